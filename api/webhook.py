@@ -1,13 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import os
 import json
 import re
 import datetime
-import requests
-from urllib.parse import quote
+from urllib.parse import quote, unquote, urlencode
+from contextlib import contextmanager
 import time
 import uuid
-from datetime import datetime, timedelta
+import threading
+import hmac
+import zlib
+from collections import OrderedDict, deque
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from array import array
 
 app = Flask(__name__)
 
@@ -25,6 +31,54 @@ print(f"Sheets ID exists: {bool(SPREADSHEET_ID)}")
 transaction_sheet = None
 holdings_sheet = None
 voting_sheet = None
+event_sheet = None
+alert_sheet = None
+route_sheet = None
+sheets_client = None
+main_spreadsheet = None
+SHEETS_INIT_LOCK = threading.Lock()
+SHEETS_INIT_AT = 0
+SHEETS_RETRY_INTERVAL = 60
+
+# 追蹤：每個事件一筆，記錄指令與每個外部呼叫（Yahoo、TWSE、Sheets、LINE）的耗時
+TRACE_BUFFER = deque(maxlen=int(os.environ.get('TRACE_BUFFER_SIZE', '200')))
+TRACE_LOCAL = threading.local()
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN')
+# 設定 OTLP_ENDPOINT（例如 http://localhost:4318）時，追蹤會以 OTLP/JSON 送出
+OTLP_ENDPOINT = os.environ.get('OTLP_ENDPOINT')
+OTLP_SERVICE_NAME = os.environ.get('OTLP_SERVICE_NAME', 'stock-linebot')
+# 匯出佇列：單一背景執行緒依序送出，collector 變慢時佇列滿了就丟棄，不堆積執行緒
+OTLP_QUEUE_SIZE = int(os.environ.get('OTLP_QUEUE_SIZE', '256'))
+OTLP_QUEUE = None
+OTLP_LOCK = threading.Lock()
+OTLP_STATS = {'exported': 0, 'failed': 0, 'dropped': 0}
+SHEET_NAME_PATTERN = re.compile(r'/values/([^!:/?]+)')
+
+# Prometheus 指標（由追蹤 span 與快取更新，/metrics 輸出）
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_LOCK = threading.Lock()
+METRICS = {
+    'commands': {},
+    'command_latency': {},
+    'upstream_latency': {},
+    'upstream_errors': {},
+    'cache': {}
+}
+
+# 單一事件分析（預設關閉）：PROFILE_EVENTS=1 分析所有事件，或只分析 PROFILE_ADMIN_USER_IDS 的事件
+# PROFILE_MODE=cprofile 輸出 pstats，PROFILE_MODE=sample 輸出 collapsed stack
+PROFILE_EVENTS = os.environ.get('PROFILE_EVENTS', '').lower() in ('1', 'true', 'yes')
+PROFILE_ADMIN_USER_IDS = {uid.strip() for uid in os.environ.get('PROFILE_ADMIN_USER_IDS', '').split(',') if uid.strip()}
+PROFILING_ENABLED = PROFILE_EVENTS or bool(PROFILE_ADMIN_USER_IDS)
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/linebot-profiles')
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_TOP_FUNCTIONS = 20
+PROFILE_LOCK = threading.Lock()
+
+# 共用 HTTP 連線（第一次對外請求時才載入 requests）
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
 
 # 儲存進行中的投票（實際部署應該用資料庫）
 active_votes = {}
@@ -35,8 +89,184 @@ STOCK_CACHE = {}
 CACHE_TIME = {}
 CACHE_DURATION = 86400  # 快取24小時
 
+# 報價快取（短時間內重複查同一支股票不再打外部 API）
+QUOTE_CACHE = {}
+QUOTE_CACHE_DURATION = int(os.environ.get('QUOTE_CACHE_DURATION', '60'))
+
+# 交易日曆：休市日、半日交易與交易時段來自 api/twse_calendar.json（第一次用到時才讀）
+# 收盤後到下次開盤前報價不會變，報價快取、價格提醒、收盤摘要都先問日曆再決定要不要查上游
+TRADING_CALENDAR_PATH = os.environ.get(
+    'TRADING_CALENDAR_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'twse_calendar.json')
+)
+TAIPEI_TZ = timezone(timedelta(hours=8))  # 台灣沒有日光節約時間
+TRADING_CALENDAR = None
+ALERT_CLOSE_GRACE = int(os.environ.get('ALERT_CLOSE_GRACE', '900'))  # 收盤後還會再檢查一次提醒的秒數
+ALERT_STATE = {'checked_at': 0}
+
+# 日線歷史（OHLCV）：每支股票一組 array 欄位存在記憶體，並以欄位格式存檔到 OHLC_DIR
+# 由 /cron/ohlc 排程增量更新，/走勢 只讀本機資料
+# 注意：Serverless 的 /tmp 只在同一個實例內有效，多實例部署請把 OHLC_DIR 指到共用磁碟
+OHLC_DIR = os.environ.get('OHLC_DIR', '/tmp/linebot-ohlc')
+OHLC_INITIAL_RANGE = os.environ.get('OHLC_INITIAL_RANGE', '1y')
+OHLC_FIELDS = (('dates', 'i'), ('open', 'd'), ('high', 'd'), ('low', 'd'), ('close', 'd'), ('volume', 'q'))
+OHLC_MARKETS = (None, 'tse', 'otc')
+OHLC_FILE_VERSION = 1
+OHLC_MAX_DAYS = 250
+OHLC_SPARKLINE_WIDTH = 30
+OHLC_CRON_BUDGET = float(os.environ.get('OHLC_CRON_BUDGET', '50'))
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+OHLC_SYMBOL_PATTERN = re.compile(r'^\d{4,6}[A-Z]?$')
+OHLC_STORE = {}
+OHLC_NAMES = None
+OHLC_LOCK = threading.RLock()
+
+QUOTE_BATCH_SIZE = 50  # mis.twse 批次報價一次查詢的股票數
+
+# 價格提醒：存在「價格提醒」工作表，由 /cron/alerts 排程批次查價後比對
+ALERT_PATTERN = re.compile(r'^/提醒\s+(\S+)\s*(>=|<=|>|<)\s*(\d+(?:\.\d+)?)\s*元?$')
+# 條件欄位的值 -> 顯示符號；above / below 不含門檻價，at_or_above / at_or_below 含
+ALERT_CONDITIONS = {'above': '>', 'at_or_above': '≥', 'below': '<', 'at_or_below': '≤'}
+ALERT_OPERATORS = {'>': 'above', '>=': 'at_or_above', '<': 'below', '<=': 'at_or_below'}
+ALERT_MAX_PER_USER = int(os.environ.get('ALERT_MAX_PER_USER', '20'))
+ALERT_CRON_BUDGET = float(os.environ.get('ALERT_CRON_BUDGET', '50'))
+ALERT_LINES_PER_MESSAGE = 20  # 每則訊息最多幾個提醒
+ALERT_PUSH_BATCH_SIZE = 5     # LINE 一次推播最多 5 則訊息
+
+# 交易紀錄匯出：/匯出 產生有時效的簽章連結，下載時分頁讀取工作表、邊讀邊輸出 CSV
+# 連結的截止時間固定在產生當下，續傳（Range）時內容不會因為新交易而改變
+EXPORT_SECRET = os.environ.get('EXPORT_SECRET', '')  # 專用金鑰，不與 LINE 簽章共用；未設定時停用匯出
+EXPORT_LINK_TTL = int(os.environ.get('EXPORT_LINK_TTL', '86400'))
+EXPORT_PAGE_ROWS = int(os.environ.get('EXPORT_PAGE_ROWS', '500'))
+EXPORT_BUDGET = float(os.environ.get('EXPORT_BUDGET', '55'))
+EXPORT_COLUMNS = (0, 2, 3, 4, 5, 6, 7, 8, 9, 13, 14)  # 交易紀錄的欄位（不含內部 ID）
+EXPORT_SIGNED_FIELDS = ('g', 'u', 'from', 'to', 'exp')
+EXPORT_SPOOL_BYTES = int(os.environ.get('EXPORT_SPOOL_BYTES', str(1024 * 1024)))  # 續傳時超過這個大小的 CSV 暫存到磁碟
+EXPORT_READ_BYTES = 64 * 1024
+
+# 收盤摘要：/cron/digest 每個交易日推播各群組的今日損益、結束的投票與交易
+DIGEST_CRON_BUDGET = float(os.environ.get('DIGEST_CRON_BUDGET', '50'))
+DIGEST_MAX_TRADES = 20
+
+# 唯讀指令的回覆快取：key 含群組的持股／投票版本與報價時段，寫入時版本加一即失效
+# REPLY_CACHE_TTL 另外限制最長保留時間（其他實例的寫入不會更新這裡的版本）
+REPLY_CACHE = OrderedDict()
+REPLY_CACHE_TTL = int(os.environ.get('REPLY_CACHE_TTL', '60'))
+REPLY_CACHE_MAX_SIZE = int(os.environ.get('REPLY_CACHE_MAX_SIZE', '200'))
+REPLY_VERSIONS = {}  # (範圍, 群組ID) -> 版本
+REPLY_CACHE_LOCK = threading.Lock()
+
+# 長回覆切成多則訊息：一次回覆最多 5 則，其餘改用推播（每次推播同樣最多 5 則）
+# REPLY_FLEX=1 時，超過一則的回覆改用 Flex 輪播，一則訊息可容納多張卡片
+LINE_TEXT_LIMIT = 5000
+LINE_MESSAGES_PER_CALL = 5
+REPLY_FLEX = os.environ.get('REPLY_FLEX', '').lower() in ('1', 'true', 'yes')
+FLEX_BUBBLE_CHARS = int(os.environ.get('FLEX_BUBBLE_CHARS', '1200'))
+FLEX_BUBBLES_PER_CAROUSEL = 10
+REPLY_BLOCK_SEPARATOR = '=' * 25
+
+# 排程端點（/cron/...）驗證用，Vercel Cron 會帶 Authorization: Bearer <CRON_SECRET>
+CRON_SECRET = os.environ.get('CRON_SECRET', '')
+
+# 每個事件的時間預算：LINE 回覆 token 有時效，超過就只能改用推播
+REPLY_TOKEN_TTL = float(os.environ.get('REPLY_TOKEN_TTL', '50'))
+DEADLINE_LOW_WATER = float(os.environ.get('DEADLINE_LOW_WATER', '8'))
+MIN_UPSTREAM_TIMEOUT = 0.5
+SHEETS_TIMEOUT = float(os.environ.get('SHEETS_TIMEOUT', '15'))
+
+# 使用者名稱快取（key: (群組ID, 使用者ID)）
+PROFILE_CACHE = OrderedDict()
+PROFILE_CACHE_DURATION = int(os.environ.get('PROFILE_CACHE_DURATION', '3600'))
+PROFILE_CACHE_MAX_SIZE = int(os.environ.get('PROFILE_CACHE_MAX_SIZE', '1000'))
+PROFILE_CACHE_LOCK = threading.Lock()
+PROFILE_CACHE_STATS = {'hits': 0, 'misses': 0, 'fetches': 0, 'fetch_time_total': 0.0}
+LINE_BOT_API = None
+
+# 重送事件去重（LINE 逾時重送時 webhookEventId 不變）
+SEEN_EVENTS = OrderedDict()
+SEEN_EVENTS_TTL = int(os.environ.get('EVENT_DEDUP_TTL', '86400'))
+SEEN_EVENTS_MAX_SIZE = int(os.environ.get('EVENT_DEDUP_MAX_SIZE', '10000'))
+SEEN_EVENTS_LOCK = threading.Lock()
+# EVENT_DEDUP_SHEET=1 時，寫入類指令的事件ID另存到「事件紀錄」工作表，跨實例也能去重
+EVENT_DEDUP_SHEET = os.environ.get('EVENT_DEDUP_SHEET', '').lower() in ('1', 'true', 'yes')
+WRITE_COMMAND_PREFIXES = ('/買入', '/賣出', '/贊成', '/反對', '/提醒', '/取消提醒', '/匯入')
+
+# 群組排行榜快照：每位成員的成本與市值合計，交易寫入與報價更新時增量調整
+LEADERBOARD = {}          # 群組ID -> {'users': {使用者ID: {...}}}
+LEADERBOARD_HOLDERS = {}  # 股票代號 -> {(群組ID, 使用者ID)}，報價更新時只調整持有者
+LEADERBOARD_PRICES = {}   # 股票代號 -> 快照使用的最新價格
+LEADERBOARD_STATE = {'loaded_at': 0, 'groups': {}}  # 分片模式下依群組各自重建
+LEADERBOARD_TTL = int(os.environ.get('LEADERBOARD_TTL', '600'))
+LEADERBOARD_LOCK = threading.RLock()
+
+# 分片：SHARD_MODE=group 每個群組各自一組工作表，SHARD_MODE=bucket 依群組ID雜湊分到 SHARD_BUCKETS 組
+# 「分片路由」工作表記錄 群組 -> 分片，群組第一次交易時才建立；既有資料用 migrate_to_shards() 搬移
+# SHARD_SPREADSHEET_IDS（逗號分隔）可把分片分散到其他試算表（需與主試算表共用給同一個服務帳號）
+SHARD_MODE = os.environ.get('SHARD_MODE', 'off').lower()
+if SHARD_MODE not in ('group', 'bucket'):
+    SHARD_MODE = 'off'
+SHARD_BUCKETS = int(os.environ.get('SHARD_BUCKETS', '16'))
+SHARD_SPREADSHEET_IDS = [sid.strip() for sid in os.environ.get('SHARD_SPREADSHEET_IDS', '').split(',') if sid.strip()]
+SHARD_ROUTE_REFRESH = int(os.environ.get('SHARD_ROUTE_REFRESH', '60'))
+SHARD_ROUTES = {}        # 群組ID -> (分片, 試算表ID)
+SHARD_SHEETS = {}        # 分片 -> {種類: 工作表}
+SHARD_SPREADSHEETS = {}  # 試算表ID -> 試算表
+SHARD_STATE = {'loaded_at': 0}
+SHARD_UNMIGRATED = set()  # 共用表裡還有資料、尚未遷移的群組（寫入時先不建立路由）
+SHARD_LOCK = threading.RLock()
+
+# 批次成本引擎：重播交易紀錄，保留每筆買入批次，支援 FIFO 與平均成本兩種已實現損益
+# 狀態存成 JSON（Serverless 的 /tmp 在同一個實例內可沿用），之後只讀游標之後的新交易
+LOT_STATE_PATH = os.environ.get('LOT_STATE_PATH', '/tmp/linebot-lots.json')
+LOT_METHOD = 'average' if os.environ.get('LOT_METHOD', 'fifo').lower() == 'average' else 'fifo'
+LOT_STATES = {}  # 分片 -> 狀態（未分片時只有 None 一份）
+LOT_LOCK = threading.Lock()
+
+# 事件處理執行緒池：不同來源（群組/使用者）的事件並行處理，同一來源依序處理
+# ASYNC_WEBHOOK=1 時先回 200 再由背景執行緒處理並回覆
+# 注意：Serverless 環境回應後可能凍結程序，建議搭配常駐部署（gunicorn 等）使用
+ASYNC_WEBHOOK = os.environ.get('ASYNC_WEBHOOK', '').lower() in ('1', 'true', 'yes')
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', '4'))
+EVENT_EXECUTOR = None
+SOURCE_QUEUES = {}  # 來源 -> 待處理事件 deque[(事件, 進佇列時間, Future 或 None)]；有項目時恰好有一個工作在處理
+EVENT_STATS_LOCK = threading.Lock()
+EVENT_STATS_STARTED_AT = time.time()
+# 排隊延遲 = 進來源佇列到被取出處理的時間；忙碌時間只算處理事件本身
+EVENT_QUEUE_STATS = {
+    'enqueued': 0,
+    'dequeued': 0,
+    'processed': 0,
+    'failed': 0,
+    'in_flight': 0,
+    'queue_latency_total': 0.0,
+    'queue_latency_max': 0.0,
+    'busy_time_total': 0.0
+}
+
+# 可分片的工作表：種類 -> (工作表名稱, 標題列)
+SHEET_LAYOUTS = {
+    'transactions': ('交易紀錄', ['日期時間', '使用者ID', '使用者名稱', '股票代號', '股票名稱',
+                                 '交易類型', '股數', '單價', '總金額', '理由', '群組ID', '紀錄ID',
+                                 '投票ID', '狀態', '備註']),
+    'holdings': ('持股統計', ['使用者ID', '使用者名稱', '股票代號', '股票名稱',
+                              '總股數', '平均成本', '總成本', '群組ID', '更新時間', '備註']),
+    'votes': ('投票紀錄', ['投票ID', '發起人ID', '發起人名稱', '股票代號', '股票名稱',
+                          '賣出股數', '賣出價格', '群組ID', '投票狀態', '贊成票數',
+                          '反對票數', '創建時間', '截止時間', '結果', '備註']),
+}
+ROUTE_SHEET_HEADER = ['群組ID', '分片', '試算表ID', '建立時間']
+
+def open_worksheet(spreadsheet, title, header):
+    """取得工作表，不存在時建立並寫入標題列"""
+    try:
+        return spreadsheet.worksheet(title)
+    except Exception:
+        worksheet = spreadsheet.add_worksheet(title=title, rows=1000, cols=len(header))
+        worksheet.update(f'A1:{chr(ord("A") + len(header) - 1)}1', [header])
+        return worksheet
+
 def init_google_sheets():
-    global transaction_sheet, holdings_sheet, voting_sheet
+    global transaction_sheet, holdings_sheet, voting_sheet, event_sheet, alert_sheet
+    global route_sheet, sheets_client, main_spreadsheet
     try:
         if not GOOGLE_CREDENTIALS_JSON:
             print("❌ 沒有 Google 認證資訊")
@@ -45,31 +275,34 @@ def init_google_sheets():
         import gspread
         credentials_info = json.loads(GOOGLE_CREDENTIALS_JSON)
         gc = gspread.service_account_from_dict(credentials_info)
+        gc.set_timeout(SHEETS_TIMEOUT)
+        trace_sheets_client(gc)
         spreadsheet = gc.open_by_key(SPREADSHEET_ID)
+        sheets_client = gc
+        main_spreadsheet = spreadsheet
         
-        # 取得或創建工作表
-        try:
-            transaction_sheet = spreadsheet.worksheet('交易紀錄')
-        except:
-            transaction_sheet = spreadsheet.add_worksheet(title='交易紀錄', rows=1000, cols=15)
-            transaction_sheet.update('A1:O1', [['日期時間', '使用者ID', '使用者名稱', '股票代號', '股票名稱', 
-                                               '交易類型', '股數', '單價', '總金額', '理由', '群組ID', '紀錄ID', 
-                                               '投票ID', '狀態', '備註']])
+        # 取得或創建工作表（分片模式下這三張是遷移前的共用表）
+        transaction_sheet = open_worksheet(spreadsheet, *SHEET_LAYOUTS['transactions'])
+        holdings_sheet = open_worksheet(spreadsheet, *SHEET_LAYOUTS['holdings'])
+        voting_sheet = open_worksheet(spreadsheet, *SHEET_LAYOUTS['votes'])
         
-        try:
-            holdings_sheet = spreadsheet.worksheet('持股統計')
-        except:
-            holdings_sheet = spreadsheet.add_worksheet(title='持股統計', rows=1000, cols=10)
-            holdings_sheet.update('A1:J1', [['使用者ID', '使用者名稱', '股票代號', '股票名稱', 
-                                            '總股數', '平均成本', '總成本', '群組ID', '更新時間', '備註']])
+        if SHARD_MODE != 'off':
+            route_sheet = open_worksheet(spreadsheet, '分片路由', ROUTE_SHEET_HEADER)
+            load_shard_routes()
         
         try:
-            voting_sheet = spreadsheet.worksheet('投票紀錄')
+            alert_sheet = spreadsheet.worksheet('價格提醒')
         except:
-            voting_sheet = spreadsheet.add_worksheet(title='投票紀錄', rows=1000, cols=15)
-            voting_sheet.update('A1:O1', [['投票ID', '發起人ID', '發起人名稱', '股票代號', '股票名稱',
-                                          '賣出股數', '賣出價格', '群組ID', '投票狀態', '贊成票數', 
-                                          '反對票數', '創建時間', '截止時間', '結果', '備註']])
+            alert_sheet = spreadsheet.add_worksheet(title='價格提醒', rows=1000, cols=13)
+            alert_sheet.update('A1:M1', [['提醒ID', '使用者ID', '使用者名稱', '群組ID', '股票代號', '股票名稱',
+                                         '市場', '條件', '價格', '狀態', '建立時間', '觸發時間', '觸發價格']])
+        
+        if EVENT_DEDUP_SHEET:
+            try:
+                event_sheet = spreadsheet.worksheet('事件紀錄')
+            except:
+                event_sheet = spreadsheet.add_worksheet(title='事件紀錄', rows=1000, cols=3)
+                event_sheet.update('A1:C1', [['事件ID', '處理時間', '指令']])
         
         print("✅ Google Sheets 初始化成功")
         return True
@@ -77,12 +310,612 @@ def init_google_sheets():
         print(f"❌ Google Sheets 初始化失敗: {e}")
         return False
 
-# 初始化 Google Sheets
-init_google_sheets()
+def ensure_google_sheets():
+    """第一次需要 Google Sheets 的指令才初始化（冷啟動不連線）"""
+    global SHEETS_INIT_AT
+    if transaction_sheet and holdings_sheet and voting_sheet:
+        return True
+    
+    with SHEETS_INIT_LOCK:
+        if transaction_sheet and holdings_sheet and voting_sheet:
+            return True
+        # 初始化失敗後稍等一段時間再重試，避免每個指令都重新連線
+        if SHEETS_INIT_AT and time.time() - SHEETS_INIT_AT < SHEETS_RETRY_INTERVAL:
+            return False
+        SHEETS_INIT_AT = time.time()
+        return init_google_sheets()
+
+def get_shared_sheet(kind):
+    """未分片（或遷移前）所有群組共用的工作表"""
+    return {'transactions': transaction_sheet, 'holdings': holdings_sheet, 'votes': voting_sheet}[kind]
+
+def get_group_shard(group_id):
+    """新群組要放的分片：group 模式每個群組一個，bucket 模式依群組ID雜湊分桶"""
+    group_key = str(group_id or 'private')
+    if SHARD_MODE == 'group':
+        return group_key
+    return f"b{zlib.crc32(group_key.encode('utf-8')) % SHARD_BUCKETS:03d}"
+
+def load_shard_routes():
+    """讀取路由表；同一群組有多列時（多個實例同時建立）以第一列為準"""
+    routes = {}
+    for record in read_sheet_records(route_sheet):
+        group_id = str(record.get('群組ID', ''))
+        if group_id and group_id not in routes:
+            routes[group_id] = (str(record.get('分片', '')), str(record.get('試算表ID', '')))
+    with SHARD_LOCK:
+        SHARD_ROUTES.clear()
+        SHARD_ROUTES.update(routes)
+        SHARD_STATE['loaded_at'] = time.time()
+    return routes
+
+def get_shard_route(group_id):
+    """群組的 (分片, 試算表ID)，還沒有路由時回傳 None；查不到時最多每 SHARD_ROUTE_REFRESH 秒重讀一次路由表"""
+    group_key = str(group_id or 'private')
+    route = SHARD_ROUTES.get(group_key)
+    if route is None and route_sheet and time.time() - SHARD_STATE['loaded_at'] >= SHARD_ROUTE_REFRESH:
+        route = load_shard_routes().get(group_key)
+    return route
+
+def create_shard_route(group_id):
+    """群組第一次交易時建立路由（先重讀路由表，避免覆蓋其他實例剛建立的路由）"""
+    group_key = str(group_id or 'private')
+    with SHARD_LOCK:
+        route = load_shard_routes().get(group_key)
+        if route:
+            return route
+        shard = get_group_shard(group_key)
+        spreadsheet_id = ''
+        if SHARD_SPREADSHEET_IDS:
+            spreadsheet_id = SHARD_SPREADSHEET_IDS[zlib.crc32(shard.encode('utf-8')) % len(SHARD_SPREADSHEET_IDS)]
+        route_sheet.append_row([group_key, shard, spreadsheet_id, local_now().strftime('%Y-%m-%d %H:%M:%S')])
+        SHARD_ROUTES[group_key] = (shard, spreadsheet_id)
+        print(f"🧩 群組 {group_key} 分配到分片 {shard}")
+        return SHARD_ROUTES[group_key]
+
+def open_shard_sheets(route):
+    """取得分片的三張工作表（每個實例只開啟一次）"""
+    shard, spreadsheet_id = route
+    with SHARD_LOCK:
+        sheets = SHARD_SHEETS.get(shard)
+        if sheets is None:
+            spreadsheet = main_spreadsheet
+            if spreadsheet_id and spreadsheet_id != SPREADSHEET_ID:
+                spreadsheet = SHARD_SPREADSHEETS.get(spreadsheet_id)
+                if spreadsheet is None:
+                    spreadsheet = SHARD_SPREADSHEETS[spreadsheet_id] = sheets_client.open_by_key(spreadsheet_id)
+            sheets = SHARD_SHEETS[shard] = {
+                kind: open_worksheet(spreadsheet, f"{title}_{shard}", header)
+                for kind, (title, header) in SHEET_LAYOUTS.items()
+            }
+        return sheets
+
+def has_shared_rows(group_id):
+    """共用表裡是否還有這個群組的持股或交易（有的話要等遷移，不能直接開新分片）"""
+    group_key = str(group_id or 'private')
+    if group_key in SHARD_UNMIGRATED:
+        return True
+    for kind in ('holdings', 'transactions'):
+        sheet = get_shared_sheet(kind)
+        group_column = SHEET_LAYOUTS[kind][1].index('群組ID') + 1
+        if sheet and sheet.find(group_key, in_column=group_column):
+            SHARD_UNMIGRATED.add(group_key)
+            return True
+    return False
+
+def get_group_sheet(kind, group_id, create=False):
+    """群組資料所在的工作表
+    
+    分片模式下還沒有路由的群組讀寫共用表；共用表沒有這個群組的資料（新群組）時，寫入（create=True）才建立路由與分片。
+    """
+    if SHARD_MODE == 'off':
+        return get_shared_sheet(kind)
+    
+    route = get_shard_route(group_id)
+    if route is None:
+        if not create or has_shared_rows(group_id):
+            return get_shared_sheet(kind)
+        route = create_shard_route(group_id)
+    return open_shard_sheets(route)[kind]
+
+def read_group_records(kind, group_id, deadline=None):
+    """讀取群組所在工作表的所有記錄（分片模式下只讀該群組的分片）；多行指令期間同一張表只讀一次"""
+    sheet = get_group_sheet(kind, group_id)
+    if not sheet:
+        return []
+    snapshots = getattr(BATCH_LOCAL, 'records', None)
+    if snapshots is None:
+        return read_sheet_records(sheet, deadline)
+    if id(sheet) not in snapshots:
+        snapshots[id(sheet)] = read_sheet_records(sheet, deadline)
+    return snapshots[id(sheet)]
+
+def forget_batch_records():
+    """寫入持股後丟掉多行指令的快照，之後的指令重新讀取"""
+    if getattr(BATCH_LOCAL, 'records', None):
+        BATCH_LOCAL.records.clear()
+
+def append_sheet_row(sheet, row):
+    """新增一列；多行指令期間先暫存，結束時每張表合併成一次 append_rows
+
+    只用在指令執行期間不會再讀的表（交易紀錄、投票）；持股的新增要馬上寫入，後面的指令才讀得到。
+    """
+    pending = getattr(BATCH_LOCAL, 'appends', None)
+    if pending is None:
+        sheet.append_row(row)
+        return
+    pending.setdefault(id(sheet), (sheet, []))[1].append(row)
+
+@contextmanager
+def batch_scope():
+    """多行指令的處理範圍：共用工作表快照、合併新增列"""
+    BATCH_LOCAL.records = {}
+    BATCH_LOCAL.appends = {}
+    try:
+        yield
+    finally:
+        pending = BATCH_LOCAL.appends
+        BATCH_LOCAL.records = None
+        BATCH_LOCAL.appends = None
+        for sheet, rows in pending.values():
+            try:
+                sheet.append_rows(rows)
+            except Exception as e:
+                print(f"❌ 批次新增 {len(rows)} 列失敗: {e}")
+
+def get_all_shard_sheets(kind):
+    """所有分片的同種工作表（排程等跨群組的工作用），未分片時只有共用表"""
+    if SHARD_MODE == 'off':
+        return [get_shared_sheet(kind)]
+    if route_sheet:
+        load_shard_routes()
+    routes = {route[0]: route for route in list(SHARD_ROUTES.values())}
+    return [open_shard_sheets(route)[kind] for route in routes.values()]
+
+def read_all_shard_records(kind, deadline=None):
+    """依序讀取所有分片的記錄並合併；分片模式下共用表裡還沒有路由（未遷移）的群組也一起讀"""
+    records = []
+    for sheet in get_all_shard_sheets(kind):
+        records.extend(read_sheet_records(sheet, deadline))
+    if SHARD_MODE != 'off' and get_shared_sheet(kind):
+        records.extend(record for record in read_sheet_records(get_shared_sheet(kind), deadline)
+                       if str(record.get('群組ID', '')) not in SHARD_ROUTES)
+    return records
+
+# 遷移時判斷分片裡是否已有同一列：交易紀錄看紀錄ID、投票看投票ID
+MIGRATION_KEY_COLUMNS = {'transactions': '紀錄ID', 'votes': '投票ID'}
+
+def get_migration_key(kind, row):
+    """列的遷移比對 key，沒有 ID 的舊資料用整列內容"""
+    column = SHEET_LAYOUTS[kind][1].index(MIGRATION_KEY_COLUMNS[kind])
+    value = str(row[column]) if column < len(row) else ''
+    return value or tuple(str(value) for value in row)
+
+def ledger_rows_to_trades(rows):
+    """交易紀錄的原始列轉成 plan_trades 用的交易（只取已執行的買賣）"""
+    trades = []
+    for line_no, row in enumerate(rows, 1):
+        row = list(row) + [''] * (15 - len(row))
+        if row[5] not in ('買入', '賣出') or (row[13] and row[13] != '已執行'):
+            continue
+        shares = int(parse_sheet_number(row[6]))
+        if shares <= 0:
+            continue
+        trades.append({
+            'line_no': line_no, 'time': str(row[0]), 'action': 'buy' if row[5] == '買入' else 'sell',
+            'user_id': str(row[1]), 'user_name': str(row[2]), 'group_id': str(row[10]),
+            'stock_code': str(row[3]), 'stock_name': str(row[4]),
+            'shares': shares, 'price': parse_sheet_number(row[7])
+        })
+    return trades
+
+def migrate_to_shards(dry_run=False):
+    """把共用的交易紀錄、持股統計、投票紀錄依群組搬到各分片
+    
+    逐列比對分片裡已有的資料，不看群組有沒有路由，可重複執行（共用表保留不刪）：
+    * 交易紀錄、投票紀錄：分片裡還沒有的紀錄ID／投票ID才搬，遷移後到部署前寫進共用表的列重跑時會補上
+    * 持股統計：分片裡這個群組還沒有持股和交易時直接複製；已經在分片交易過（例如先開了分片才遷移）
+      或是補搬了交易時，把補搬的交易套用到分片的持股上
+    每個分片的每張表最多讀一次、寫一次，回傳各群組搬移的列數。
+    """
+    if SHARD_MODE == 'off':
+        raise ValueError('請先設定 SHARD_MODE=group 或 bucket')
+    
+    load_shard_routes()
+    shared = {}  # 種類 -> 群組ID -> [列]
+    for kind, (title, header) in SHEET_LAYOUTS.items():
+        group_column = header.index('群組ID')
+        shared[kind] = {}
+        for row in get_shared_sheet(kind).get(f'A2:{chr(ord("A") + len(header) - 1)}',
+                                              value_render_option='UNFORMATTED_VALUE'):
+            group_id = str(row[group_column]) if group_column < len(row) else ''
+            if group_id:
+                shared[kind].setdefault(group_id, []).append(row)
+    
+    shard_rows = {}  # (分片, 種類) -> 分片裡的列（bucket 模式多個群組共用，只讀一次）
+    def get_shard_rows(route, kind):
+        key = (route[0], kind)
+        if key not in shard_rows:
+            header = SHEET_LAYOUTS[kind][1]
+            shard_rows[key] = open_shard_sheets(route)[kind].get(
+                f'A2:{chr(ord("A") + len(header) - 1)}', value_render_option='UNFORMATTED_VALUE')
+        return shard_rows[key]
+    
+    def group_rows(rows, kind, group_id):
+        group_column = SHEET_LAYOUTS[kind][1].index('群組ID')
+        return [row for row in rows if group_column < len(row) and str(row[group_column]) == group_id]
+    
+    summary = {}
+    moves = {}  # 群組ID -> {種類: [要新增的列]}
+    replays = {}  # 群組ID -> [要套用到分片持股的交易列]
+    group_ids = set().union(*shared.values())
+    for group_id in sorted(group_ids):
+        route = SHARD_ROUTES.get(group_id)
+        existing = {kind: group_rows(get_shard_rows(route, kind), kind, group_id) if route else []
+                    for kind in SHEET_LAYOUTS}
+        
+        group_moves = {}
+        for kind in MIGRATION_KEY_COLUMNS:
+            seen = {get_migration_key(kind, row) for row in existing[kind]}
+            rows = [row for row in shared[kind].get(group_id, []) if get_migration_key(kind, row) not in seen]
+            if rows:
+                group_moves[kind] = rows
+        
+        if not existing['holdings'] and not existing['transactions']:
+            if shared['holdings'].get(group_id):
+                group_moves['holdings'] = shared['holdings'][group_id]
+        elif group_moves.get('transactions'):
+            replays[group_id] = group_moves['transactions']
+        
+        if group_moves:
+            moves[group_id] = group_moves
+            summary[group_id] = {kind: len(rows) for kind, rows in group_moves.items()}
+    
+    if dry_run:
+        return summary
+    
+    # bucket 模式多個群組共用分片，先依分片合併再寫
+    by_shard = {}
+    for group_id, group_moves in moves.items():
+        route = SHARD_ROUTES.get(group_id) or create_shard_route(group_id)
+        shard = by_shard.setdefault(route, {'rows': {}, 'replay': []})
+        for kind, rows in group_moves.items():
+            shard['rows'].setdefault(kind, []).extend(rows)
+        shard['replay'].extend(replays.get(group_id, []))
+        SHARD_UNMIGRATED.discard(group_id)
+    
+    for route, shard in by_shard.items():
+        sheets = open_shard_sheets(route)
+        # 持股先依補搬的交易調整（列號以目前內容為準），再新增直接複製的持股
+        if shard['replay']:
+            records = read_sheet_records(sheets['holdings'])
+            changed, errors = plan_trades(records, ledger_rows_to_trades(shard['replay']))
+            for error in errors:
+                print(f"⚠️ 分片 {route[0]} 套用交易失敗：{error}")
+            write_position_changes(sheets['holdings'], changed, local_now().strftime('%Y-%m-%d %H:%M:%S'))
+        for kind, rows in shard['rows'].items():
+            sheets[kind].append_rows(rows)
+        print(f"🧩 分片 {route[0]}：" + "、".join(f"{SHEET_LAYOUTS[kind][0]} {len(rows)} 列" for kind, rows in shard['rows'].items())
+              + (f"，持股套用 {len(shard['replay'])} 筆交易" if shard['replay'] else ''))
+    return summary
+
+class Deadline:
+    """單一事件的時間預算，外部呼叫依剩餘時間縮短 timeout"""
+    
+    def __init__(self, expires_at):
+        self.expires_at = expires_at
+    
+    @classmethod
+    def for_event(cls, event):
+        """回覆 token 從事件發生時開始計時（LINE timestamp 為毫秒）"""
+        now = time.time()
+        event_time = event.get('timestamp')
+        started_at = min(now, event_time / 1000) if isinstance(event_time, (int, float)) else now
+        return cls(started_at + REPLY_TOKEN_TTL)
+    
+    def remaining(self):
+        return max(0.0, self.expires_at - time.time())
+    
+    def expired(self):
+        return self.remaining() <= 0
+    
+    def running_low(self):
+        """剩餘時間不多時，應略過非必要的外部呼叫（例如即時股價）"""
+        return self.remaining() < DEADLINE_LOW_WATER
+
+def upstream_timeout(deadline, default):
+    """外部呼叫的 timeout：不超過預設值，也不超過剩餘時間"""
+    if deadline is None:
+        return default
+    return max(MIN_UPSTREAM_TIMEOUT, min(default, deadline.remaining()))
+
+def get_http_session():
+    """共用的 HTTP 連線（第一次使用時才載入 requests）"""
+    global HTTP_SESSION
+    if HTTP_SESSION is None:
+        with HTTP_SESSION_LOCK:
+            if HTTP_SESSION is None:
+                import requests
+                HTTP_SESSION = requests.Session()
+    return HTTP_SESSION
+
+@contextmanager
+def trace_span(name, **attrs):
+    """記錄一段操作的耗時；不在追蹤中的呼叫照常執行，只是不保存"""
+    trace = getattr(TRACE_LOCAL, 'trace', None)
+    span = {
+        'name': name,
+        'span_id': os.urandom(8).hex(),
+        'parent_id': None,
+        'start': time.time(),
+        'status': 'ok',
+        'attrs': attrs
+    }
+    if trace is not None:
+        stack = trace['stack']
+        span['parent_id'] = stack[-1]['span_id'] if stack else None
+        stack.append(span)
+    
+    started_at = time.perf_counter()
+    try:
+        yield span
+    except Exception as e:
+        span['status'] = 'error'
+        span['attrs']['error'] = str(e)[:200]
+        raise
+    finally:
+        span['duration_ms'] = (time.perf_counter() - started_at) * 1000
+        if trace is not None:
+            trace['stack'].pop()
+            trace['spans'].append(span)
+        observe_span(span)
+
+@contextmanager
+def start_trace(name, **attrs):
+    """開始一個事件的追蹤，結束後放進最近追蹤的環形緩衝區"""
+    trace = {
+        'trace_id': os.urandom(16).hex(),
+        'name': name,
+        'attrs': attrs,
+        'spans': [],
+        'stack': []
+    }
+    TRACE_LOCAL.trace = trace
+    root = None
+    try:
+        with trace_span(name, **attrs) as root:
+            yield root
+    finally:
+        TRACE_LOCAL.trace = None
+        del trace['stack']
+        if root is not None:
+            trace['start'] = root['start']
+            trace['duration_ms'] = root['duration_ms']
+            trace['status'] = root['status']
+            TRACE_BUFFER.append(trace)
+            if OTLP_ENDPOINT:
+                export_trace_otlp(trace)
+
+def observe_histogram(histograms, label, seconds):
+    """記錄一筆耗時到直方圖（每個 label 一組桶）"""
+    histogram = histograms.get(label)
+    if histogram is None:
+        histogram = histograms.setdefault(label, {'buckets': [0] * (len(METRICS_BUCKETS) + 1), 'sum': 0.0, 'count': 0})
+    histogram['buckets'][bisect_left(METRICS_BUCKETS, seconds)] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+def observe_span(span):
+    """span 結束時更新指標：指令與外部呼叫的次數、延遲與錯誤數"""
+    seconds = span['duration_ms'] / 1000
+    name = span['name']
+    
+    with METRICS_LOCK:
+        if name.startswith('command.'):
+            command = span['attrs'].get('command') or name.removeprefix('command.')
+            METRICS['commands'][command] = METRICS['commands'].get(command, 0) + 1
+            observe_histogram(METRICS['command_latency'], command, seconds)
+        elif 'provider' in span['attrs']:
+            provider = span['attrs']['provider']
+            observe_histogram(METRICS['upstream_latency'], provider, seconds)
+            if span['status'] == 'error':
+                METRICS['upstream_errors'][provider] = METRICS['upstream_errors'].get(provider, 0) + 1
+
+def record_cache_event(cache, result):
+    """快取命中 / 未命中 / 淘汰次數"""
+    key = (cache, result)
+    with METRICS_LOCK:
+        METRICS['cache'][key] = METRICS['cache'].get(key, 0) + 1
+
+def render_metrics():
+    """輸出 Prometheus 文字格式"""
+    lines = []
+    
+    def histogram_lines(metric, label_name, histograms):
+        lines.append(f"# TYPE {metric} histogram")
+        for label, histogram in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + (float('inf'),), histogram['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{metric}_bucket{{{label_name}="{label}",le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{label_name}="{label}"}} {histogram["sum"]:.6f}')
+            lines.append(f'{metric}_count{{{label_name}="{label}"}} {histogram["count"]}')
+    
+    with METRICS_LOCK:
+        lines.append("# HELP linebot_commands_total 指令處理次數")
+        lines.append("# TYPE linebot_commands_total counter")
+        for command, count in sorted(METRICS['commands'].items()):
+            lines.append(f'linebot_commands_total{{command="{command}"}} {count}')
+        
+        lines.append("# HELP linebot_command_duration_seconds 指令處理耗時")
+        histogram_lines('linebot_command_duration_seconds', 'command', METRICS['command_latency'])
+        
+        lines.append("# HELP linebot_upstream_duration_seconds 外部呼叫耗時（yahoo、twse、sheets、line）")
+        histogram_lines('linebot_upstream_duration_seconds', 'provider', METRICS['upstream_latency'])
+        
+        lines.append("# HELP linebot_upstream_errors_total 外部呼叫錯誤次數")
+        lines.append("# TYPE linebot_upstream_errors_total counter")
+        for provider, count in sorted(METRICS['upstream_errors'].items()):
+            lines.append(f'linebot_upstream_errors_total{{provider="{provider}"}} {count}')
+        
+        lines.append("# HELP linebot_cache_events_total 快取命中、未命中與淘汰次數")
+        lines.append("# TYPE linebot_cache_events_total counter")
+        for (cache, result), count in sorted(METRICS['cache'].items()):
+            lines.append(f'linebot_cache_events_total{{cache="{cache}",result="{result}"}} {count}')
+    
+    now = local_now()
+    in_flight_votes = sum(1 for vote in list(active_votes.values())
+                          if vote['status'] == 'active' and vote['deadline'] > now)
+    queue_stats = get_event_queue_stats()
+    
+    lines.append("# HELP linebot_votes_in_flight 進行中的投票數")
+    lines.append("# TYPE linebot_votes_in_flight gauge")
+    lines.append(f"linebot_votes_in_flight {in_flight_votes}")
+    lines.append("# HELP linebot_cache_entries 快取項目數")
+    lines.append("# TYPE linebot_cache_entries gauge")
+    lines.append(f'linebot_cache_entries{{cache="stock_info"}} {len(STOCK_CACHE)}')
+    lines.append(f'linebot_cache_entries{{cache="quote"}} {len(QUOTE_CACHE)}')
+    lines.append(f'linebot_cache_entries{{cache="profile"}} {len(PROFILE_CACHE)}')
+    lines.append("# HELP linebot_events_pending 背景佇列中等待處理的事件數")
+    lines.append("# TYPE linebot_events_pending gauge")
+    lines.append(f"linebot_events_pending {queue_stats['pending']}")
+    
+    if OTLP_ENDPOINT:
+        with OTLP_LOCK:
+            otlp_stats = dict(OTLP_STATS)
+        lines.append("# HELP linebot_otlp_traces_total OTLP 追蹤匯出結果（dropped 是佇列滿時丟棄的）")
+        lines.append("# TYPE linebot_otlp_traces_total counter")
+        for result, count in sorted(otlp_stats.items()):
+            lines.append(f'linebot_otlp_traces_total{{result="{result}"}} {count}')
+    
+    return "\n".join(lines) + "\n"
+
+def traced_request(span_name, method, url, attrs=None, **kwargs):
+    """對外 HTTP 請求，記錄 provider、狀態碼與耗時"""
+    provider = span_name.split('.')[0]
+    with trace_span(span_name, provider=provider, **(attrs or {})) as span:
+        response = get_http_session().request(method, url, **kwargs)
+        span['attrs']['http_status'] = response.status_code
+        if response.status_code >= 400:
+            span['status'] = 'error'
+        return response
+
+def trace_sheets_client(gc):
+    """替 gspread 的 HTTP 客戶端加上追蹤（每個 Sheets API 請求一個 span）"""
+    http_client = gc.http_client
+    original_request = http_client.request
+    
+    def request(method, endpoint, *args, **kwargs):
+        # endpoint 形如 .../values/交易紀錄!A1:O1，取出工作表名稱
+        match = SHEET_NAME_PATTERN.search(unquote(str(endpoint)))
+        attrs = {'method': method, 'sheet': match.group(1) if match else ''}
+        with trace_span(f'sheets.{method.lower()}', provider='sheets', **attrs) as span:
+            response = original_request(method, endpoint, *args, **kwargs)
+            span['attrs']['http_status'] = response.status_code
+            return response
+    
+    http_client.request = request
+
+def get_slowest_traces(limit=10):
+    """最近的追蹤中最慢的幾筆"""
+    traces = sorted(list(TRACE_BUFFER), key=lambda t: t['duration_ms'], reverse=True)
+    return traces[:limit]
+
+def build_otlp_payload(trace):
+    """轉成 OTLP/JSON 格式（/v1/traces）"""
+    def attributes(attrs):
+        result = []
+        for key, value in attrs.items():
+            if isinstance(value, bool):
+                result.append({'key': key, 'value': {'boolValue': value}})
+            elif isinstance(value, int):
+                result.append({'key': key, 'value': {'intValue': str(value)}})
+            elif isinstance(value, float):
+                result.append({'key': key, 'value': {'doubleValue': value}})
+            else:
+                result.append({'key': key, 'value': {'stringValue': str(value)}})
+        return result
+    
+    spans = []
+    for span in trace['spans']:
+        start_ns = int(span['start'] * 1e9)
+        otlp_span = {
+            'traceId': trace['trace_id'],
+            'spanId': span['span_id'],
+            'name': span['name'],
+            # SpanKind：根 span 為 SERVER，外部呼叫為 CLIENT，其他為 INTERNAL
+            'kind': 2 if span['parent_id'] is None else (3 if 'provider' in span['attrs'] else 1),
+            'startTimeUnixNano': str(start_ns),
+            'endTimeUnixNano': str(start_ns + int(span['duration_ms'] * 1e6)),
+            'attributes': attributes(span['attrs']),
+            'status': {'code': 2 if span['status'] == 'error' else 1}
+        }
+        if span['parent_id']:
+            otlp_span['parentSpanId'] = span['parent_id']
+        spans.append(otlp_span)
+    
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': attributes({'service.name': OTLP_SERVICE_NAME})},
+            'scopeSpans': [{'scope': {'name': 'api.webhook'}, 'spans': spans}]
+        }]
+    }
+
+def get_otlp_queue():
+    """取得 OTLP 匯出佇列（第一次使用時建立，並啟動唯一的匯出執行緒）"""
+    global OTLP_QUEUE
+    with OTLP_LOCK:
+        if OTLP_QUEUE is None:
+            import queue
+            OTLP_QUEUE = queue.Queue(maxsize=OTLP_QUEUE_SIZE)
+            threading.Thread(target=run_otlp_exporter, args=(OTLP_QUEUE,),
+                             name='otlp-exporter', daemon=True).start()
+        return OTLP_QUEUE
+
+def run_otlp_exporter(traces):
+    """依序把佇列中的追蹤送到 OTLP collector，失敗只印 log"""
+    while True:
+        trace = traces.get()
+        try:
+            get_http_session().post(f"{OTLP_ENDPOINT.rstrip('/')}/v1/traces",
+                                    json=build_otlp_payload(trace), timeout=2)
+            result = 'exported'
+        except Exception as e:
+            print(f"⚠️ OTLP 匯出失敗: {e}")
+            result = 'failed'
+        with OTLP_LOCK:
+            OTLP_STATS[result] += 1
+        traces.task_done()
+
+def export_trace_otlp(trace):
+    """把追蹤放進匯出佇列（不等待送出），佇列滿時丟棄並計數"""
+    from queue import Full
+    try:
+        get_otlp_queue().put_nowait(trace)
+    except Full:
+        with OTLP_LOCK:
+            OTLP_STATS['dropped'] += 1
 
-def search_stock_realtime(keyword):
+def read_sheet_records(sheet, deadline=None):
+    """讀取工作表所有紀錄（時間預算用完時不再發出請求）"""
+    if deadline and deadline.expired():
+        raise TimeoutError("時間預算已用完")
+    return sheet.get_all_records()
+
+def read_sheet_rows(sheet, start_row, deadline=None):
+    """讀取工作表從 start_row 開始到最後一列的原始值（A 到 O 欄）"""
+    if deadline and deadline.expired():
+        raise TimeoutError("時間預算已用完")
+    return [list(row) for row in sheet.get(f'A{start_row}:O')]
+
+def search_stock_realtime(keyword, deadline=None):
     """即時搜尋股票（從證交所API）"""
     try:
+        if deadline and deadline.expired():
+            print(f"⏰ 時間預算用完，略過搜尋股票: {keyword}")
+            return None, None, None
+        
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
@@ -95,7 +928,9 @@ def search_stock_realtime(keyword):
             url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp"
             params = {'ex_ch': f'tse_{keyword}.tw', 'json': '1', 'delay': '0'}
             
-            response = requests.get(url, params=params, headers=headers, timeout=5)
+            response = traced_request('twse.search', 'GET', url, {'symbol': keyword, 'market': 'tse'},
+                                      params=params, headers=headers,
+                                      timeout=upstream_timeout(deadline, 5))
             if response.status_code == 200:
                 data = response.json()
                 if 'msgArray' in data and len(data['msgArray']) > 0:
@@ -108,7 +943,9 @@ def search_stock_realtime(keyword):
             
             # 嘗試上櫃
             params['ex_ch'] = f'otc_{keyword}.tw'
-            response = requests.get(url, params=params, headers=headers, timeout=5)
+            response = traced_request('twse.search', 'GET', url, {'symbol': keyword, 'market': 'otc'},
+                                      params=params, headers=headers,
+                                      timeout=upstream_timeout(deadline, 5))
             if response.status_code == 200:
                 data = response.json()
                 if 'msgArray' in data and len(data['msgArray']) > 0:
@@ -149,13 +986,13 @@ def search_stock_realtime(keyword):
         if keyword in common_stocks:
             code = common_stocks[keyword]
             # 驗證並取得完整資訊
-            return search_stock_realtime(code)
+            return search_stock_realtime(code, deadline)
         
         # 部分匹配
         for name, code in common_stocks.items():
             if keyword in name or name in keyword:
                 print(f"部分匹配到: {name} -> {code}")
-                return search_stock_realtime(code)
+                return search_stock_realtime(code, deadline)
         
         print(f"找不到股票: {keyword}")
         return None, None, None
@@ -164,17 +1001,20 @@ def search_stock_realtime(keyword):
         print(f"搜尋股票錯誤: {e}")
         return None, None, None
 
-def get_stock_info(keyword):
+def get_stock_info(keyword, deadline=None):
     """取得股票資訊（代號、名稱、市場）"""
     # 檢查快取
     if keyword in STOCK_CACHE:
         cache_time = CACHE_TIME.get(keyword, 0)
         if time.time() - cache_time < CACHE_DURATION:
             print(f"使用快取: {keyword}")
+            record_cache_event('stock_info', 'hit')
             return STOCK_CACHE[keyword]
+        record_cache_event('stock_info', 'eviction')
+    record_cache_event('stock_info', 'miss')
     
     # 即時搜尋
-    code, name, market = search_stock_realtime(keyword)
+    code, name, market = search_stock_realtime(keyword, deadline)
     
     if code and name:
         # 加入快取
@@ -191,7 +1031,93 @@ def get_stock_info(keyword):
     
     return None
 
-def get_stock_price_yahoo(stock_code, market='tse'):
+def load_trading_calendar():
+    """讀取交易日曆；檔案不存在或格式錯誤時只排除週末"""
+    global TRADING_CALENDAR
+    if TRADING_CALENDAR is not None:
+        return TRADING_CALENDAR
+    
+    calendar = {'years': set(), 'warned': set(), 'holidays': {}, 'early_close': {}, 'extra_trading_days': {},
+                'session': {'pre_open': '08:30', 'open': '09:00', 'close': '13:30'}}
+    try:
+        with open(TRADING_CALENDAR_PATH, encoding='utf-8') as f:
+            data = json.load(f)
+        calendar['years'] = set(data.get('years', []))
+        for key in ('holidays', 'early_close', 'extra_trading_days', 'session'):
+            calendar[key].update(data.get(key, {}))
+    except (OSError, ValueError) as e:
+        print(f"⚠️ 交易日曆讀取失敗，只排除週末: {e}")
+    TRADING_CALENDAR = calendar
+    return calendar
+
+def taipei_now():
+    """台北時間（Serverless 主機通常是 UTC）"""
+    return datetime.now(TAIPEI_TZ)
+
+def local_now():
+    """台北時間（不帶時區），交易紀錄、投票、提醒等寫進工作表或互相比較的時間都用這個
+
+    Vercel 主機是 UTC，用 datetime.now() 的話台北 00:00～08:00 的紀錄會記成前一天。
+    """
+    return datetime.now(TAIPEI_TZ).replace(tzinfo=None)
+
+def is_trading_day(day):
+    """是否為交易日（day 為 date）；日曆沒涵蓋的年份只排除週末"""
+    calendar = load_trading_calendar()
+    key = day.strftime('%Y-%m-%d')
+    if key in calendar['extra_trading_days']:
+        return True
+    if key in calendar['holidays']:
+        return False
+    if calendar['years'] and day.year not in calendar['years'] and day.year not in calendar['warned']:
+        calendar['warned'].add(day.year)
+        print(f"⚠️ 交易日曆沒有 {day.year} 年的資料，只排除週末")
+    return day.weekday() < 5
+
+def get_session_times(day):
+    """交易日的 (試撮開始, 開盤, 收盤) 台北時間，半日交易時收盤提早"""
+    calendar = load_trading_calendar()
+    session = calendar['session']
+    close_text = calendar['early_close'].get(day.strftime('%Y-%m-%d'), session['close'])
+    
+    def at(text):
+        hour, minute = map(int, text.split(':'))
+        return datetime(day.year, day.month, day.day, hour, minute, tzinfo=TAIPEI_TZ)
+    
+    return at(session['pre_open']), at(session['open']), at(close_text)
+
+def get_market_session(now=None):
+    """目前時段：'open'（盤中）、'pre_open'（開盤前試撮）或 'closed'"""
+    now = now or taipei_now()
+    if not is_trading_day(now.date()):
+        return 'closed'
+    pre_open, market_open, market_close = get_session_times(now.date())
+    if market_open <= now < market_close:
+        return 'open'
+    if pre_open <= now < market_open:
+        return 'pre_open'
+    return 'closed'
+
+def get_last_close(now=None):
+    """最近一次收盤時間（不晚於 now）"""
+    now = now or taipei_now()
+    day = now.date()
+    for _ in range(30):
+        if is_trading_day(day):
+            market_close = get_session_times(day)[2]
+            if market_close <= now:
+                return market_close
+        day -= timedelta(days=1)
+    return now - timedelta(days=30)
+
+def quote_can_change(since, now=None):
+    """since（epoch 秒）之後報價是否可能變動：盤中，或 since 之後有過收盤"""
+    now = now or taipei_now()
+    if get_market_session(now) == 'open':
+        return True
+    return get_last_close(now).timestamp() > since
+
+def get_stock_price_yahoo(stock_code, market='tse', deadline=None):
     """使用 Yahoo Finance API 抓取股價"""
     try:
         # 根據市場決定後綴
@@ -204,12 +1130,16 @@ def get_stock_price_yahoo(stock_code, market='tse'):
             suffixes = [suffix]
         
         for suffix in suffixes:
+            if deadline and deadline.expired():
+                return None
+            
             url = f"https://query1.finance.yahoo.com/v8/finance/chart/{stock_code}{suffix}"
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
             }
             
-            response = requests.get(url, headers=headers, timeout=10)
+            response = traced_request('yahoo.quote', 'GET', url, {'symbol': f'{stock_code}{suffix}'},
+                                      headers=headers, timeout=upstream_timeout(deadline, 10))
             
             if response.status_code == 200:
                 data = response.json()
@@ -226,9 +1156,12 @@ def get_stock_price_yahoo(stock_code, market='tse'):
         print(f"Yahoo Finance 錯誤 {stock_code}: {e}")
         return None
 
-def get_stock_price_twse(stock_code, market='tse'):
-    """使用 TWSE/TPEx API 抓取股價"""
+def get_stock_price_twse(stock_code, market='tse', deadline=None):
+    """使用 TWSE/TPEx API 抓取股價，回傳 (價格, 是否為昨收)；今天還沒有成交時 z 是 '-'，改用昨收 y"""
     try:
+        if deadline and deadline.expired():
+            return None, False
+        
         url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp"
         
         # 根據市場決定前綴
@@ -248,7 +1181,9 @@ def get_stock_price_twse(stock_code, market='tse'):
             'Referer': 'https://mis.twse.com.tw/'
         }
         
-        response = requests.get(url, params=params, headers=headers, timeout=10)
+        response = traced_request('twse.quote', 'GET', url, {'symbol': stock_code, 'market': market},
+                                  params=params, headers=headers,
+                                  timeout=upstream_timeout(deadline, 10))
         
         if response.status_code == 200:
             data = response.json()
@@ -256,58 +1191,386 @@ def get_stock_price_twse(stock_code, market='tse'):
                 stock_data = data['msgArray'][0]
                 if 'z' in stock_data and stock_data['z'] != '-':
                     print(f"✅ TWSE API 成功 ({market}): {stock_data['z']}")
-                    return float(stock_data['z'])
+                    return float(stock_data['z']), False
                 elif 'y' in stock_data and stock_data['y'] != '-':
                     print(f"✅ TWSE API 成功 ({market}昨收): {stock_data['y']}")
-                    return float(stock_data['y'])
+                    return float(stock_data['y']), True
         
         # 如果失敗，嘗試另一個市場
         if market == 'tse':
-            return get_stock_price_twse(stock_code, 'otc')
+            return get_stock_price_twse(stock_code, 'otc', deadline)
         
-        return None
+        return None, False
     except Exception as e:
         print(f"TWSE/TPEx API 錯誤 {stock_code}: {e}")
-        return None
+        return None, False
+
+def get_cached_price(stock_code, max_age=QUOTE_CACHE_DURATION):
+    """從報價快取取價格，超過 max_age 秒視為沒有（max_age=None 表示不限）
+
+    收盤後取得的報價在下次開盤前都不會變，不受 max_age 限制。
+    """
+    cached = QUOTE_CACHE.get(stock_code)
+    if not cached:
+        return 0
+    if max_age is not None and time.time() - cached['time'] >= max_age and quote_can_change(cached['time']):
+        return 0
+    return cached['price']
+
+def is_previous_close_quote(stock_code):
+    """快取中的報價是否為昨收（盤中今天還沒有成交）"""
+    cached = QUOTE_CACHE.get(stock_code)
+    return bool(cached and cached.get('previous_close') and get_market_session() == 'open')
 
-def get_stock_price(stock_code, stock_name=None, market=None):
-    """取得股票價格（整合版）"""
+def get_stock_price(stock_code, stock_name=None, market=None, deadline=None, optional=False):
+    """取得股票價格（整合版）
+
+    optional=True 表示股價只是附加資訊（例如持股列表），時間預算快用完時
+    只使用報價快取（可能是較舊的價格）
+    """
     if not stock_code:
         return 0
     
+    price = get_cached_price(stock_code)
+    if price > 0:
+        record_cache_event('quote', 'hit')
+        return price
+    record_cache_event('quote', 'miss')
+    if stock_code in QUOTE_CACHE:
+        record_cache_event('quote', 'eviction')
+    
+    if optional and deadline and deadline.running_low():
+        print(f"⏰ 略過即時股價：{stock_code}")
+        return get_cached_price(stock_code, max_age=None)
+    
     print(f"📊 開始抓取股價：{stock_code} {stock_name if stock_name else ''} ({market if market else '未知市場'})")
     
     # 策略1: Yahoo Finance
-    price = get_stock_price_yahoo(stock_code, market if market else 'tse')
-    if price and price > 0:
-        return price
+    price = get_stock_price_yahoo(stock_code, market if market else 'tse', deadline)
+    previous_close = False
     
     # 策略2: TWSE/TPEx API
-    time.sleep(0.5)
-    price = get_stock_price_twse(stock_code, market if market else 'tse')
+    if not (price and price > 0):
+        price, previous_close = get_stock_price_twse(stock_code, market if market else 'tse', deadline)
+    
     if price and price > 0:
+        QUOTE_CACHE[stock_code] = {'price': price, 'time': time.time(), 'previous_close': previous_close}
+        update_leaderboard_price(stock_code, price)
         return price
     
     print(f"❌ 無法取得股價: {stock_code}")
-    return 0
+    return get_cached_price(stock_code, max_age=None)
+
+# 預先編譯的指令語法
+SHARES_ZHANG_PATTERN = re.compile(r'(\d+(?:\.\d+)?)張')
+SHARES_GU_PATTERN = re.compile(r'(\d+)股')
+NUMBER_PATTERN = re.compile(r'(\d+(?:\.\d+)?)')
+# 數量 價格 配對，例如「2張 580元」
+TRADE_PAIR_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元')
+BUY_WITH_REASON_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元\s+(.*)$')
+TRADE_NO_NOTE_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元\s*$')
+SELL_WITH_NOTE_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元\s*(.*)$')
+# 匯入的每一行：[日期 [時間]] [買入|賣出] 股票 數量 價格 [理由]（價格的「元」可省略，方便從試算表貼上）
+IMPORT_LINE_PATTERN = re.compile(
+    r'^(?:(\d{4}-\d{2}-\d{2})(?:\s+(\d{1,2}:\d{2}(?::\d{2})?))?\s+)?(?:(買入|賣出)\s+)?'
+    r'(\S+)\s+(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元?(?:\s+(.*))?$'
+)
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', '200'))
+# 多行指令：每行一個指令，一次處理後合併回覆
+BATCH_MAX_COMMANDS = int(os.environ.get('BATCH_MAX_COMMANDS', '20'))
+BATCH_LOCAL = threading.local()
+
+class DailyBars:
+    """單一股票的日線（OHLCV），每個欄位一個 array，依日期（YYYYMMDD 整數）排序"""
+    
+    def __init__(self, market=None):
+        self.market = market
+        for field, typecode in OHLC_FIELDS:
+            setattr(self, field, array(typecode))
+    
+    def __len__(self):
+        return len(self.dates)
+    
+    def merge(self, bars):
+        """合併新抓到的日線，同一天的會覆蓋（收盤前抓到的資料之後會被更新），回傳新增根數"""
+        added = 0
+        for bar in bars:
+            date = bar[0]
+            if not self.dates or date > self.dates[-1]:
+                for (field, _), value in zip(OHLC_FIELDS, bar):
+                    getattr(self, field).append(value)
+                added += 1
+                continue
+            
+            index = bisect_left(self.dates, date)
+            if self.dates[index] == date:
+                for (field, _), value in zip(OHLC_FIELDS, bar):
+                    getattr(self, field)[index] = value
+            else:
+                for (field, _), value in zip(OHLC_FIELDS, bar):
+                    getattr(self, field).insert(index, value)
+                added += 1
+        return added
+    
+    def last(self, count):
+        """最後 count 根的 (起, 迄) 索引"""
+        return max(0, len(self.dates) - count), len(self.dates)
+    
+    def between(self, start, end):
+        """日期區間 [start, end] 的 (起, 迄) 索引"""
+        return bisect_left(self.dates, start), bisect_right(self.dates, end)
+    
+    def save(self, path):
+        """依欄位寫成二進位檔：標頭（版本、根數、市場）後接各欄位的原始陣列"""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as f:
+            array('i', [OHLC_FILE_VERSION, len(self.dates), OHLC_MARKETS.index(self.market)]).tofile(f)
+            for field, _ in OHLC_FIELDS:
+                getattr(self, field).tofile(f)
+        os.replace(temp_path, path)
+    
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            header = array('i')
+            header.fromfile(f, 3)
+            version, count, market_index = header
+            if version != OHLC_FILE_VERSION:
+                raise ValueError(f"日線檔版本不符: {version}")
+            bars = cls(OHLC_MARKETS[market_index])
+            for field, _ in OHLC_FIELDS:
+                getattr(bars, field).fromfile(f, count)
+        return bars
+
+def get_ohlc_path(stock_code):
+    return os.path.join(OHLC_DIR, f"{stock_code}.bin")
+
+def get_daily_bars(stock_code):
+    """從記憶體或本機檔案取日線（不連網），沒有資料時回傳 None"""
+    with OHLC_LOCK:
+        bars = OHLC_STORE.get(stock_code)
+        if bars is not None:
+            return bars
+        
+        try:
+            bars = DailyBars.load(get_ohlc_path(stock_code))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError) as e:
+            print(f"⚠️ 日線檔讀取失敗 {stock_code}: {e}")
+            return None
+        
+        OHLC_STORE[stock_code] = bars
+        return bars
+
+def save_daily_bars(stock_code, bars):
+    """存到記憶體與本機檔案"""
+    with OHLC_LOCK:
+        OHLC_STORE[stock_code] = bars
+        try:
+            os.makedirs(OHLC_DIR, exist_ok=True)
+            bars.save(get_ohlc_path(stock_code))
+        except OSError as e:
+            print(f"⚠️ 日線檔存檔失敗 {stock_code}: {e}")
+
+def list_tracked_symbols():
+    """已有日線檔（含等待第一次更新）的股票代號"""
+    try:
+        return sorted(name[:-4] for name in os.listdir(OHLC_DIR) if name.endswith('.bin'))
+    except FileNotFoundError:
+        return []
+
+def track_symbol(stock_code):
+    """先建立空的日線檔，下一次排程更新時就會抓取歷史資料"""
+    if get_daily_bars(stock_code) is None:
+        save_daily_bars(stock_code, DailyBars())
+
+def get_ohlc_names():
+    """代號 → 名稱的對照（排程更新時寫入，讓 /走勢 可以用名稱查詢）"""
+    global OHLC_NAMES
+    with OHLC_LOCK:
+        if OHLC_NAMES is None:
+            try:
+                with open(os.path.join(OHLC_DIR, 'names.json'), encoding='utf-8') as f:
+                    OHLC_NAMES = json.load(f)
+            except (OSError, ValueError):
+                OHLC_NAMES = {}
+        return OHLC_NAMES
+
+def save_ohlc_names(names):
+    with OHLC_LOCK:
+        get_ohlc_names().update(names)
+        try:
+            os.makedirs(OHLC_DIR, exist_ok=True)
+            with open(os.path.join(OHLC_DIR, 'names.json'), 'w', encoding='utf-8') as f:
+                json.dump(OHLC_NAMES, f, ensure_ascii=False)
+        except OSError as e:
+            print(f"⚠️ 股票名稱對照存檔失敗: {e}")
+
+def fetch_yahoo_daily_bars(stock_code, market=None, since=None, deadline=None):
+    """從 Yahoo chart API 抓日線；since（YYYYMMDD）有值時只抓該日之後，回傳 (bars, market)"""
+    if market in ('tse', 'otc'):
+        candidates = [market]
+    else:
+        candidates = ['tse', 'otc']
+    
+    params = {'interval': '1d'}
+    if since:
+        params['period1'] = int(datetime.strptime(str(since), '%Y%m%d').replace(tzinfo=timezone.utc).timestamp())
+        params['period2'] = int(time.time())
+    else:
+        params['range'] = OHLC_INITIAL_RANGE
+    
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    }
+    
+    for candidate in candidates:
+        if deadline and deadline.expired():
+            break
+        
+        suffix = '.TW' if candidate == 'tse' else '.TWO'
+        url = f"https://query1.finance.yahoo.com/v8/finance/chart/{stock_code}{suffix}"
+        response = traced_request('yahoo.history', 'GET', url, {'symbol': f'{stock_code}{suffix}'},
+                                  params=params, headers=headers, timeout=upstream_timeout(deadline, 10))
+        if response.status_code != 200:
+            continue
+        
+        results = (response.json().get('chart') or {}).get('result')
+        if not results:
+            continue
+        
+        result = results[0]
+        timestamps = result.get('timestamp') or []
+        quote = ((result.get('indicators') or {}).get('quote') or [{}])[0]
+        # 換成台北時間的日期
+        offset = result.get('meta', {}).get('gmtoffset', 8 * 3600)
+        
+        bars = []
+        for i, timestamp in enumerate(timestamps):
+            close = quote.get('close', [None] * len(timestamps))[i]
+            if close is None:
+                continue
+            date = int(datetime.fromtimestamp(timestamp + offset, timezone.utc).strftime('%Y%m%d'))
+            open_price = quote.get('open', [None] * len(timestamps))[i]
+            high = quote.get('high', [None] * len(timestamps))[i]
+            low = quote.get('low', [None] * len(timestamps))[i]
+            volume = quote.get('volume', [None] * len(timestamps))[i]
+            bars.append((
+                date,
+                float(open_price if open_price is not None else close),
+                float(high if high is not None else close),
+                float(low if low is not None else close),
+                float(close),
+                int(volume or 0)
+            ))
+        return bars, candidate
+    
+    return None, market
+
+def update_daily_bars(stock_code, market=None, deadline=None):
+    """增量更新：只抓最後一根（含）之後的日線，回傳新增根數，失敗回傳 None"""
+    try:
+        bars = get_daily_bars(stock_code) or DailyBars()
+        since = bars.dates[-1] if len(bars) else None
+        fetched, found_market = fetch_yahoo_daily_bars(stock_code, bars.market or market, since, deadline)
+        if fetched is None:
+            return None
+        
+        if bars.market is None:
+            bars.market = found_market
+        added = bars.merge(fetched)
+        save_daily_bars(stock_code, bars)
+        return added
+    except Exception as e:
+        print(f"⚠️ 日線更新失敗 {stock_code}: {e}")
+        return None
+
+def render_sparkline(values, width=OHLC_SPARKLINE_WIDTH):
+    """用方塊字元畫走勢（超過寬度時每段取最後一個收盤價）"""
+    if len(values) > width:
+        step = len(values) / width
+        values = [values[min(len(values) - 1, int((i + 1) * step) - 1)] for i in range(width)]
+    low, high = min(values), max(values)
+    span = high - low
+    if span <= 0:
+        return SPARK_CHARS[len(SPARK_CHARS) // 2] * len(values)
+    return ''.join(SPARK_CHARS[int((value - low) / span * (len(SPARK_CHARS) - 1))] for value in values)
+
+def format_ohlc_date(date):
+    return f"{date // 10000}-{date // 100 % 100:02d}-{date % 100:02d}"
+
+def get_price_trend(stock_input, days):
+    """/走勢：只用本機日線資料回覆，不連網"""
+    # 名稱只用快取或本機的名稱對照換成代號
+    names = get_ohlc_names()
+    cached = STOCK_CACHE.get(stock_input)
+    if cached:
+        stock_code = cached['code']
+    elif OHLC_SYMBOL_PATTERN.match(stock_input):
+        stock_code = stock_input
+    else:
+        stock_code = next((code for code, name in names.items() if name == stock_input), None)
+        if not stock_code:
+            return f"❌ 找不到 {stock_input} 的歷史資料，請用股票代號查詢，例如：/走勢 2330 {days}"
+    stock_name = cached['name'] if cached else names.get(stock_code)
+    
+    bars = get_daily_bars(stock_code)
+    if bars is None or not len(bars):
+        track_symbol(stock_code)
+        return f"📭 還沒有 {stock_input} 的歷史資料\n\n✅ 已加入追蹤，下次收盤後更新就能查詢"
+    
+    start, end = bars.last(days)
+    closes = bars.close[start:end].tolist()
+    highs = bars.high[start:end]
+    lows = bars.low[start:end]
+    volumes = bars.volume[start:end]
+    
+    first_close = closes[0]
+    last_close = closes[-1]
+    change = last_close - first_close
+    change_pct = (change / first_close * 100) if first_close > 0 else 0
+    high_index = max(range(len(highs)), key=highs.__getitem__)
+    low_index = min(range(len(lows)), key=lows.__getitem__)
+    
+    if change > 0:
+        trend = "📈"
+    elif change < 0:
+        trend = "📉"
+    else:
+        trend = "➡️"
+    
+    title = f"{stock_name} ({stock_code})" if stock_name else stock_code
+    response = f"{trend} {title} 近 {len(closes)} 個交易日\n"
+    response += f"{'='*25}\n"
+    response += f"📅 {format_ohlc_date(bars.dates[start])} ~ {format_ohlc_date(bars.dates[end - 1])}\n"
+    response += f"• 收盤：{last_close:,.2f}元（{change:+,.2f}，{change_pct:+.2f}%）\n"
+    response += f"• 最高：{highs[high_index]:,.2f}元（{format_ohlc_date(bars.dates[start + high_index])}）\n"
+    response += f"• 最低：{lows[low_index]:,.2f}元（{format_ohlc_date(bars.dates[start + low_index])}）\n"
+    response += f"• 平均成交量：{sum(volumes) / len(volumes) / 1000:,.0f}張\n"
+    response += f"\n{render_sparkline(closes)}"
+    
+    if len(closes) < days:
+        response += f"\n\n💡 目前只有 {len(closes)} 個交易日的資料"
+    return response
 
 def parse_shares(shares_text):
     """解析股數，支援張和股"""
     shares_text = shares_text.strip()
     
     if '張' in shares_text:
-        match = re.search(r'(\d+(?:\.\d+)?)張', shares_text)
+        match = SHARES_ZHANG_PATTERN.search(shares_text)
         if match:
             zhang = float(match.group(1))
             return int(zhang * 1000)
     
     if '股' in shares_text:
-        match = re.search(r'(\d+)股', shares_text)
+        match = SHARES_GU_PATTERN.search(shares_text)
         if match:
             return int(match.group(1))
     
     # 只有數字
-    match = re.search(r'(\d+(?:\.\d+)?)', shares_text)
+    match = NUMBER_PATTERN.search(shares_text)
     if match:
         num = float(match.group(1))
         if num >= 1000:
@@ -329,77 +1592,72 @@ def format_shares(shares):
     else:
         return f"{shares}股"
 
-def parse_buy_command(text):
+def quantity_to_shares(quantity, unit):
+    """換算股數：有單位照單位，只寫數字時小於1000視為張"""
+    if unit == '股':
+        return int(quantity)
+    if unit == '張':
+        return int(quantity * 1000)
+    if quantity >= 1000:
+        return int(quantity)
+    return int(quantity * 1000)
+
+def split_trade_command(text):
+    """拆出「股票」與「數量 價格 ...」兩部分"""
+    # 移除開頭的 /買入、/賣出
+    parts = text[3:].strip().split(maxsplit=1)
+    if len(parts) < 2:
+        return None
+    return parts[0], parts[1]
+
+def parse_batch_trades(remaining):
+    """批次模式：找到2組以上「數量 價格」配對時回傳 (明細, 總股數, 總金額, 最後配對結尾位置)"""
+    matches = list(TRADE_PAIR_PATTERN.finditer(remaining))
+    if len(matches) < 2:
+        return None
+    
+    transactions = []
+    total_shares = 0
+    total_amount = 0
+    
+    for match in matches:
+        shares = quantity_to_shares(float(match.group(1)), match.group(2) or '')
+        price = float(match.group(3))
+        amount = shares * price
+        total_shares += shares
+        total_amount += amount
+        
+        transactions.append({
+            'shares': shares,
+            'price': price,
+            'amount': amount
+        })
+    
+    return transactions, total_shares, total_amount, matches[-1].end()
+
+def resolve_trade_stock(stock_input, deadline=None):
+    """語法檢查通過後才查詢股票資訊，查不到時保留使用者輸入的名稱"""
+    stock_info = get_stock_info(stock_input, deadline)
+    if stock_info:
+        return stock_info['code'], stock_info['name']
+    return '', stock_input
+
+def parse_buy_command(text, deadline=None):
     """解析買入指令"""
     try:
-        # 移除開頭的 /買入
-        text = text[3:].strip()
-        
-        # 分離股票名稱
-        parts = text.split(maxsplit=1)
-        if len(parts) < 2:
+        parts = split_trade_command(text)
+        if not parts:
             return None
         
-        stock_input = parts[0]
-        remaining = parts[1]
-        
-        # 取得股票資訊
-        stock_info = get_stock_info(stock_input)
-        if stock_info:
-            stock_code = stock_info['code']
-            stock_name = stock_info['name']
-        else:
-            stock_code = ''
-            stock_name = stock_input
+        stock_input, remaining = parts
         
         # 先嘗試批次模式：數量 價格 的配對（可能有多個）
-        batch_pattern = r'(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元'
-        matches = re.findall(batch_pattern, remaining)
-        
-        # 如果找到2個或以上匹配，視為批次交易
-        if len(matches) >= 2:
-            # 找出理由（在最後一個價格之後的文字）
-            last_match = matches[-1]
-            last_pattern = f"{last_match[0]}\\s*{last_match[1] if last_match[1] else ''}\\s+{last_match[2]}\\s*元"
-            
-            last_match_obj = None
-            for match_obj in re.finditer(last_pattern, remaining):
-                last_match_obj = match_obj
-            
-            if last_match_obj:
-                reason_start = last_match_obj.end()
-                reason = remaining[reason_start:].strip() if reason_start < len(remaining) else "批次買入"
-            else:
-                reason = "批次買入"
-            
-            transactions = []
-            total_shares = 0
-            total_amount = 0
-            
-            for match in matches:
-                quantity = float(match[0])
-                unit = match[1] if match[1] else ''
-                price = float(match[2])
-                
-                if unit == '股':
-                    shares = int(quantity)
-                elif unit == '張':
-                    shares = int(quantity * 1000)
-                else:
-                    if quantity >= 1000:
-                        shares = int(quantity)
-                    else:
-                        shares = int(quantity * 1000)
-                
-                amount = shares * price
-                total_shares += shares
-                total_amount += amount
-                
-                transactions.append({
-                    'shares': shares,
-                    'price': price,
-                    'amount': amount
-                })
+        batch = parse_batch_trades(remaining)
+        if batch:
+            transactions, total_shares, total_amount, reason_start = batch
+            # 理由是最後一個價格之後的文字
+            reason = remaining[reason_start:].strip() if reason_start < len(remaining) else "批次買入"
+            stock_code, stock_name = resolve_trade_stock(stock_input, deadline)
             
             return {
                 'stock_code': stock_code,
@@ -412,67 +1670,29 @@ def parse_buy_command(text):
                 'is_batch': True
             }
         
-        # 單一價格格式：嘗試多種解析方式
         # 格式1: 1張 1200元 理由
-        pattern1 = r'^(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元\s+(.*)$'
-        match1 = re.match(pattern1, remaining)
-        
-        if match1:
-            quantity = float(match1.group(1))
-            unit = match1.group(2) if match1.group(2) else ''
-            price = float(match1.group(3))
-            reason = match1.group(4).strip() if match1.group(4) else '無理由'
-            
-            # 計算股數
-            if unit == '股':
-                shares = int(quantity)
-            elif unit == '張':
-                shares = int(quantity * 1000)
-            else:
-                # 沒有單位時，小於1000視為張
-                if quantity < 1000:
-                    shares = int(quantity * 1000)
-                else:
-                    shares = int(quantity)
-            
-            return {
-                'stock_code': stock_code,
-                'stock_name': stock_name,
-                'shares': shares,
-                'price': price,
-                'reason': reason,
-                'is_batch': False
-            }
-        
-        # 格式2: 5張 580元 (沒有理由)
-        pattern2 = r'^(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元\s*$'
-        match2 = re.match(pattern2, remaining)
-        
-        if match2:
-            quantity = float(match2.group(1))
-            unit = match2.group(2) if match2.group(2) else ''
-            price = float(match2.group(3))
-            
-            if unit == '股':
-                shares = int(quantity)
-            elif unit == '張':
-                shares = int(quantity * 1000)
-            else:
-                if quantity < 1000:
-                    shares = int(quantity * 1000)
-                else:
-                    shares = int(quantity)
-            
-            return {
-                'stock_code': stock_code,
-                'stock_name': stock_name,
-                'shares': shares,
-                'price': price,
-                'reason': '無特定理由',
-                'is_batch': False
-            }
-        
-        return None
+        match = BUY_WITH_REASON_PATTERN.match(remaining)
+        if match:
+            reason = match.group(4).strip() if match.group(4) else '無理由'
+        else:
+            # 格式2: 5張 580元 (沒有理由)
+            match = TRADE_NO_NOTE_PATTERN.match(remaining)
+            if not match:
+                return None
+            reason = '無特定理由'
+        
+        shares = quantity_to_shares(float(match.group(1)), match.group(2) or '')
+        price = float(match.group(3))
+        stock_code, stock_name = resolve_trade_stock(stock_input, deadline)
+        
+        return {
+            'stock_code': stock_code,
+            'stock_name': stock_name,
+            'shares': shares,
+            'price': price,
+            'reason': reason,
+            'is_batch': False
+        }
         
     except Exception as e:
         print(f"解析買入錯誤: {e}")
@@ -480,75 +1700,22 @@ def parse_buy_command(text):
         print(traceback.format_exc())
         return None
 
-def parse_sell_command(text):
+def parse_sell_command(text, deadline=None):
     """解析賣出指令"""
     try:
-        text = text[3:].strip()
-        parts = text.split(maxsplit=1)
-        
-        if len(parts) < 2:
+        parts = split_trade_command(text)
+        if not parts:
             return None
         
-        stock_input = parts[0]
-        remaining = parts[1]
-        
-        # 取得股票資訊
-        stock_info = get_stock_info(stock_input)
-        if stock_info:
-            stock_code = stock_info['code']
-            stock_name = stock_info['name']
-        else:
-            stock_code = ''
-            stock_name = stock_input
+        stock_input, remaining = parts
         
         # 先嘗試批次模式：數量 價格 的配對（可能有多個）
-        batch_pattern = r'(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元'
-        matches = re.findall(batch_pattern, remaining)
-        
-        # 如果找到2個或以上匹配，視為批次交易
-        if len(matches) >= 2:
-            # 找備註
-            last_match = matches[-1]
-            last_pattern = f"{last_match[0]}\\s*{last_match[1] if last_match[1] else ''}\\s+{last_match[2]}\\s*元"
-            
-            last_match_obj = None
-            for match_obj in re.finditer(last_pattern, remaining):
-                last_match_obj = match_obj
-            
-            if last_match_obj:
-                note_start = last_match_obj.end()
-                note = remaining[note_start:].strip() if note_start < len(remaining) else ""
-            else:
-                note = ""
-            
-            transactions = []
-            total_shares = 0
-            total_amount = 0
-            
-            for match in matches:
-                quantity = float(match[0])
-                unit = match[1] if match[1] else ''
-                price = float(match[2])
-                
-                if unit == '股':
-                    shares = int(quantity)
-                elif unit == '張':
-                    shares = int(quantity * 1000)
-                else:
-                    if quantity >= 1000:
-                        shares = int(quantity)
-                    else:
-                        shares = int(quantity * 1000)
-                
-                amount = shares * price
-                total_shares += shares
-                total_amount += amount
-                
-                transactions.append({
-                    'shares': shares,
-                    'price': price,
-                    'amount': amount
-                })
+        batch = parse_batch_trades(remaining)
+        if batch:
+            transactions, total_shares, total_amount, note_start = batch
+            note = remaining[note_start:].strip() if note_start < len(remaining) else ""
+            stock_code, stock_name = resolve_trade_stock(stock_input, deadline)
+            avg_price = total_amount / total_shares if total_shares > 0 else 0
             
             return {
                 'stock_code': stock_code,
@@ -556,77 +1723,32 @@ def parse_sell_command(text):
                 'transactions': transactions,
                 'total_shares': total_shares,
                 'total_amount': total_amount,
-                'avg_price': total_amount / total_shares if total_shares > 0 else 0,
-                'price': total_amount / total_shares if total_shares > 0 else 0,  # 相容性
+                'avg_price': avg_price,
+                'price': avg_price,  # 相容性
                 'note': note,
                 'is_batch': True
             }
         
-        # 單一價格格式：嘗試多種解析方式
-        # 格式1: 500股 1150元 停損
-        pattern1 = r'^(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元\s*(.*)$'
-        match1 = re.match(pattern1, remaining)
-        
-        if match1:
-            quantity = float(match1.group(1))
-            unit = match1.group(2) if match1.group(2) else ''
-            price = float(match1.group(3))
-            note = match1.group(4).strip() if match1.group(4) else ''
-            
-            # 計算股數
-            if unit == '股':
-                shares = int(quantity)
-            elif unit == '張':
-                shares = int(quantity * 1000)
-            else:
-                # 沒有單位時，小於1000視為張
-                if quantity < 1000:
-                    shares = int(quantity * 1000)
-                else:
-                    shares = int(quantity)
-            
-            return {
-                'stock_code': stock_code,
-                'stock_name': stock_name,
-                'shares': shares,
-                'price': price,
-                'note': note,
-                'is_batch': False,
-                'total_shares': shares,
-                'avg_price': price
-            }
-        
-        # 格式2: 2張 600元 (沒有備註)
-        pattern2 = r'^(\d+(?:\.\d+)?)\s*(張|股)?\s+(\d+(?:\.\d+)?)\s*元\s*$'
-        match2 = re.match(pattern2, remaining)
-        
-        if match2:
-            quantity = float(match2.group(1))
-            unit = match2.group(2) if match2.group(2) else ''
-            price = float(match2.group(3))
-            
-            if unit == '股':
-                shares = int(quantity)
-            elif unit == '張':
-                shares = int(quantity * 1000)
-            else:
-                if quantity < 1000:
-                    shares = int(quantity * 1000)
-                else:
-                    shares = int(quantity)
-            
-            return {
-                'stock_code': stock_code,
-                'stock_name': stock_name,
-                'shares': shares,
-                'price': price,
-                'note': '',
-                'is_batch': False,
-                'total_shares': shares,
-                'avg_price': price
-            }
+        # 格式: 500股 1150元 停損 / 2張 600元 (沒有備註)
+        match = SELL_WITH_NOTE_PATTERN.match(remaining)
+        if not match:
+            return None
         
-        return None
+        shares = quantity_to_shares(float(match.group(1)), match.group(2) or '')
+        price = float(match.group(3))
+        note = match.group(4).strip() if match.group(4) else ''
+        stock_code, stock_name = resolve_trade_stock(stock_input, deadline)
+        
+        return {
+            'stock_code': stock_code,
+            'stock_name': stock_name,
+            'shares': shares,
+            'price': price,
+            'note': note,
+            'is_batch': False,
+            'total_shares': shares,
+            'avg_price': price
+        }
         
     except Exception as e:
         print(f"解析賣出錯誤: {e}")
@@ -662,12 +1784,13 @@ def handle_buy_stock(user_id, user_name, group_id, buy_data):
         
         total_amount = shares * price
         record_id = str(int(datetime.now().timestamp()))
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        current_time = local_now().strftime('%Y-%m-%d %H:%M:%S')
         
         # 嘗試記錄到 Google Sheets
         sheets_success = False
         if transaction_sheet:
             try:
+                sheet = get_group_sheet('transactions', group_id, create=True)
                 row_data = [
                     current_time,
                     str(user_id),
@@ -685,7 +1808,7 @@ def handle_buy_stock(user_id, user_name, group_id, buy_data):
                     '已執行',
                     ''
                 ]
-                transaction_sheet.append_row(row_data)
+                append_sheet_row(sheet, row_data)
                 sheets_success = True
                 print(f"✅ 交易已記錄到 Google Sheets")
             except Exception as e:
@@ -743,7 +1866,7 @@ def handle_buy_stock(user_id, user_name, group_id, buy_data):
 def handle_batch_buy_stock(user_id, user_name, group_id, buy_data):
     """處理批次買入（不同價格）"""
     try:
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        current_time = local_now().strftime('%Y-%m-%d %H:%M:%S')
         transaction_details = []
         
         # 記錄每筆交易
@@ -752,6 +1875,7 @@ def handle_batch_buy_stock(user_id, user_name, group_id, buy_data):
             
             if transaction_sheet:
                 try:
+                    sheet = get_group_sheet('transactions', group_id, create=True)
                     row_data = [
                         current_time,
                         str(user_id),
@@ -769,7 +1893,7 @@ def handle_batch_buy_stock(user_id, user_name, group_id, buy_data):
                         '已執行',
                         f"批次交易第{i}筆"
                     ]
-                    transaction_sheet.append_row(row_data)
+                    append_sheet_row(sheet, row_data)
                 except Exception as e:
                     print(f"批次 {i} 記錄失敗: {e}")
             
@@ -819,9 +1943,13 @@ def update_holdings(user_id, user_name, group_id, stock_code, stock_name, shares
             print("⚠️ holdings_sheet 不存在")
             return False
         
+        # 分片模式下第一次買入時才建立群組的分片；賣出時沒有分片就是沒有持股
+        sheet = get_group_sheet('holdings', group_id, create=(action == 'buy'))
+        forget_batch_records()
+        
         # 安全地取得記錄
         try:
-            records = holdings_sheet.get_all_records()
+            records = read_sheet_records(sheet) if sheet else []
         except Exception as e:
             print(f"無法讀取持股記錄: {e}")
             records = []
@@ -854,7 +1982,7 @@ def update_holdings(user_id, user_name, group_id, stock_code, stock_name, shares
                 print(f"比對第 {i} 行時發生錯誤: {e}")
                 continue
         
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        current_time = local_now().strftime('%Y-%m-%d %H:%M:%S')
         
         if action == 'buy':
             try:
@@ -867,9 +1995,12 @@ def update_holdings(user_id, user_name, group_id, stock_code, stock_name, shares
                     new_total_cost = old_cost + (shares * price)
                     new_avg_cost = new_total_cost / new_shares if new_shares > 0 else 0
                     
-                    holdings_sheet.update(f'E{row_index}:G{row_index}', 
-                                        [[int(new_shares), round(new_avg_cost, 2), round(new_total_cost, 2)]])
-                    holdings_sheet.update(f'I{row_index}', [[current_time]])
+                    sheet.update(f'E{row_index}:G{row_index}', 
+                                 [[int(new_shares), round(new_avg_cost, 2), round(new_total_cost, 2)]])
+                    sheet.update(f'I{row_index}', [[current_time]])
+                    bump_reply_version('holdings', group_id)
+                    update_leaderboard_position(user_id, user_name, group_id, stock_code, stock_name,
+                                                new_shares, new_total_cost)
                     print(f"✅ 買入更新成功：{old_shares} + {shares} = {new_shares} 股")
                 else:
                     # 新增持股記錄
@@ -885,7 +2016,10 @@ def update_holdings(user_id, user_name, group_id, stock_code, stock_name, shares
                         current_time,
                         ''
                     ]
-                    holdings_sheet.append_row(new_row)
+                    sheet.append_row(new_row)
+                    bump_reply_version('holdings', group_id)
+                    update_leaderboard_position(user_id, user_name, group_id, stock_code, stock_name,
+                                                shares, shares * price)
                     print(f"✅ 新增持股記錄：{stock_name} {shares} 股")
                 
                 return True
@@ -919,14 +2053,19 @@ def update_holdings(user_id, user_name, group_id, stock_code, stock_name, shares
                     new_total_cost = new_shares * avg_cost
                     print(f"更新持股：剩餘 {new_shares} 股")
                     
-                    holdings_sheet.update(f'E{row_index}:G{row_index}', 
-                                        [[int(new_shares), round(avg_cost, 2), round(new_total_cost, 2)]])
-                    holdings_sheet.update(f'I{row_index}', [[current_time]])
+                    sheet.update(f'E{row_index}:G{row_index}', 
+                                 [[int(new_shares), round(avg_cost, 2), round(new_total_cost, 2)]])
+                    sheet.update(f'I{row_index}', [[current_time]])
+                    bump_reply_version('holdings', group_id)
+                    update_leaderboard_position(user_id, user_name, group_id, stock_code, stock_name,
+                                                new_shares, new_total_cost)
                     print(f"✅ 賣出更新成功：{old_shares} - {shares} = {new_shares} 股")
                 else:
                     # 賣完了，刪除整筆記錄
                     print(f"全部賣出，刪除第 {row_index} 行")
-                    holdings_sheet.delete_rows(row_index)
+                    sheet.delete_rows(row_index)
+                    bump_reply_version('holdings', group_id)
+                    update_leaderboard_position(user_id, user_name, group_id, stock_code, stock_name, 0, 0)
                     print(f"✅ 持股記錄已刪除（全部賣出）")
                 
                 return True
@@ -945,32 +2084,426 @@ def update_holdings(user_id, user_name, group_id, stock_code, stock_name, shares
         print(traceback.format_exc())
         return False
 
-def get_user_holdings(user_id, group_id, specific_stock=None):
-    """查詢使用者持股（支援查看他人）"""
+def parse_import_lines(lines):
+    """解析匯入的每一行，回傳 (交易列表, 錯誤列表)；股票先不查詢，之後一次解析"""
+    trades = []
+    errors = []
+    now = local_now()
+    for line_no, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        match = IMPORT_LINE_PATTERN.match(line)
+        if not match:
+            errors.append(f"第 {line_no} 行：格式無法辨識「{line}」")
+            continue
+        
+        date_text, time_text, action, stock_input, quantity, unit, price, reason = match.groups()
+        trade_time = now
+        if date_text:
+            time_text = time_text or '09:00'
+            if time_text.count(':') == 1:
+                time_text += ':00'
+            try:
+                trade_time = datetime.strptime(f"{date_text} {time_text}", '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                errors.append(f"第 {line_no} 行：日期錯誤「{date_text}」")
+                continue
+            if trade_time > now:
+                errors.append(f"第 {line_no} 行：日期不能是未來")
+                continue
+        
+        shares = quantity_to_shares(float(quantity), unit or '')
+        price = float(price)
+        if shares <= 0 or price <= 0:
+            errors.append(f"第 {line_no} 行：股數與價格必須大於0")
+            continue
+        
+        trades.append({
+            'line_no': line_no,
+            'time': trade_time,
+            'action': 'sell' if action == '賣出' else 'buy',
+            'stock_input': stock_input,
+            'shares': shares,
+            'price': price,
+            'reason': (reason or '').strip()
+        })
+    return trades, errors
+
+def resolve_trade_stocks(trades, deadline=None):
+    """同一個股票輸入只查一次（大多命中股票資訊快取），回傳查不到的行的錯誤訊息"""
+    resolved = {}
+    errors = []
+    for trade in trades:
+        stock_input = trade['stock_input']
+        if stock_input not in resolved:
+            resolved[stock_input] = get_stock_info(stock_input, deadline)
+        stock_info = resolved[stock_input]
+        if not stock_info:
+            errors.append(f"第 {trade['line_no']} 行：找不到股票「{stock_input}」")
+            continue
+        trade['stock_code'] = stock_info['code']
+        trade['stock_name'] = stock_info['name']
+    return errors
+
+def plan_trades(records, trades):
+    """在記憶體中依時間套用交易，回傳 (異動的持股, 錯誤列表)；賣出超過持股時報錯"""
+    positions = {}
+    for row_index, record in enumerate(records, 2):
+        position = {
+            'row': row_index,
+            'user_id': str(record.get('使用者ID', '')),
+            'user_name': str(record.get('使用者名稱', '')),
+            'stock_code': str(record.get('股票代號', '')),
+            'stock_name': str(record.get('股票名稱', '')),
+            'group_id': str(record.get('群組ID', '')),
+            'shares': int(parse_sheet_number(record.get('總股數'))),
+            'cost': parse_sheet_number(record.get('總成本'))
+        }
+        key = (position['group_id'], position['user_id'], position['stock_code'] or position['stock_name'])
+        positions.setdefault(key, position)
+    
+    changed = {}
+    errors = []
+    for trade in sorted(trades, key=lambda trade: trade['time']):
+        group_id, user_id = str(trade['group_id']), str(trade['user_id'])
+        key = (group_id, user_id, trade['stock_code'] or trade['stock_name'])
+        position = positions.get(key) or positions.get((group_id, user_id, trade['stock_name']))
+        if position is None:
+            position = positions[key] = {
+                'row': None, 'user_id': user_id, 'user_name': str(trade['user_name']),
+                'stock_code': trade['stock_code'], 'stock_name': trade['stock_name'],
+                'group_id': group_id, 'shares': 0, 'cost': 0.0
+            }
+        
+        if trade['action'] == 'buy':
+            position['shares'] += trade['shares']
+            position['cost'] += trade['shares'] * trade['price']
+        elif position['shares'] < trade['shares']:
+            errors.append(f"第 {trade['line_no']} 行：{trade['stock_name']} 持股不足"
+                          f"（只有 {format_shares(position['shares'])}）")
+            continue
+        else:
+            avg_cost = position['cost'] / position['shares']
+            position['shares'] -= trade['shares']
+            position['cost'] = position['shares'] * avg_cost
+        position['user_name'] = str(trade['user_name'])
+        changed[id(position)] = position
+    return list(changed.values()), errors
+
+def delete_sheet_rows(sheet, row_indexes):
+    """由下往上刪除多列，連續的列合併成一次呼叫"""
+    runs = []
+    for row_index in sorted(row_indexes, reverse=True):
+        if runs and runs[-1][0] == row_index + 1:
+            runs[-1][0] = row_index
+        else:
+            runs.append([row_index, row_index])
+    for start, end in runs:
+        sheet.delete_rows(start, end)
+    return len(runs)
+
+def write_position_changes(holdings, changed, current_time):
+    """把 plan_trades 的持股異動寫回工作表：一次 batch_update、合併連續列的刪除、一次 append_rows，回傳寫入次數"""
+    writes = 0
+    updates = []
+    new_rows = []
+    deleted = []
+    for position in changed:
+        avg_cost = position['cost'] / position['shares'] if position['shares'] > 0 else 0
+        values = [int(position['shares']), round(avg_cost, 2), round(position['cost'], 2)]
+        if position['row'] is None:
+            if position['shares'] > 0:
+                new_rows.append([position['user_id'], position['user_name'], position['stock_code'],
+                                 position['stock_name']] + values + [position['group_id'], current_time, ''])
+        elif position['shares'] > 0:
+            row = position['row']
+            updates.append({'range': f'E{row}:I{row}', 'values': [values + [position['group_id'], current_time]]})
+        else:
+            deleted.append(position['row'])
+    
+    # 先改再刪（刪除會讓下面的列上移），新增的列放最後
+    if updates:
+        holdings.batch_update(updates)
+        writes += 1
+    if deleted:
+        writes += delete_sheet_rows(holdings, deleted)
+    if new_rows:
+        holdings.append_rows(new_rows)
+        writes += 1
+    return writes
+
+def commit_trades(group_id, trades, deadline=None):
+    """批次寫入多筆已執行的交易：持股讀一次、交易紀錄一次 append_rows、持股一次 batch_update 加一次 append_rows
+    
+    trades 需已解析股票（stock_code、stock_name）並帶 user_id、user_name、group_id；
+    任何一筆驗證失敗時整批不寫入，回傳 (異動的持股, 錯誤列表, Sheets 寫入次數)。
+    """
+    holdings = get_group_sheet('holdings', group_id, create=True)
+    records = read_group_records('holdings', group_id, deadline)
+    changed, errors = plan_trades(records, trades)
+    if errors:
+        return changed, errors, 0
+    
+    writes = 0
+    now = local_now()
+    current_time = now.strftime('%Y-%m-%d %H:%M:%S')
+    ledger_rows = []
+    for i, trade in enumerate(sorted(trades, key=lambda trade: trade['time']), 1):
+        amount = trade['shares'] * trade['price']
+        ledger_rows.append([
+            trade['time'].strftime('%Y-%m-%d %H:%M:%S'),
+            str(trade['user_id']),
+            str(trade['user_name']),
+            str(trade['stock_code']),
+            str(trade['stock_name']),
+            '買入' if trade['action'] == 'buy' else '賣出',
+            int(trade['shares']),
+            float(trade['price']),
+            float(amount),
+            trade.get('reason') or '無理由',
+            str(trade['group_id']),
+            f"{int(time.time())}_{i}",
+            '',
+            '已執行',
+            trade.get('note', '')
+        ])
+    forget_batch_records()
+    get_group_sheet('transactions', group_id, create=True).append_rows(ledger_rows)
+    writes += 1
+    # 匯入比帳上最後一筆還早的交易時，批次引擎要依時間重播
+    if ledger_rows[0][0] < get_lot_last_time(group_id):
+        reset_lot_state(group_id)
+    
+    writes += write_position_changes(holdings, changed, current_time)
+    
+    for position in changed:
+        update_leaderboard_position(position['user_id'], position['user_name'], position['group_id'],
+                                    position['stock_code'], position['stock_name'],
+                                    position['shares'], position['cost'])
+    bump_reply_version('holdings', group_id)
+    print(f"✅ 批次寫入 {len(trades)} 筆交易，異動 {len(changed)} 筆持股，Sheets 寫入 {writes} 次")
+    return changed, [], writes
+
+def render_position_changes(changed):
+    """批次寫入後各持股的結果（每支一行）"""
+    text = ''
+    for position in sorted(changed, key=lambda position: (position['user_name'], position['stock_code'])):
+        if position['shares'] > 0:
+            text += (f"📌 {position['stock_name']} ({position['stock_code'] or 'N/A'})："
+                     f"{format_shares(position['shares'])}，平均成本 {position['cost'] / position['shares']:.2f}元\n")
+        else:
+            text += f"📌 {position['stock_name']} ({position['stock_code'] or 'N/A'})：已全部賣出\n"
+    return text
+
+def import_trades(user_id, user_name, group_id, lines, deadline=None):
+    """/匯入：批次匯入歷史交易（全部驗證通過才寫入）"""
     try:
         if not holdings_sheet:
             return "❌ 無法連接持股資料庫"
         
-        records = holdings_sheet.get_all_records()
+        trades, errors = parse_import_lines(lines)
+        if not trades and not errors:
+            return "❌ 沒有要匯入的交易\n\n" + IMPORT_USAGE
+        if len(trades) > IMPORT_MAX_ROWS:
+            return f"❌ 一次最多匯入 {IMPORT_MAX_ROWS} 筆，請分批匯入"
+        errors += resolve_trade_stocks(trades, deadline)
+        
+        if not errors:
+            for trade in trades:
+                trade.update({'user_id': user_id, 'user_name': user_name, 'group_id': group_id, 'note': '匯入'})
+            changed, errors, writes = commit_trades(group_id, trades, deadline)
+        
+        if errors:
+            response = f"❌ 匯入失敗，沒有寫入任何資料（{len(errors)} 個錯誤）：\n"
+            response += '\n'.join(f"• {error}" for error in errors[:10])
+            if len(errors) > 10:
+                response += f"\n…還有 {len(errors) - 10} 個錯誤"
+            return response
+        
+        buys = sum(1 for trade in trades if trade['action'] == 'buy')
+        response = f"📥 匯入完成：{len(trades)} 筆交易（買入 {buys} 筆、賣出 {len(trades) - buys} 筆）\n"
+        response += f"{'='*25}\n"
+        response += render_position_changes(changed)
+        response += f"{'='*25}\n"
+        response += f"💾 Google Sheets 寫入 {writes} 次"
+        return response
+        
+    except Exception as e:
+        print(f"❌ 匯入交易錯誤: {e}")
+        return f"❌ 匯入交易時發生錯誤: {str(e)}"
+
+def get_holding_prices(holdings, deadline=None):
+    """取得每筆持股的目前股價（同一支股票只查一次），無法取得時為 0"""
+    price_by_stock = {}
+    prices = []
+    for holding in holdings:
+        stock_code = holding['股票代號']
+        stock_name = holding['股票名稱']
+        key = (stock_code, stock_name)
+        if key not in price_by_stock:
+            # 取得市場資訊
+            stock_info = get_stock_info(stock_code if stock_code else stock_name, deadline)
+            market = stock_info['market'] if stock_info else None
+            price_by_stock[key] = get_stock_price(stock_code, stock_name, market, deadline, optional=True)
+        prices.append(price_by_stock[key])
+    return prices
+
+def value_holdings(holdings, prices, group_by='使用者名稱'):
+    """持股估值引擎：以欄位向量一次算出市值、未實現損益、權重與分組小計"""
+    import numpy as np
+    
+    shares = np.array([int(h['總股數']) for h in holdings], dtype=np.int64)
+    avg_cost = np.array([float(h['平均成本']) for h in holdings], dtype=np.float64)
+    cost = np.array([float(h['總成本']) for h in holdings], dtype=np.float64)
+    price = np.array(prices, dtype=np.float64).reshape(len(holdings))
+    
+    # 沒有股價的持股以成本計算市值，損益為 0
+    has_price = price > 0
+    value = np.where(has_price, shares * price, cost)
+    pnl = value - cost
+    pnl_pct = np.zeros_like(pnl)
+    np.divide(pnl, cost, out=pnl_pct, where=cost > 0)
+    pnl_pct *= 100
+    
+    total_cost = float(cost.sum())
+    total_value = float(value.sum())
+    weight = value / total_value if total_value > 0 else np.zeros_like(value)
+    
+    # 分組小計（依第一次出現的順序編號）
+    group_index = {}
+    group_ids = np.array([group_index.setdefault(h[group_by], len(group_index)) for h in holdings], dtype=np.int64)
+    group_count = len(group_index)
+    group_cost = np.bincount(group_ids, weights=cost, minlength=group_count)
+    group_value = np.bincount(group_ids, weights=value, minlength=group_count)
+    group_pnl = group_value - group_cost
+    group_pnl_pct = np.zeros_like(group_pnl)
+    np.divide(group_pnl, group_cost, out=group_pnl_pct, where=group_cost > 0)
+    group_pnl_pct *= 100
+    group_weight = group_value / total_value if total_value > 0 else np.zeros_like(group_value)
+    
+    group_rows = [[] for _ in range(group_count)]
+    for row, group_id in enumerate(group_ids.tolist()):
+        group_rows[group_id].append(row)
+    
+    groups = {}
+    for key, group_id in group_index.items():
+        groups[key] = {
+            'rows': group_rows[group_id],
+            'cost': float(group_cost[group_id]),
+            'value': float(group_value[group_id]),
+            'pnl': float(group_pnl[group_id]),
+            'pnl_pct': float(group_pnl_pct[group_id]),
+            'weight': float(group_weight[group_id])
+        }
+    
+    total_pnl = total_value - total_cost
+    return {
+        'shares': shares.tolist(),
+        'avg_cost': avg_cost.tolist(),
+        'cost': cost.tolist(),
+        'price': price.tolist(),
+        'value': value.tolist(),
+        'pnl': pnl.tolist(),
+        'pnl_pct': pnl_pct.tolist(),
+        'weight': weight.tolist(),
+        'total_cost': total_cost,
+        'total_value': total_value,
+        'total_pnl': total_pnl,
+        'total_pnl_pct': (total_pnl / total_cost * 100) if total_cost > 0 else 0,
+        'groups': groups
+    }
+
+def render_holdings_detail(holdings, valuation, title, summary_title):
+    """把估值結果排成個人持股明細"""
+    holdings_text = title
+    
+    for row, holding in enumerate(holdings):
+        stock_code = holding['股票代號']
+        stock_name = holding['股票名稱']
+        shares = valuation['shares'][row]
+        avg_cost = valuation['avg_cost'][row]
+        current_price = valuation['price'][row]
+        
+        holdings_text += f"{'='*25}\n"
+        holdings_text += f"📌 {stock_name}"
+        if stock_code:
+            holdings_text += f" ({stock_code})"
+        holdings_text += f"\n"
+        holdings_text += f"• 持股：{format_shares(shares)}\n"
+        holdings_text += f"• 平均成本：{avg_cost:.2f}元\n"
+        
+        if current_price > 0:
+            if current_price > avg_cost:
+                price_trend = "📈"
+            elif current_price < avg_cost:
+                price_trend = "📉"
+            else:
+                price_trend = "➡️"
+            
+            unrealized_pnl = valuation['pnl'][row]
+            if unrealized_pnl > 0:
+                pnl_symbol = "🟢"
+            elif unrealized_pnl < 0:
+                pnl_symbol = "🔴"
+            else:
+                pnl_symbol = "⚪"
+            
+            holdings_text += f"• 目前股價：{current_price:.2f}元 {price_trend}\n"
+            holdings_text += f"• 市值：{valuation['value'][row]:,.0f}元\n"
+            holdings_text += f"• 未實現損益：{pnl_symbol} {unrealized_pnl:+,.0f}元 ({valuation['pnl_pct'][row]:+.2f}%)\n"
+        else:
+            holdings_text += f"• 股價：暫時無法取得\n"
+            holdings_text += f"• 成本價值：{valuation['cost'][row]:,.0f}元\n"
+    
+    if len(holdings) > 1:
+        total_cost = valuation['total_cost']
+        total_current_value = valuation['total_value']
+        
+        holdings_text += f"\n{'='*25}\n"
+        holdings_text += summary_title
+        holdings_text += f"• 總投資成本：{total_cost:,.0f}元\n"
+        
+        if total_current_value != total_cost:
+            total_unrealized = valuation['total_pnl']
+            if total_unrealized > 0:
+                total_symbol = "🟢"
+            elif total_unrealized < 0:
+                total_symbol = "🔴"
+            else:
+                total_symbol = "⚪"
+            
+            holdings_text += f"• 目前總市值：{total_current_value:,.0f}元\n"
+            holdings_text += f"• 總未實現損益：{total_symbol} {total_unrealized:+,.0f}元 ({valuation['total_pnl_pct']:+.2f}%)"
+    
+    return holdings_text
+
+def get_user_holdings(user_id, group_id, specific_stock=None, deadline=None):
+    """查詢使用者持股（支援查看他人）"""
+    try:
+        if not holdings_sheet:
+            return "❌ 無法連接持股資料庫"
         
         # 判斷是否要查看他人持股
         if specific_stock:
             # 處理特殊關鍵字
             if specific_stock == '全部':
-                return get_all_group_holdings(group_id)
+                return get_all_group_holdings(group_id, deadline)
             
             # 檢查是否為用戶名稱（不是股票）
-            stock_info = get_stock_info(specific_stock)
+            stock_info = get_stock_info(specific_stock, deadline)
             if not stock_info:
                 # 可能是用戶名稱
-                return get_others_holdings(specific_stock, group_id)
+                return get_others_holdings(specific_stock, group_id, deadline)
+        
+        records = read_group_records('holdings', group_id, deadline)
         
         # 原本的個人持股查詢邏輯
         user_holdings = []
         for record in records:
             if record['使用者ID'] == user_id and record['群組ID'] == group_id:
                 if specific_stock:
-                    stock_info = get_stock_info(specific_stock)
+                    stock_info = get_stock_info(specific_stock, deadline)
                     if stock_info:
                         stock_code = stock_info['code']
                         stock_name = stock_info['name']
@@ -988,100 +2521,20 @@ def get_user_holdings(user_id, group_id, specific_stock=None):
             else:
                 return "📊 您目前沒有任何持股"
         
-        total_cost = 0
-        total_current_value = 0
-        holdings_text = "📊 您的持股狀況：\n\n"
-        
-        for holding in user_holdings:
-            stock_code = holding['股票代號']
-            stock_name = holding['股票名稱']
-            shares = int(holding['總股數'])
-            avg_cost = float(holding['平均成本'])
-            cost = float(holding['總成本'])
-            
-            # 取得市場資訊
-            stock_info = get_stock_info(stock_code if stock_code else stock_name)
-            market = stock_info['market'] if stock_info else None
-            
-            current_price = get_stock_price(stock_code, stock_name, market)
-            
-            if current_price > 0:
-                current_value = shares * current_price
-                unrealized_pnl = current_value - cost
-                pnl_percentage = (unrealized_pnl / cost * 100) if cost > 0 else 0
-                
-                price_trend = ""
-                if current_price > avg_cost:
-                    price_trend = "📈"
-                elif current_price < avg_cost:
-                    price_trend = "📉"
-                else:
-                    price_trend = "➡️"
-            else:
-                current_value = cost
-                unrealized_pnl = 0
-                pnl_percentage = 0
-                price_trend = ""
-            
-            holdings_text += f"{'='*25}\n"
-            holdings_text += f"📌 {stock_name}"
-            if stock_code:
-                holdings_text += f" ({stock_code})"
-            holdings_text += f"\n"
-            holdings_text += f"• 持股：{format_shares(shares)}\n"
-            holdings_text += f"• 平均成本：{avg_cost:.2f}元\n"
-            
-            if current_price > 0:
-                holdings_text += f"• 目前股價：{current_price:.2f}元 {price_trend}\n"
-                holdings_text += f"• 市值：{current_value:,.0f}元\n"
-                
-                if unrealized_pnl > 0:
-                    pnl_symbol = "🟢"
-                elif unrealized_pnl < 0:
-                    pnl_symbol = "🔴"
-                else:
-                    pnl_symbol = "⚪"
-                    
-                holdings_text += f"• 未實現損益：{pnl_symbol} {unrealized_pnl:+,.0f}元 ({pnl_percentage:+.2f}%)\n"
-            else:
-                holdings_text += f"• 股價：暫時無法取得\n"
-                holdings_text += f"• 成本價值：{cost:,.0f}元\n"
-            
-            total_cost += cost
-            total_current_value += current_value
-        
-        if len(user_holdings) > 1:
-            holdings_text += f"\n{'='*25}\n"
-            holdings_text += f"📊 投資組合總結：\n"
-            holdings_text += f"• 總投資成本：{total_cost:,.0f}元\n"
-            
-            if total_current_value != total_cost:
-                holdings_text += f"• 目前總市值：{total_current_value:,.0f}元\n"
-                total_unrealized = total_current_value - total_cost
-                total_percentage = (total_unrealized / total_cost * 100) if total_cost > 0 else 0
-                
-                if total_unrealized > 0:
-                    total_symbol = "🟢"
-                elif total_unrealized < 0:
-                    total_symbol = "🔴"
-                else:
-                    total_symbol = "⚪"
-                    
-                holdings_text += f"• 總未實現損益：{total_symbol} {total_unrealized:+,.0f}元 ({total_percentage:+.2f}%)"
-        
-        return holdings_text
+        valuation = value_holdings(user_holdings, get_holding_prices(user_holdings, deadline))
+        return render_holdings_detail(user_holdings, valuation, "📊 您的持股狀況：\n\n", f"📊 投資組合總結：\n")
         
     except Exception as e:
         print(f"❌ 查詢持股錯誤: {e}")
         return f"❌ 查詢持股時發生錯誤: {str(e)}"
 
-def get_others_holdings(target_name, group_id):
+def get_others_holdings(target_name, group_id, deadline=None):
     """查看指定用戶的持股"""
     try:
         if not holdings_sheet:
             return "❌ 無法連接持股資料庫"
         
-        records = holdings_sheet.get_all_records()
+        records = read_group_records('holdings', group_id, deadline)
         target_holdings = []
         target_user_id = None
         
@@ -1096,92 +2549,16 @@ def get_others_holdings(target_name, group_id):
             return f"❌ 找不到用戶「{target_name}」的持股資料\n\n💡 提示：請確認名稱是否正確，或該用戶是否有持股"
         
         # 計算持股資訊
-        total_cost = 0
-        total_current_value = 0
-        holdings_text = f"📊 {target_name} 的持股狀況：\n\n"
-        
-        for holding in target_holdings:
-            stock_code = holding['股票代號']
-            stock_name = holding['股票名稱']
-            shares = int(holding['總股數'])
-            avg_cost = float(holding['平均成本'])
-            cost = float(holding['總成本'])
-            
-            # 取得市場資訊
-            stock_info = get_stock_info(stock_code if stock_code else stock_name)
-            market = stock_info['market'] if stock_info else None
-            
-            current_price = get_stock_price(stock_code, stock_name, market)
-            
-            if current_price > 0:
-                current_value = shares * current_price
-                unrealized_pnl = current_value - cost
-                pnl_percentage = (unrealized_pnl / cost * 100) if cost > 0 else 0
-                
-                price_trend = ""
-                if current_price > avg_cost:
-                    price_trend = "📈"
-                elif current_price < avg_cost:
-                    price_trend = "📉"
-                else:
-                    price_trend = "➡️"
-            else:
-                current_value = cost
-                unrealized_pnl = 0
-                pnl_percentage = 0
-                price_trend = ""
-            
-            holdings_text += f"{'='*25}\n"
-            holdings_text += f"📌 {stock_name}"
-            if stock_code:
-                holdings_text += f" ({stock_code})"
-            holdings_text += f"\n"
-            holdings_text += f"• 持股：{format_shares(shares)}\n"
-            holdings_text += f"• 平均成本：{avg_cost:.2f}元\n"
-            
-            if current_price > 0:
-                holdings_text += f"• 目前股價：{current_price:.2f}元 {price_trend}\n"
-                holdings_text += f"• 市值：{current_value:,.0f}元\n"
-                
-                if unrealized_pnl > 0:
-                    pnl_symbol = "🟢"
-                elif unrealized_pnl < 0:
-                    pnl_symbol = "🔴"
-                else:
-                    pnl_symbol = "⚪"
-                    
-                holdings_text += f"• 未實現損益：{pnl_symbol} {unrealized_pnl:+,.0f}元 ({pnl_percentage:+.2f}%)\n"
-            else:
-                holdings_text += f"• 股價：暫時無法取得\n"
-                holdings_text += f"• 成本價值：{cost:,.0f}元\n"
-            
-            total_cost += cost
-            total_current_value += current_value
-        
-        if len(target_holdings) > 1:
-            holdings_text += f"\n{'='*25}\n"
-            holdings_text += f"📊 {target_name} 的投資組合總結：\n"
-            holdings_text += f"• 總投資成本：{total_cost:,.0f}元\n"
-            
-            if total_current_value != total_cost:
-                holdings_text += f"• 目前總市值：{total_current_value:,.0f}元\n"
-                total_unrealized = total_current_value - total_cost
-                total_percentage = (total_unrealized / total_cost * 100) if total_cost > 0 else 0
-                
-                if total_unrealized > 0:
-                    total_symbol = "🟢"
-                elif total_unrealized < 0:
-                    total_symbol = "🔴"
-                else:
-                    total_symbol = "⚪"
-                    
-                holdings_text += f"• 總未實現損益：{total_symbol} {total_unrealized:+,.0f}元 ({total_percentage:+.2f}%)"
+        valuation = value_holdings(target_holdings, get_holding_prices(target_holdings, deadline))
+        holdings_text = render_holdings_detail(
+            target_holdings, valuation,
+            f"📊 {target_name} 的持股狀況：\n\n", f"📊 {target_name} 的投資組合總結：\n"
+        )
         
         # 加上最後更新時間
-        if target_holdings:
-            last_update = target_holdings[0].get('更新時間', '')
-            if last_update:
-                holdings_text += f"\n\n⏰ 最後更新：{last_update}"
+        last_update = target_holdings[0].get('更新時間', '')
+        if last_update:
+            holdings_text += f"\n\n⏰ 最後更新：{last_update}"
         
         return holdings_text
         
@@ -1191,79 +2568,42 @@ def get_others_holdings(target_name, group_id):
         print(traceback.format_exc())
         return f"❌ 查詢他人持股時發生錯誤: {str(e)}"
 
-def get_all_group_holdings(group_id):
+def get_all_group_holdings(group_id, deadline=None):
     """查看群組所有人的持股總覽"""
     try:
         if not holdings_sheet:
             return "❌ 無法連接持股資料庫"
         
-        records = holdings_sheet.get_all_records()
-        
-        # 整理群組內所有用戶的持股
-        user_holdings_map = {}
+        records = read_group_records('holdings', group_id, deadline)
+        group_holdings = [record for record in records if record['群組ID'] == group_id]
         
-        for record in records:
-            if record['群組ID'] == group_id:
-                user_name = record['使用者名稱']
-                
-                if user_name not in user_holdings_map:
-                    user_holdings_map[user_name] = {
-                        'user_id': record['使用者ID'],
-                        'holdings': [],
-                        'total_cost': 0,
-                        'total_value': 0
-                    }
-                
-                stock_code = record['股票代號']
-                stock_name = record['股票名稱']
-                shares = int(record['總股數'])
-                avg_cost = float(record['平均成本'])
-                cost = float(record['總成本'])
-                
-                # 取得市場資訊和目前股價
-                stock_info = get_stock_info(stock_code if stock_code else stock_name)
-                market = stock_info['market'] if stock_info else None
-                current_price = get_stock_price(stock_code, stock_name, market)
-                current_value = shares * current_price if current_price > 0 else cost
-                
-                user_holdings_map[user_name]['holdings'].append({
-                    'stock_name': stock_name,
-                    'stock_code': stock_code,
-                    'shares': shares,
-                    'cost': cost,
-                    'current_value': current_value,
-                    'current_price': current_price,
-                    'avg_cost': avg_cost
-                })
-                
-                user_holdings_map[user_name]['total_cost'] += cost
-                user_holdings_map[user_name]['total_value'] += current_value
-        
-        if not user_holdings_map:
+        if not group_holdings:
             return "📊 群組內目前沒有任何人持有股票"
         
+        # 整理群組內所有用戶的持股（依使用者名稱分組）
+        valuation = value_holdings(group_holdings, get_holding_prices(group_holdings, deadline))
+        user_groups = valuation['groups']
+        
         # 產生報告
         response = f"📊 群組持股總覽\n"
         response += f"{'='*30}\n\n"
         
-        # 統計資訊
-        total_group_value = 0
-        total_group_cost = 0
         stock_statistics = {}
         
         # 依用戶顯示持股
-        for user_name, data in sorted(user_holdings_map.items()):
+        for user_name, data in sorted(user_groups.items()):
             response += f"👤 **{user_name}**\n"
             
             # 顯示該用戶的每支股票
-            for holding in data['holdings']:
-                shares_display = format_shares(holding['shares'])
-                response += f"  • {holding['stock_name']}: {shares_display}"
+            for row in data['rows']:
+                holding = group_holdings[row]
+                stock_name = holding['股票名稱']
+                stock_code = holding['股票代號']
+                shares = valuation['shares'][row]
+                response += f"  • {stock_name}: {format_shares(shares)}"
                 
-                if holding['current_price'] > 0:
-                    pnl = holding['current_value'] - holding['cost']
-                    pnl_pct = (pnl / holding['cost'] * 100) if holding['cost'] > 0 else 0
-                    
+                if valuation['price'][row] > 0:
+                    pnl = valuation['pnl'][row]
                     if pnl > 0:
                         response += f" 🟢"
                     elif pnl < 0:
@@ -1274,39 +2614,34 @@ def get_all_group_holdings(group_id):
                 response += f"\n"
                 
                 # 統計股票持有情況
-                stock_key = f"{holding['stock_name']} ({holding['stock_code']})" if holding['stock_code'] else holding['stock_name']
-                if stock_key not in stock_statistics:
-                    stock_statistics[stock_key] = 0
-                stock_statistics[stock_key] += holding['shares']
+                stock_key = f"{stock_name} ({stock_code})" if stock_code else stock_name
+                stock_statistics[stock_key] = stock_statistics.get(stock_key, 0) + shares
             
             # 顯示該用戶的總市值
-            user_pnl = data['total_value'] - data['total_cost']
-            user_pnl_pct = (user_pnl / data['total_cost'] * 100) if data['total_cost'] > 0 else 0
-            
-            response += f"  💰 總市值：{data['total_value']:,.0f}元"
+            user_pnl = data['pnl']
+            response += f"  💰 總市值：{data['value']:,.0f}元"
             
             if user_pnl != 0:
                 if user_pnl > 0:
                     response += f" 🟢"
                 else:
                     response += f" 🔴"
-                response += f" ({user_pnl:+,.0f}, {user_pnl_pct:+.1f}%)"
+                response += f" ({user_pnl:+,.0f}, {data['pnl_pct']:+.1f}%)"
             
             response += f"\n\n"
-            
-            total_group_value += data['total_value']
-            total_group_cost += data['total_cost']
         
         # 群組總計
+        total_group_cost = valuation['total_cost']
+        total_group_value = valuation['total_value']
         response += f"{'='*30}\n"
         response += f"📈 **群組統計**\n"
-        response += f"• 總成員數：{len(user_holdings_map)}人\n"
+        response += f"• 總成員數：{len(user_groups)}人\n"
         response += f"• 總投資成本：{total_group_cost:,.0f}元\n"
         response += f"• 總市值：{total_group_value:,.0f}元\n"
         
-        group_pnl = total_group_value - total_group_cost
+        group_pnl = valuation['total_pnl']
         if group_pnl != 0:
-            group_pnl_pct = (group_pnl / total_group_cost * 100) if total_group_cost > 0 else 0
+            group_pnl_pct = valuation['total_pnl_pct']
             if group_pnl > 0:
                 response += f"• 總損益：🟢 {group_pnl:+,.0f}元 ({group_pnl_pct:+.1f}%)\n"
             else:
@@ -1328,13 +2663,1214 @@ def get_all_group_holdings(group_id):
         print(traceback.format_exc())
         return f"❌ 查詢群組持股時發生錯誤: {str(e)}"
 
-def create_sell_voting(user_id, user_name, group_id, sell_data):
+def get_leaderboard_price(stock_code):
+    """快照使用的價格：最近一次報價，沒有時回傳 0（以成本計算）"""
+    return LEADERBOARD_PRICES.get(stock_code) or get_cached_price(stock_code, max_age=None)
+
+def set_snapshot_position(group_snapshot, user_id, user_name, group_id, stock_code, stock_name, shares, cost):
+    """設定一位成員單一持股的股數與成本，並調整成員的成本／市值合計"""
+    users = group_snapshot['users']
+    user = users.get(user_id)
+    if not user:
+        user = users[user_id] = {'user_name': user_name, 'cost': 0.0, 'value': 0.0, 'unpriced': 0, 'positions': {}}
+    user['user_name'] = user_name
+    
+    stock_key = stock_code or stock_name
+    old = user['positions'].pop(stock_key, None)
+    if old:
+        user['cost'] -= old['cost']
+        user['value'] -= old['value']
+        user['unpriced'] -= not old['priced']
+    
+    if shares <= 0:
+        if stock_code:
+            LEADERBOARD_HOLDERS.get(stock_code, set()).discard((group_id, user_id))
+        if not user['positions']:
+            del users[user_id]
+        return
+    
+    price = get_leaderboard_price(stock_code) if stock_code else 0
+    value = shares * price if price > 0 else cost
+    user['positions'][stock_key] = {
+        'stock_code': stock_code, 'shares': shares, 'cost': cost, 'value': value, 'priced': price > 0
+    }
+    user['cost'] += cost
+    user['value'] += value
+    user['unpriced'] += not price > 0
+    if stock_code:
+        LEADERBOARD_HOLDERS.setdefault(stock_code, set()).add((group_id, user_id))
+
+def rebuild_leaderboard(deadline=None, group_id=None):
+    """從持股表重建快照（只讀一次工作表，不查股價）；分片模式下只讀該群組的分片、只重建該群組"""
+    if SHARD_MODE != 'off' and group_id is not None:
+        group_id = str(group_id)
+        records = [record for record in read_group_records('holdings', group_id, deadline)
+                   if str(record['群組ID']) == group_id]
+        with LEADERBOARD_LOCK:
+            old_snapshot = LEADERBOARD.pop(group_id, {'users': {}})
+            for user_id, user in old_snapshot['users'].items():
+                for position in user['positions'].values():
+                    LEADERBOARD_HOLDERS.get(position['stock_code'], set()).discard((group_id, user_id))
+            group_snapshot = LEADERBOARD[group_id] = {'users': {}}
+            for record in records:
+                try:
+                    set_snapshot_position(
+                        group_snapshot, str(record['使用者ID']), str(record['使用者名稱']), group_id,
+                        str(record['股票代號']), str(record['股票名稱']),
+                        int(parse_sheet_number(record['總股數'])), parse_sheet_number(record['總成本'])
+                    )
+                except (KeyError, ValueError) as e:
+                    print(f"⚠️ 略過無法解析的持股記錄: {e}")
+            LEADERBOARD_STATE['groups'][group_id] = time.time()
+        return
+    
+    records = read_all_shard_records('holdings', deadline)
+    
+    with LEADERBOARD_LOCK:
+        LEADERBOARD.clear()
+        LEADERBOARD_HOLDERS.clear()
+        LEADERBOARD_STATE['groups'].clear()
+        loaded_at = time.time()
+        for record in records:
+            try:
+                group_id = str(record['群組ID'])
+                group_snapshot = LEADERBOARD.setdefault(group_id, {'users': {}})
+                set_snapshot_position(
+                    group_snapshot, str(record['使用者ID']), str(record['使用者名稱']), group_id,
+                    str(record['股票代號']), str(record['股票名稱']),
+                    int(parse_sheet_number(record['總股數'])), parse_sheet_number(record['總成本'])
+                )
+            except (KeyError, ValueError) as e:
+                print(f"⚠️ 略過無法解析的持股記錄: {e}")
+        LEADERBOARD_STATE['loaded_at'] = loaded_at
+
+def update_leaderboard_position(user_id, user_name, group_id, stock_code, stock_name, shares, cost):
+    """交易寫入持股表後同步快照（快照還沒建立時略過，之後重建會讀到）"""
+    with LEADERBOARD_LOCK:
+        group_snapshot = LEADERBOARD.get(str(group_id))
+        if group_snapshot is None:
+            if not LEADERBOARD_STATE['loaded_at']:
+                return
+            group_snapshot = LEADERBOARD[str(group_id)] = {'users': {}}
+        set_snapshot_position(group_snapshot, str(user_id), str(user_name), str(group_id),
+                              str(stock_code), str(stock_name), int(shares), float(cost))
+
+def update_leaderboard_price(stock_code, price):
+    """報價更新時只調整持有這支股票的成員市值"""
+    if price <= 0:
+        return
+    with LEADERBOARD_LOCK:
+        LEADERBOARD_PRICES[stock_code] = price
+        for group_id, user_id in LEADERBOARD_HOLDERS.get(stock_code, ()):
+            user = LEADERBOARD[group_id]['users'][user_id]
+            for position in user['positions'].values():
+                if position['stock_code'] == stock_code:
+                    value = position['shares'] * price
+                    user['value'] += value - position['value']
+                    position['value'] = value
+                    if not position['priced']:
+                        position['priced'] = True
+                        user['unpriced'] -= 1
+
+def get_leaderboard(group_id, deadline=None):
+    """/排行：依報酬率排序群組成員（從快照產生，不查股價）"""
+    try:
+        if not holdings_sheet:
+            return "❌ 無法連接持股資料庫"
+        
+        # 其他實例的交易不會更新這裡的快照，超過 LEADERBOARD_TTL 就重建
+        if SHARD_MODE != 'off':
+            if time.time() - LEADERBOARD_STATE['groups'].get(group_id, 0) >= LEADERBOARD_TTL:
+                rebuild_leaderboard(deadline, group_id)
+        elif time.time() - LEADERBOARD_STATE['loaded_at'] >= LEADERBOARD_TTL:
+            rebuild_leaderboard(deadline)
+        
+        with LEADERBOARD_LOCK:
+            users = LEADERBOARD.get(group_id, {}).get('users', {})
+            rows = []
+            unpriced = 0
+            for user in users.values():
+                pnl = user['value'] - user['cost']
+                pnl_pct = (pnl / user['cost'] * 100) if user['cost'] > 0 else 0
+                rows.append((pnl_pct, pnl, user['user_name'], user['cost'], user['value']))
+                unpriced += user['unpriced']
+        
+        if not rows:
+            return "📊 群組內目前沒有任何人持有股票"
+        
+        rows.sort(reverse=True)
+        medals = ['🥇', '🥈', '🥉']
+        response = f"🏆 群組績效排行榜\n"
+        response += f"{'='*25}\n"
+        
+        total_cost = 0
+        total_value = 0
+        for rank, (pnl_pct, pnl, user_name, cost, value) in enumerate(rows, 1):
+            prefix = medals[rank - 1] if rank <= len(medals) else f"{rank}."
+            response += f"{prefix} {user_name}：{pnl_pct:+.2f}%（{pnl_symbol(pnl)} {pnl:+,.0f}元）\n"
+            total_cost += cost
+            total_value += value
+        
+        group_pnl = total_value - total_cost
+        group_pct = (group_pnl / total_cost * 100) if total_cost > 0 else 0
+        response += f"{'='*25}\n"
+        response += f"📊 群組合計：市值 {total_value:,.0f}元，{pnl_symbol(group_pnl)} {group_pnl:+,.0f}元 ({group_pct:+.2f}%)"
+        
+        if unpriced:
+            response += f"\n\n💡 {unpriced} 筆持股尚無報價，暫以成本計算"
+        return response
+        
+    except Exception as e:
+        print(f"❌ 查詢排行榜錯誤: {e}")
+        return f"❌ 查詢排行榜時發生錯誤: {str(e)}"
+
+def parse_alert_command(text):
+    """解析 /提醒 2330 > 1200，回傳 (股票, 方向, 價格)，格式錯誤時回傳 None"""
+    match = ALERT_PATTERN.match(text.strip())
+    if not match:
+        return None
+    stock_input, operator, threshold = match.groups()
+    return stock_input, ALERT_OPERATORS[operator], float(threshold)
+
+def format_alert_condition(direction, threshold):
+    return f"{ALERT_CONDITIONS[direction]} {threshold:,.2f}元"
+
+def get_user_alerts(records, user_id, group_id):
+    """使用者在這個群組中啟用中的提醒，回傳 (列號, 紀錄)"""
+    return [(row, record) for row, record in enumerate(records, 2)
+            if str(record['使用者ID']) == user_id and str(record['群組ID']) == group_id
+            and record['狀態'] == '啟用']
+
+def create_price_alert(user_id, user_name, group_id, stock_input, direction, threshold, deadline=None):
+    """新增價格提醒"""
+    try:
+        if not alert_sheet:
+            return "❌ 無法連接提醒資料庫"
+        
+        stock_info = get_stock_info(stock_input, deadline)
+        if not stock_info:
+            return f"❌ 找不到股票：{stock_input}"
+        
+        records = read_sheet_records(alert_sheet, deadline)
+        if len(get_user_alerts(records, user_id, group_id)) >= ALERT_MAX_PER_USER:
+            return f"❌ 每人最多 {ALERT_MAX_PER_USER} 個提醒，請先用 /取消提醒 刪除不需要的提醒"
+        
+        alert_id = str(uuid.uuid4())[:8]
+        alert_sheet.append_row([
+            alert_id, str(user_id), str(user_name), str(group_id),
+            str(stock_info['code']), str(stock_info['name']), str(stock_info['market'] or ''),
+            direction, float(threshold), '啟用',
+            local_now().strftime('%Y-%m-%d %H:%M:%S'), '', ''
+        ])
+        
+        response = f"""⏰ 價格提醒已設定！
+
+🏢 股票：{stock_info['name']} ({stock_info['code']})
+🎯 條件：{format_alert_condition(direction, threshold)}
+🆔 提醒ID：{alert_id}"""
+        
+        current_price = get_cached_price(stock_info['code'], max_age=None)
+        if current_price > 0:
+            response += f"\n💰 目前股價：{current_price:.2f}元"
+        response += "\n\n💡 盤中每 5 分鐘檢查一次，觸發後會推播通知並自動停用"
+        return response
+        
+    except Exception as e:
+        print(f"❌ 新增提醒錯誤: {e}")
+        return f"❌ 新增提醒時發生錯誤: {str(e)}"
+
+def list_price_alerts(user_id, group_id, deadline=None):
+    """列出使用者啟用中的提醒"""
+    try:
+        if not alert_sheet:
+            return "❌ 無法連接提醒資料庫"
+        
+        alerts = get_user_alerts(read_sheet_records(alert_sheet, deadline), user_id, group_id)
+        if not alerts:
+            return "⏰ 目前沒有啟用中的提醒\n\n💡 設定方式：/提醒 2330 > 1200"
+        
+        response = f"⏰ 您的價格提醒（{len(alerts)} 個）：\n\n"
+        for _, record in alerts:
+            threshold = parse_sheet_number(record['價格'])
+            response += f"• {record['股票名稱']} ({record['股票代號']}) {format_alert_condition(record['條件'], threshold)}\n"
+            response += f"  ID：{record['提醒ID']}\n"
+        response += "\n💡 取消：/取消提醒 提醒ID"
+        return response
+        
+    except Exception as e:
+        print(f"❌ 查詢提醒錯誤: {e}")
+        return f"❌ 查詢提醒時發生錯誤: {str(e)}"
+
+def cancel_price_alert(user_id, group_id, alert_id, deadline=None):
+    """取消自己的提醒"""
+    try:
+        if not alert_sheet:
+            return "❌ 無法連接提醒資料庫"
+        
+        for row, record in get_user_alerts(read_sheet_records(alert_sheet, deadline), user_id, group_id):
+            if str(record['提醒ID']) == alert_id:
+                alert_sheet.update(f'J{row}', [['已取消']])
+                return f"✅ 已取消提醒：{record['股票名稱']} {format_alert_condition(record['條件'], parse_sheet_number(record['價格']))}"
+        
+        return f"❌ 找不到提醒ID：{alert_id}"
+        
+    except Exception as e:
+        print(f"❌ 取消提醒錯誤: {e}")
+        return f"❌ 取消提醒時發生錯誤: {str(e)}"
+
+def build_alert_index(records):
+    """依股票建立排序好的門檻索引：每種條件各是 (門檻列表, 提醒列表)"""
+    grouped = {}
+    for row, record in enumerate(records, 2):
+        if record['狀態'] != '啟用' or record['條件'] not in ALERT_CONDITIONS:
+            continue
+        try:
+            threshold = parse_sheet_number(record['價格'])
+        except ValueError:
+            continue
+        stock_code = str(record['股票代號'])
+        entry = grouped.setdefault(stock_code, {'market': record['市場'] or None,
+                                                **{condition: [] for condition in ALERT_CONDITIONS}})
+        entry[record['條件']].append((threshold, row, record))
+    
+    index = {}
+    for stock_code, entry in grouped.items():
+        index[stock_code] = {'market': entry['market']}
+        for direction in ALERT_CONDITIONS:
+            alerts = sorted(entry[direction], key=lambda item: item[0])
+            index[stock_code][direction] = ([item[0] for item in alerts], [item[1:] for item in alerts])
+    return index
+
+def evaluate_alerts(index, prices):
+    """用二分搜尋找出觸發的提醒：往上的條件取門檻 < 股價（≥ 含等於）的前段，往下的取門檻 > 股價（≤ 含等於）的後段"""
+    triggered = []
+    for stock_code, price in prices.items():
+        entry = index.get(stock_code)
+        if not entry:
+            continue
+        matched = (
+            entry['above'][1][:bisect_left(entry['above'][0], price)]
+            + entry['at_or_above'][1][:bisect_right(entry['at_or_above'][0], price)]
+            + entry['below'][1][bisect_right(entry['below'][0], price):]
+            + entry['at_or_below'][1][bisect_left(entry['at_or_below'][0], price):]
+        )
+        for row, record in matched:
+            triggered.append((row, record, price))
+    return triggered
+
+def fetch_twse_quote_rows(symbols, deadline=None):
+    """一次查詢多支股票的報價（mis.twse 的 ex_ch 可用 | 串接），回傳 {代號: 原始報價資料}"""
+    channels = []
+    for stock_code, market in symbols.items():
+        # 不確定市場時上市、上櫃都查，只會有一個有資料
+        for candidate in ([market] if market in ('tse', 'otc') else ['tse', 'otc']):
+            channels.append(f"{candidate}_{stock_code}.tw")
+    
+    url = "https://mis.twse.com.tw/stock/api/getStockInfo.jsp"
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+        'Referer': 'https://mis.twse.com.tw/'
+    }
+    
+    rows = {}
+    for start in range(0, len(channels), QUOTE_BATCH_SIZE):
+        if deadline and deadline.expired():
+            break
+        batch = channels[start:start + QUOTE_BATCH_SIZE]
+        params = {'ex_ch': '|'.join(batch), 'json': '1', 'delay': '0'}
+        try:
+            response = traced_request('twse.quote_batch', 'GET', url, {'symbols': len(batch)},
+                                      params=params, headers=headers,
+                                      timeout=upstream_timeout(deadline, 10))
+            if response.status_code != 200:
+                print(f"⚠️ 批次報價失敗: HTTP {response.status_code}")
+                continue
+            for stock_data in response.json().get('msgArray', []):
+                rows[stock_data['c']] = stock_data
+        except Exception as e:
+            print(f"⚠️ 批次報價錯誤: {e}")
+    return rows
+
+def parse_twse_price(value):
+    """mis.twse 沒有資料時是 '-'，回傳 0"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+def fetch_twse_quotes(symbols, deadline=None):
+    """批次查詢即時成交價，回傳 {代號: 價格}，並更新報價快取與排行榜快照"""
+    prices = {}
+    previous_closes = {}
+    for stock_code, stock_data in fetch_twse_quote_rows(symbols, deadline).items():
+        # 盤中最近一筆成交價，沒有成交時略過（不用昨收，避免用舊價格觸發）
+        price = parse_twse_price(stock_data.get('z'))
+        if price > 0:
+            prices[stock_code] = price
+        else:
+            previous_closes[stock_code] = parse_twse_price(stock_data.get('y'))
+    
+    now = time.time()
+    for stock_code, price in prices.items():
+        QUOTE_CACHE[stock_code] = {'price': price, 'time': now, 'previous_close': False}
+        update_leaderboard_price(stock_code, price)
+    # 今天還沒成交的股票快取昨收並標記，和 get_stock_price 一樣，/股價 才會註明是昨收
+    for stock_code, price in previous_closes.items():
+        if price > 0:
+            QUOTE_CACHE[stock_code] = {'price': price, 'time': now, 'previous_close': True}
+    return prices
+
+def run_price_alerts(deadline=None):
+    """排程檢查：讀一次提醒表、批次查價、比對門檻、更新狀態、依聊天室批次推播
+
+    休市時段不查上游；收盤後 ALERT_CLOSE_GRACE 秒內還會用收盤價檢查一次。
+    """
+    if get_market_session() != 'open':
+        last_close = get_last_close().timestamp()
+        if ALERT_STATE['checked_at'] >= last_close or time.time() - last_close > ALERT_CLOSE_GRACE:
+            print("💤 休市中，略過價格提醒")
+            return {"watched": 0, "quoted": 0, "triggered": 0, "pushed": 0, "skipped": "market_closed"}
+    ALERT_STATE['checked_at'] = time.time()
+    
+    records = read_sheet_records(alert_sheet, deadline)
+    index = build_alert_index(records)
+    if not index:
+        return {"watched": 0, "quoted": 0, "triggered": 0, "pushed": 0}
+    
+    prices = fetch_twse_quotes({code: entry['market'] for code, entry in index.items()}, deadline)
+    triggered = evaluate_alerts(index, prices)
+    if not triggered:
+        return {"watched": len(index), "quoted": len(prices), "triggered": 0, "pushed": 0}
+    
+    # 先標記已觸發（一次寫入），避免推播失敗後下一輪重複通知
+    triggered_time = local_now().strftime('%Y-%m-%d %H:%M:%S')
+    alert_sheet.batch_update([
+        {'range': f'J{row}', 'values': [['已觸發']]} for row, _, _ in triggered
+    ] + [
+        {'range': f'L{row}:M{row}', 'values': [[triggered_time, price]]} for row, _, price in triggered
+    ])
+    
+    # 同一個聊天室的通知合併，每次推播最多 5 則訊息
+    lines_by_chat = {}
+    for _, record, price in triggered:
+        threshold = parse_sheet_number(record['價格'])
+        lines_by_chat.setdefault(str(record['群組ID']), []).append(
+            f"🔔 {record['使用者名稱']} 的提醒：{record['股票名稱']} ({record['股票代號']}) "
+            f"現價 {price:.2f}元，已{'漲到' if record['條件'].endswith('above') else '跌到'} {format_alert_condition(record['條件'], threshold)}"
+        )
+    
+    pushed = 0
+    for chat_id, lines in lines_by_chat.items():
+        messages = ['\n'.join(lines[i:i + ALERT_LINES_PER_MESSAGE]) for i in range(0, len(lines), ALERT_LINES_PER_MESSAGE)]
+        for start in range(0, len(messages), ALERT_PUSH_BATCH_SIZE):
+            if send_push_message(chat_id, messages[start:start + ALERT_PUSH_BATCH_SIZE]):
+                pushed += 1
+    
+    print(f"🔔 價格提醒：觸發 {len(triggered)} 個，推播 {pushed} 次")
+    return {"watched": len(index), "quoted": len(prices), "triggered": len(triggered), "pushed": pushed}
+
+def close_expired_votes(now=None):
+    """把已過截止時間的投票標記為過期（沒人再投票時狀態不會自己改變）"""
+    now = now or local_now()
+    for vote in active_votes.values():
+        if vote['status'] == 'active' and now > vote['deadline']:
+            vote['status'] = 'expired'
+            vote['closed_at'] = vote['deadline']
+            bump_reply_version('votes', vote['group_id'])
+
+def split_message_text(text, limit=LINE_TEXT_LIMIT):
+    """依行切成不超過 limit 字的多則訊息（單行過長時硬切）"""
+    messages = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                messages.append(current)
+                current = ''
+            messages.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            messages.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        messages.append(current)
+    return messages
+
+def split_reply_text(text, limit=LINE_TEXT_LIMIT):
+    """依空行與持股分隔線切成多則訊息，同一位成員或同一支股票的區塊不拆開（區塊過長時才依行切）"""
+    if len(text) <= limit:
+        return [text]
+    
+    blocks = []
+    current = []
+    for line in text.split('\n'):
+        if current and (not line.strip() or line.startswith(REPLY_BLOCK_SEPARATOR)):
+            blocks.append('\n'.join(current))
+            current = []
+        current.append(line)
+    if current:
+        blocks.append('\n'.join(current))
+    
+    messages = []
+    current = ''
+    for block in blocks:
+        candidate = f"{current}\n{block}" if current else block
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current.strip():
+            messages.append(current.strip('\n'))
+        current = block
+        if len(block) > limit:
+            parts = split_message_text(block.strip('\n'), limit)
+            messages.extend(parts[:-1])
+            current = parts[-1]
+    if current.strip():
+        messages.append(current.strip('\n'))
+    return messages
+
+def build_flex_messages(text):
+    """把長回覆轉成 Flex 輪播，每張卡片一段文字"""
+    chunks = split_reply_text(text, FLEX_BUBBLE_CHARS)
+    alt_text = (text.strip().split('\n', 1)[0] or '查詢結果')[:300]
+    messages = []
+    for start in range(0, len(chunks), FLEX_BUBBLES_PER_CAROUSEL):
+        bubbles = [{
+            'type': 'bubble',
+            'size': 'mega',
+            'body': {
+                'type': 'box',
+                'layout': 'vertical',
+                'contents': [{'type': 'text', 'text': chunk, 'wrap': True, 'size': 'xs'}]
+            }
+        } for chunk in chunks[start:start + FLEX_BUBBLES_PER_CAROUSEL]]
+        messages.append({
+            'type': 'flex',
+            'altText': alt_text,
+            'contents': {'type': 'carousel', 'contents': bubbles}
+        })
+    return messages
+
+def build_reply_messages(text):
+    """把回覆文字轉成 LINE 訊息物件列表（不截斷，需要幾則就幾則）"""
+    text = str(text)
+    if len(text) <= LINE_TEXT_LIMIT:
+        return [{'type': 'text', 'text': text}]
+    if REPLY_FLEX:
+        return build_flex_messages(text)
+    return [{'type': 'text', 'text': chunk} for chunk in split_reply_text(text)]
+
+def build_daily_digests(holdings_records, transaction_records, quotes, today):
+    """一次走訪所有持股與今日交易，算出每個群組的摘要資料"""
+    groups = {}
+    
+    def get_position(group_id, user_id, user_name, stock_code, stock_name):
+        group = groups.setdefault(group_id, {'positions': {}, 'trades': [], 'votes': {}})
+        key = (user_id, stock_code or stock_name)
+        position = group['positions'].get(key)
+        if position is None:
+            position = group['positions'][key] = {
+                'user_name': user_name, 'stock_code': stock_code, 'stock_name': stock_name,
+                'shares': 0, 'bought': 0, 'buy_cost': 0.0, 'sold': 0, 'proceeds': 0.0
+            }
+        return position
+    
+    for record in holdings_records:
+        position = get_position(str(record['群組ID']), str(record['使用者ID']), str(record['使用者名稱']),
+                                str(record['股票代號']), str(record['股票名稱']))
+        position['shares'] += int(parse_sheet_number(record['總股數']))
+    
+    for record in transaction_records:
+        if not str(record['日期時間']).startswith(today) or record['狀態'] not in ('', '已執行'):
+            continue
+        action = record['交易類型']
+        if action not in ('買入', '賣出'):
+            continue
+        group_id = str(record['群組ID'])
+        shares = int(parse_sheet_number(record['股數']))
+        price = parse_sheet_number(record['單價'])
+        position = get_position(group_id, str(record['使用者ID']), str(record['使用者名稱']),
+                                str(record['股票代號']), str(record['股票名稱']))
+        if action == '買入':
+            position['bought'] += shares
+            position['buy_cost'] += shares * price
+        else:
+            position['sold'] += shares
+            position['proceeds'] += shares * price
+            if record['投票ID']:
+                groups[group_id]['votes'][str(record['投票ID'])] = (
+                    '✅', f"{record['使用者名稱']} 賣出 {record['股票名稱']} {format_shares(shares)}（通過）"
+                )
+        groups[group_id]['trades'].append(
+            f"{record['使用者名稱']} {action} {record['股票名稱']} {format_shares(shares)} @ {price:.2f}元"
+        )
+    
+    # 否決與過期的投票只記在記憶體中
+    for vote_id, vote in active_votes.items():
+        closed_at = vote.get('closed_at')
+        if vote['status'] in ('rejected', 'expired') and closed_at and closed_at.strftime('%Y-%m-%d') == today:
+            result = '否決' if vote['status'] == 'rejected' else '過期'
+            groups.setdefault(vote['group_id'], {'positions': {}, 'trades': [], 'votes': {}})['votes'][vote_id] = (
+                '❌' if vote['status'] == 'rejected' else '⌛',
+                f"{vote['initiator_name']} 賣出 {vote['stock_name']} {format_shares(vote['shares'])}（{result}）"
+            )
+    
+    # 今日損益 = 收盤市值 − 昨收市值 − 今日買進金額 + 今日賣出金額
+    for group in groups.values():
+        users = {}
+        for (user_id, _), position in group['positions'].items():
+            close, previous_close = quotes.get(position['stock_code'], (0, 0))
+            if close <= 0 or previous_close <= 0:
+                continue
+            opening_shares = position['shares'] - position['bought'] + position['sold']
+            day_pnl = (position['shares'] * close - opening_shares * previous_close
+                       - position['buy_cost'] + position['proceeds'])
+            user = users.setdefault(user_id, {'user_name': position['user_name'], 'pnl': 0.0, 'value': 0.0})
+            user['pnl'] += day_pnl
+            user['value'] += position['shares'] * close
+        group['users'] = users
+    return groups
+
+def render_daily_digest(group, today):
+    """產生單一群組的每日摘要文字，沒有任何內容時回傳 None"""
+    if not group['users'] and not group['trades'] and not group['votes']:
+        return None
+    
+    response = f"📰 今日群組摘要（{today}）\n"
+    response += f"{'='*25}\n"
+    
+    if group['users']:
+        response += "💹 今日損益：\n"
+        group_pnl = 0
+        for user in sorted(group['users'].values(), key=lambda user: user['pnl'], reverse=True):
+            response += f"• {user['user_name']}：{pnl_symbol(user['pnl'])} {user['pnl']:+,.0f}元（市值 {user['value']:,.0f}元）\n"
+            group_pnl += user['pnl']
+        response += f"💰 群組合計：{pnl_symbol(group_pnl)} {group_pnl:+,.0f}元\n"
+    
+    if group['votes']:
+        response += "\n🗳️ 今日結束的投票：\n"
+        for symbol, text in group['votes'].values():
+            response += f"• {symbol} {text}\n"
+    
+    if group['trades']:
+        response += f"\n📝 今日交易（{len(group['trades'])} 筆）：\n"
+        for text in group['trades'][:DIGEST_MAX_TRADES]:
+            response += f"• {text}\n"
+        if len(group['trades']) > DIGEST_MAX_TRADES:
+            response += f"…還有 {len(group['trades']) - DIGEST_MAX_TRADES} 筆\n"
+    
+    return response.rstrip('\n')
+
+def run_daily_digest(dry_run=False, deadline=None):
+    """收盤摘要：持股與交易紀錄各讀一次，所有群組的股票合併後批次查收盤價，逐群組推播"""
+    started_at = time.perf_counter()
+    # 用台北日期：主機是 UTC 時，接近午夜會標錯日期、找錯當天的交易
+    now = taipei_now()
+    today = now.strftime('%Y-%m-%d')
+    
+    # 休市日沒有新的收盤價，也不推播（dry_run 仍照常產生內容方便測試）
+    if not dry_run and not is_trading_day(now.date()):
+        print("💤 今天休市，略過每日摘要")
+        return {"date": today, "groups": 0, "pushed": 0, "skipped": "market_closed"}
+    
+    with start_trace('cron.digest', dry_run=dry_run):
+        trace = TRACE_LOCAL.trace
+        holdings_records = read_all_shard_records('holdings', deadline)
+        transaction_records = read_all_shard_records('transactions', deadline)
+        close_expired_votes()
+        
+        # 所有群組的股票去重後一起查
+        symbols = {}
+        for record in holdings_records + transaction_records:
+            stock_code = str(record.get('股票代號', ''))
+            if stock_code and stock_code not in symbols:
+                cached = STOCK_CACHE.get(stock_code)
+                symbols[stock_code] = cached['market'] if cached else None
+        
+        quotes = {}
+        for stock_code, stock_data in fetch_twse_quote_rows(symbols, deadline).items():
+            previous_close = parse_twse_price(stock_data.get('y'))
+            # 今天沒有成交時收盤價等於昨收
+            close = parse_twse_price(stock_data.get('z')) or previous_close
+            quotes[stock_code] = (close, previous_close)
+            if close > 0:
+                update_leaderboard_price(stock_code, close)
+        
+        groups = build_daily_digests(holdings_records, transaction_records, quotes, today)
+        
+        digests = {}
+        pushed = 0
+        for group_id, group in groups.items():
+            text = render_daily_digest(group, today)
+            if not text:
+                continue
+            digests[group_id] = text
+            # 超過 5 則時分多次推播
+            if not dry_run and send_push_messages(group_id, split_reply_text(text)):
+                pushed += 1
+        
+        upstream_calls = {}
+        for span in trace['spans']:
+            provider = span['attrs'].get('provider')
+            if provider:
+                upstream_calls[provider] = upstream_calls.get(provider, 0) + 1
+    
+    report = {
+        "date": today,
+        "groups": len(digests),
+        "pushed": pushed,
+        "symbols": len(symbols),
+        "quoted": len(quotes),
+        "runtime_ms": round((time.perf_counter() - started_at) * 1000, 1),
+        "upstream_calls": upstream_calls
+    }
+    print(f"📰 每日摘要：{report}")
+    if dry_run:
+        report["digests"] = digests
+    return report
+
+def new_lot_state():
+    """空的批次狀態：positions[群組][使用者][股票] 為未平倉批次，realized[群組][使用者] 依時間排序
+
+    last_time 是已套用交易中最晚的交易時間，之後讀到比它早的交易（補登、匯入歷史）就從頭重播。
+    """
+    return {'version': 2, 'cursor': 0, 'fingerprint': None, 'last_time': '', 'positions': {}, 'realized': {}}
+
+def get_lot_state_path(shard=None):
+    """每個分片各自存一份批次狀態"""
+    if shard is None:
+        return LOT_STATE_PATH
+    root, ext = os.path.splitext(LOT_STATE_PATH)
+    return f"{root}-{shard}{ext}"
+
+def load_lot_state(path=None):
+    """讀取上次存檔的批次狀態，沒有存檔或格式不符時從頭重播"""
+    try:
+        with open(path or LOT_STATE_PATH, encoding='utf-8') as f:
+            state = json.load(f)
+        if isinstance(state, dict) and state.get('version') == 2:
+            return state
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"⚠️ 批次狀態讀取失敗，重新計算: {e}")
+    return new_lot_state()
+
+def save_lot_state(state, path=None):
+    """先寫暫存檔再改名，避免寫到一半的檔案被讀到"""
+    path = path or LOT_STATE_PATH
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"⚠️ 批次狀態存檔失敗: {e}")
+
+def parse_sheet_number(value):
+    """工作表的數字欄位可能帶千分位"""
+    return float(str(value or 0).replace(',', ''))
+
+def apply_ledger_row(state, row):
+    """套用一筆交易紀錄：買入新增批次，賣出依 FIFO 扣除批次並記下兩種成本的已實現損益"""
+    row = list(row) + [''] * (15 - len(row))
+    trade_time, user_id, user_name, stock_code, stock_name, action = row[:6]
+    group_id, status = row[10], row[13]
+    if action not in ('買入', '賣出') or (status and status != '已執行'):
+        return
+    
+    try:
+        shares = int(parse_sheet_number(row[6]))
+        price = parse_sheet_number(row[7])
+    except ValueError:
+        print(f"⚠️ 略過無法解析的交易紀錄: {row[:8]}")
+        return
+    if shares <= 0:
+        return
+    
+    stock_key = stock_code or stock_name
+    user_positions = state['positions'].setdefault(group_id, {}).setdefault(user_id, {})
+    position = user_positions.get(stock_key)
+    
+    if action == '買入':
+        if not position:
+            position = user_positions[stock_key] = {
+                'stock_code': stock_code, 'stock_name': stock_name,
+                'shares': 0, 'cost': 0.0, 'lots': []
+            }
+        position['user_name'] = user_name
+        position['lots'].append([shares, price, trade_time])
+        position['shares'] += shares
+        position['cost'] += shares * price
+        return
+    
+    if not position:
+        print(f"⚠️ 賣出找不到對應的買入批次: {user_name} {stock_key}")
+        return
+    if shares > position['shares']:
+        print(f"⚠️ 賣出股數超過批次剩餘股數: {user_name} {stock_key} {shares} > {position['shares']}")
+        shares = position['shares']
+    
+    # 平均成本：依賣出前的平均成本計算
+    average_cost = position['cost'] / position['shares'] * shares
+    
+    # FIFO：從最早的批次開始扣，只走訪被扣到的批次
+    fifo_cost = 0.0
+    remaining = shares
+    consumed = 0
+    lots = position['lots']
+    while remaining > 0:
+        lot = lots[consumed]
+        used = min(remaining, lot[0])
+        fifo_cost += used * lot[1]
+        lot[0] -= used
+        remaining -= used
+        if lot[0] == 0:
+            consumed += 1
+    del lots[:consumed]
+    
+    position['shares'] -= shares
+    position['cost'] -= average_cost
+    if position['shares'] == 0:
+        del user_positions[stock_key]
+    
+    realized = state['realized'].setdefault(group_id, {}).setdefault(
+        user_id, {'user_name': user_name, 'times': [], 'entries': []}
+    )
+    realized['user_name'] = user_name
+    index = bisect_right(realized['times'], trade_time)
+    realized['times'].insert(index, trade_time)
+    realized['entries'].insert(index, [trade_time, stock_key, stock_name, shares, shares * price, fifo_cost, average_cost])
+
+def get_lot_shard(group_id):
+    """群組的批次狀態屬於哪個分片（未分片或未遷移時為 None）"""
+    if SHARD_MODE == 'off':
+        return None
+    route = get_shard_route(group_id)
+    return route[0] if route else None
+
+def get_lot_last_time(group_id):
+    """批次引擎已套用的最後交易時間"""
+    shard = get_lot_shard(group_id)
+    with LOT_LOCK:
+        if shard not in LOT_STATES:
+            LOT_STATES[shard] = load_lot_state(get_lot_state_path(shard))
+        return LOT_STATES[shard]['last_time']
+
+def reset_lot_state(group_id):
+    """清掉群組所在分片的批次狀態，下次查詢時從頭依交易時間重播"""
+    shard = get_lot_shard(group_id)
+    with LOT_LOCK:
+        LOT_STATES[shard] = new_lot_state()
+        save_lot_state(LOT_STATES[shard], get_lot_state_path(shard))
+    print(f"📒 匯入了較早的交易，批次狀態將重新計算（分片 {shard or '共用'}）")
+
+def apply_ledger_rows(state, rows):
+    """依交易時間（同時間照工作表順序）套用多筆交易紀錄，FIFO 批次才會照時間先後開立與扣除"""
+    for row in sorted(rows, key=lambda row: str(row[0]) if row else ''):
+        apply_ledger_row(state, row)
+        if row and str(row[0]) > state['last_time']:
+            state['last_time'] = str(row[0])
+
+def sync_lot_state(deadline=None, group_id=None):
+    """只讀取游標之後的新交易並套用；工作表被改過（最後處理的那列對不上）或讀到補登的舊交易時從頭重播
+    
+    分片模式下每個分片各有一份狀態，只讀 group_id 所在分片的交易紀錄。
+    """
+    # 還沒有路由（未遷移）的群組用共用表的狀態
+    shard = get_lot_shard(group_id)
+    path = get_lot_state_path(shard)
+    
+    with LOT_LOCK:
+        if shard not in LOT_STATES:
+            LOT_STATES[shard] = load_lot_state(path)
+        sheet = get_group_sheet('transactions', group_id)
+        if not sheet:
+            return LOT_STATES[shard]
+        
+        state = LOT_STATES[shard]
+        # 從最後處理的那一列（或標題列）開始讀，第一列用來核對
+        rows = read_sheet_rows(sheet, state['cursor'] + 1, deadline)
+        if state['fingerprint'] is not None and (not rows or rows[0] != state['fingerprint']):
+            print("⚠️ 交易紀錄已被修改，重新計算所有批次")
+            state = LOT_STATES[shard] = new_lot_state()
+            rows = read_sheet_rows(sheet, 1, deadline)
+        if not rows:
+            return state
+        
+        new_rows = rows[1:]
+        # 新讀到的交易比已套用的還早（補登、匯入歷史）時，批次順序會錯，依交易時間從頭重播
+        if state['last_time'] and any(row and str(row[0]) < state['last_time'] for row in new_rows):
+            print("⚠️ 交易紀錄有補登的舊交易，依交易時間重新計算所有批次")
+            state = LOT_STATES[shard] = new_lot_state()
+            rows = read_sheet_rows(sheet, 1, deadline)
+            new_rows = rows[1:]
+        apply_ledger_rows(state, new_rows)
+        
+        if new_rows or state['fingerprint'] != rows[-1]:
+            state['cursor'] += len(new_rows)
+            state['fingerprint'] = rows[-1]
+            save_lot_state(state, path)
+            if new_rows:
+                print(f"📒 批次引擎套用 {len(new_rows)} 筆新交易（游標 {state['cursor']}）")
+        return state
+
+def query_realized_pnl(state, group_id, user_id, start=None, end=None, stock_keys=None, method=None):
+    """查詢已實現損益：依時間二分搜尋，只走訪期間內的賣出紀錄，回傳各股票小計"""
+    method = method or LOT_METHOD
+    realized = state['realized'].get(group_id, {}).get(user_id)
+    if not realized:
+        return {}
+    
+    times = realized['times']
+    low = bisect_left(times, start) if start else 0
+    high = bisect_right(times, end) if end else len(times)
+    
+    by_stock = {}
+    for trade_time, stock_key, stock_name, shares, proceeds, fifo_cost, average_cost in realized['entries'][low:high]:
+        if stock_keys and stock_key not in stock_keys:
+            continue
+        cost = fifo_cost if method == 'fifo' else average_cost
+        summary = by_stock.setdefault(stock_key, {'stock_name': stock_name, 'shares': 0, 'proceeds': 0.0, 'cost': 0.0})
+        summary['shares'] += shares
+        summary['proceeds'] += proceeds
+        summary['cost'] += cost
+    
+    for summary in by_stock.values():
+        summary['pnl'] = summary['proceeds'] - summary['cost']
+    return by_stock
+
+def query_open_positions(state, group_id, user_id, stock_keys=None, method=None):
+    """未平倉部位與成本（FIFO 為剩餘批次成本合計，平均成本法為均價 × 股數）"""
+    method = method or LOT_METHOD
+    positions = []
+    for stock_key, position in state['positions'].get(group_id, {}).get(user_id, {}).items():
+        if stock_keys and stock_key not in stock_keys:
+            continue
+        if method == 'fifo':
+            cost = sum(lot_shares * lot_price for lot_shares, lot_price, _ in position['lots'])
+        else:
+            cost = position['cost']
+        positions.append({
+            'stock_key': stock_key,
+            'stock_code': position['stock_code'],
+            'stock_name': position['stock_name'],
+            'shares': position['shares'],
+            'cost': cost
+        })
+    return positions
+
+def get_lot_user_name(state, group_id, user_id):
+    """從批次狀態找出使用者名稱"""
+    realized = state['realized'].get(group_id, {}).get(user_id)
+    if realized:
+        return realized['user_name']
+    for position in state['positions'].get(group_id, {}).get(user_id, {}).values():
+        return position.get('user_name', user_id)
+    return user_id
+
+def pnl_symbol(pnl):
+    """損益符號"""
+    if pnl > 0:
+        return "🟢"
+    elif pnl < 0:
+        return "🔴"
+    return "⚪"
+
+def parse_pnl_period(token):
+    """2025年、2025-03、2025-03-15 轉成 (起, 迄) 時間字串；年度要加「年」以免和股票代號混淆"""
+    for date_format, length in (('%Y-%m-%d', 10), ('%Y-%m', 7), ('%Y年', 5)):
+        if len(token) != length:
+            continue
+        try:
+            start = datetime.strptime(token, date_format)
+        except ValueError:
+            return None
+        if length == 10:
+            end = start
+        elif length == 7:
+            end = (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        else:
+            end = start.replace(month=12, day=31)
+        return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d') + ' 23:59:59'
+    return None
+
+def get_pnl_report(user_id, group_id, args, deadline=None):
+    """/損益 報表：已實現（可指定期間、股票）與未實現損益"""
+    try:
+        if not transaction_sheet:
+            return "❌ 無法連接交易紀錄"
+        
+        method = LOT_METHOD
+        periods = []
+        stock_query = None
+        group_wide = False
+        for token in args:
+            if token.lower() == 'fifo' or token == '先進先出':
+                method = 'fifo'
+            elif token in ('平均', '平均成本'):
+                method = 'average'
+            elif token == '全部':
+                group_wide = True
+            elif parse_pnl_period(token):
+                periods.append(parse_pnl_period(token))
+            elif not stock_query:
+                stock_query = token
+            else:
+                return "❌ 損益查詢格式錯誤\n\n" + PNL_USAGE
+        
+        if len(periods) > 2:
+            return "❌ 損益查詢格式錯誤\n\n" + PNL_USAGE
+        start = periods[0][0] if periods else None
+        end = periods[-1][1] if periods else None
+        
+        stock_keys = None
+        if stock_query:
+            stock_info = get_stock_info(stock_query, deadline)
+            stock_keys = {stock_info['code'], stock_info['name']} if stock_info else {stock_query}
+        
+        state = sync_lot_state(deadline, group_id)
+        method_name = '先進先出' if method == 'fifo' else '平均成本'
+        period_text = f"{start} ~ {end[:10]}" if periods else "全部期間"
+        
+        if group_wide:
+            return render_group_pnl(state, group_id, start, end, stock_keys, method, method_name, period_text)
+        
+        realized = query_realized_pnl(state, group_id, user_id, start, end, stock_keys, method)
+        positions = query_open_positions(state, group_id, user_id, stock_keys, method)
+        if not realized and not positions:
+            return f"📊 {period_text}沒有任何損益紀錄"
+        
+        response = f"💹 您的損益（{method_name}）\n"
+        response += f"📅 期間：{period_text}\n"
+        response += f"{'='*25}\n"
+        
+        response += "✅ 已實現損益：\n"
+        total_realized = 0
+        for stock_key, summary in realized.items():
+            pnl = summary['pnl']
+            pnl_pct = (pnl / summary['cost'] * 100) if summary['cost'] > 0 else 0
+            response += f"• {summary['stock_name']}：賣出 {format_shares(summary['shares'])} {pnl_symbol(pnl)} {pnl:+,.0f}元 ({pnl_pct:+.2f}%)\n"
+            total_realized += pnl
+        if realized:
+            response += f"💰 合計：{pnl_symbol(total_realized)} {total_realized:+,.0f}元\n"
+        else:
+            response += "• 期間內沒有賣出\n"
+        
+        if positions:
+            response += "\n📊 未實現損益（目前持有）：\n"
+            prices = get_holding_prices(
+                [{'股票代號': p['stock_code'], '股票名稱': p['stock_name']} for p in positions], deadline
+            )
+            total_unrealized = 0
+            for position, current_price in zip(positions, prices):
+                response += f"• {position['stock_name']}：{format_shares(position['shares'])}，成本 {position['cost']:,.0f}元"
+                if current_price > 0:
+                    pnl = position['shares'] * current_price - position['cost']
+                    pnl_pct = (pnl / position['cost'] * 100) if position['cost'] > 0 else 0
+                    response += f" {pnl_symbol(pnl)} {pnl:+,.0f}元 ({pnl_pct:+.2f}%)"
+                    total_unrealized += pnl
+                else:
+                    response += "（股價暫時無法取得）"
+                response += "\n"
+            response += f"💰 合計：{pnl_symbol(total_unrealized)} {total_unrealized:+,.0f}元"
+        
+        return response.rstrip('\n')
+        
+    except Exception as e:
+        print(f"❌ 查詢損益錯誤: {e}")
+        import traceback
+        print(traceback.format_exc())
+        return f"❌ 查詢損益時發生錯誤: {str(e)}"
+
+def render_group_pnl(state, group_id, start, end, stock_keys, method, method_name, period_text):
+    """群組每位成員的已實現損益（只讀批次狀態，不查股價）"""
+    user_ids = set(state['realized'].get(group_id, {}))
+    rows = []
+    for user_id in user_ids:
+        realized = query_realized_pnl(state, group_id, user_id, start, end, stock_keys, method)
+        if realized:
+            total = sum(summary['pnl'] for summary in realized.values())
+            rows.append((get_lot_user_name(state, group_id, user_id), total))
+    
+    if not rows:
+        return f"📊 群組在{period_text}沒有已實現損益"
+    
+    response = f"💹 群組已實現損益（{method_name}）\n"
+    response += f"📅 期間：{period_text}\n"
+    response += f"{'='*25}\n"
+    group_total = 0
+    for user_name, total in sorted(rows, key=lambda x: x[1], reverse=True):
+        response += f"👤 {user_name}：{pnl_symbol(total)} {total:+,.0f}元\n"
+        group_total += total
+    response += f"{'='*25}\n"
+    response += f"💰 群組合計：{pnl_symbol(group_total)} {group_total:+,.0f}元"
+    return response
+
+def get_public_base_url():
+    """對外網址：PUBLIC_BASE_URL，沒有設定時用 Vercel 提供的正式網域"""
+    base_url = os.environ.get('PUBLIC_BASE_URL')
+    if base_url:
+        return base_url.rstrip('/')
+    host = os.environ.get('VERCEL_PROJECT_PRODUCTION_URL') or os.environ.get('VERCEL_URL')
+    return f"https://{host}" if host else None
+
+def sign_export_params(params):
+    """匯出連結的 HMAC 簽章"""
+    message = '|'.join(str(params.get(field, '')) for field in EXPORT_SIGNED_FIELDS)
+    return hmac.new(EXPORT_SECRET.encode(), message.encode('utf-8'), 'sha256').hexdigest()
+
+def verify_export_params(args):
+    """檢查簽章與期限，通過時回傳參數"""
+    params = {field: args.get(field, '') for field in EXPORT_SIGNED_FIELDS}
+    if not EXPORT_SECRET or not params['g'] or not params['exp'].isdigit():
+        return None
+    if int(params['exp']) < time.time():
+        return None
+    # 用 bytes 比對，sig 含非 ASCII 字元時 compare_digest 才不會拋 TypeError
+    if not hmac.compare_digest(sign_export_params(params).encode(), args.get('sig', '').encode('utf-8')):
+        return None
+    return params
+
+def build_export_url(group_id, user_id, start, end):
+    """產生匯出連結（user_id 為空字串時匯出整個群組）"""
+    params = {
+        'g': group_id,
+        'u': user_id,
+        'from': start or '',
+        'to': end,
+        'exp': str(int(time.time()) + EXPORT_LINK_TTL)
+    }
+    params['sig'] = sign_export_params(params)
+    return f"{get_public_base_url()}/export/transactions.csv?{urlencode(params)}"
+
+def get_export_link(user_id, group_id, args):
+    """/匯出：回覆交易紀錄 CSV 下載連結"""
+    if not EXPORT_SECRET or not get_public_base_url():
+        return "❌ 匯出功能尚未設定（需要 EXPORT_SECRET 與 PUBLIC_BASE_URL）"
+    
+    group_wide = False
+    periods = []
+    for token in args:
+        if token == '全部':
+            group_wide = True
+        elif parse_pnl_period(token):
+            periods.append(parse_pnl_period(token))
+        else:
+            return "❌ 匯出格式錯誤\n\n" + EXPORT_USAGE
+    if len(periods) > 2:
+        return "❌ 匯出格式錯誤\n\n" + EXPORT_USAGE
+    
+    now_text = local_now().strftime('%Y-%m-%d %H:%M:%S')
+    start = periods[0][0] if periods else None
+    end = min(periods[-1][1], now_text) if periods else now_text
+    url = build_export_url(group_id, '' if group_wide else user_id, start, end)
+    
+    period_text = f"{start} ~ {end[:10]}" if periods else f"全部期間（至 {end[:16]}）"
+    return f"""📄 交易紀錄匯出（{'群組全部成員' if group_wide else '個人'}）
+📅 期間：{period_text}
+
+🔗 下載連結：
+{url}
+
+⏰ 連結 {EXPORT_LINK_TTL // 3600} 小時內有效，下載中斷可續傳"""
+
+def iter_sheet_pages(sheet, start_row=2, page_rows=EXPORT_PAGE_ROWS, deadline=None):
+    """分頁讀取工作表（A 到 O 欄的原始值），一次只取 page_rows 列，讀到不足一頁時結束"""
+    while True:
+        if deadline and deadline.expired():
+            raise TimeoutError("時間預算已用完")
+        page = sheet.get(f'A{start_row}:O{start_row + page_rows - 1}', value_render_option='UNFORMATTED_VALUE')
+        if page:
+            yield page
+        if len(page) < page_rows:
+            return
+        start_row += page_rows
+
+def iter_ledger_csv(sheet, params, deadline=None):
+    """篩選交易紀錄並逐頁產生 CSV（bytes，開頭加 BOM 讓 Excel 正確顯示中文）"""
+    import csv
+    import io
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header = SHEET_LAYOUTS['transactions'][1]
+    writer.writerow([header[i] for i in EXPORT_COLUMNS])
+    yield ('\ufeff' + buffer.getvalue()).encode('utf-8')
+    if sheet is None:
+        return
+    
+    for page in iter_sheet_pages(sheet, deadline=deadline):
+        buffer.seek(0)
+        buffer.truncate()
+        for row in page:
+            row = list(row) + [''] * (15 - len(row))
+            if str(row[10]) != params['g'] or (params['u'] and str(row[1]) != params['u']):
+                continue
+            trade_time = str(row[0])
+            if (params['from'] and trade_time < params['from']) or trade_time > params['to']:
+                continue
+            writer.writerow([row[i] for i in EXPORT_COLUMNS])
+        if buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+def spool_chunks(chunks):
+    """把 CSV 寫進暫存檔（小檔在記憶體、大檔寫到 /tmp），回傳 (檔案, 總長度)；記憶體用量不隨匯出筆數增加"""
+    import tempfile
+    
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    try:
+        for chunk in chunks:
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, spool.tell()
+
+def iter_spooled_range(spool, first, length):
+    """從暫存檔的 first 開始分段輸出 length 個位元組，結束後關閉檔案"""
+    try:
+        spool.seek(first)
+        while length > 0:
+            block = spool.read(min(EXPORT_READ_BYTES, length))
+            if not block:
+                return
+            length -= len(block)
+            yield block
+    finally:
+        spool.close()
+
+def prefetch_chunks(chunks, count=2):
+    """先取出前幾段（表頭與第一頁）再送出標頭，開頭就逾時或讀取失敗時還能回錯誤狀態碼
+
+    標頭送出後才逾時就中斷連線（不送結尾的 chunk），用戶端會看到下載失敗而不是不完整的檔案。
+    """
+    head = []
+    for chunk in chunks:
+        head.append(chunk)
+        if len(head) >= count:
+            break
+    
+    def generate():
+        yield from head
+        try:
+            yield from chunks
+        except TimeoutError:
+            print("❌ 匯出下載逾時，中斷連線")
+            raise
+    
+    return generate()
+
+def create_sell_voting(user_id, user_name, group_id, sell_data, deadline=None):
     """創建賣出投票"""
     try:
         if not holdings_sheet:
             return "❌ 無法連接持股資料庫"
         
-        records = holdings_sheet.get_all_records()
+        records = read_group_records('holdings', group_id, deadline)
         user_holding = None
         
         for record in records:
@@ -1358,8 +3894,8 @@ def create_sell_voting(user_id, user_name, group_id, sell_data):
         group_member_count = get_group_member_count(group_id, user_id)
         
         vote_id = str(uuid.uuid4())[:8]
-        current_time = datetime.now()
-        deadline = current_time + timedelta(hours=24)
+        current_time = local_now()
+        vote_deadline = current_time + timedelta(hours=24)
         
         # 處理批次或單一價格
         if sell_data.get('is_batch') and len(sell_data.get('transactions', [])) > 1:
@@ -1374,14 +3910,15 @@ def create_sell_voting(user_id, user_name, group_id, sell_data):
         
         if voting_sheet:
             try:
+                sheet = get_group_sheet('votes', group_id, create=True)
                 vote_data = [
                     vote_id, user_id, user_name, sell_data['stock_code'], sell_data['stock_name'],
                     sell_shares, display_price, group_id, '進行中', 0, 0,
                     current_time.strftime('%Y-%m-%d %H:%M:%S'),
-                    deadline.strftime('%Y-%m-%d %H:%M:%S'),
+                    vote_deadline.strftime('%Y-%m-%d %H:%M:%S'),
                     '', f"群組人數:{group_member_count}|價格詳情:{price_info}|{sell_data.get('note', '')}"
                 ]
-                voting_sheet.append_row(vote_data)
+                append_sheet_row(sheet, vote_data)
             except Exception as e:
                 print(f"記錄投票到 Google Sheets 失敗: {e}")
         
@@ -1394,7 +3931,7 @@ def create_sell_voting(user_id, user_name, group_id, sell_data):
             'shares': sell_shares,
             'price': display_price,
             'price_details': sell_data.get('transactions', [{'shares': sell_shares, 'price': display_price}]),
-            'deadline': deadline,
+            'deadline': vote_deadline,
             'yes_votes': set(),
             'no_votes': set(),
             'voted_users': {},
@@ -1404,6 +3941,7 @@ def create_sell_voting(user_id, user_name, group_id, sell_data):
             'group_member_count': group_member_count,
             'required_votes': 1 if group_member_count == 1 else max(2, group_member_count // 2 + 1)  # 私訊時只需1票
         }
+        bump_reply_version('votes', group_id)
         
         avg_cost = float(user_holding['平均成本'])
         expected_profit = (display_price - avg_cost) * sell_shares
@@ -1427,7 +3965,7 @@ def create_sell_voting(user_id, user_name, group_id, sell_data):
         response += f"""
 📈 平均成本：{avg_cost:.2f}元
 💵 預期損益：{expected_profit:+,.0f}元 ({profit_percentage:+.2f}%)
-⏰ 投票截止：{deadline.strftime('%m/%d %H:%M')}
+⏰ 投票截止：{vote_deadline.strftime('%m/%d %H:%M')}
 
 👥 群組資訊："""
         
@@ -1465,13 +4003,13 @@ def get_group_member_count(group_id, user_id):
             return 1  # 只有發起人自己
         
         if LINE_CHANNEL_ACCESS_TOKEN:
-            from linebot import LineBotApi
             from linebot.exceptions import LineBotApiError
             
-            line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+            line_bot_api = get_line_bot_api()
             
             try:
-                group_member_count = line_bot_api.get_group_members_count(group_id)
+                with trace_span('line.group_members', provider='line', group_id=group_id):
+                    group_member_count = line_bot_api.get_group_members_count(group_id)
                 # 減去機器人自己，只計算真人數量
                 human_count = group_member_count.count - 1
                 return max(1, human_count)  # 至少要有1人（發起人）
@@ -1487,6 +4025,72 @@ def get_group_member_count(group_id, user_id):
         print(f"取得群組成員數錯誤: {e}")
         return 4
 
+def get_line_bot_api():
+    """共用的 LineBotApi 客戶端（第一次使用時建立）"""
+    global LINE_BOT_API
+    if LINE_BOT_API is None:
+        from linebot import LineBotApi
+        LINE_BOT_API = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+    return LINE_BOT_API
+
+def get_user_name(user_id, group_id):
+    """取得使用者顯示名稱（TTL + LRU 快取，過期時才重新查詢）"""
+    key = (group_id, user_id)
+    now = time.time()
+    
+    with PROFILE_CACHE_LOCK:
+        cached = PROFILE_CACHE.get(key)
+        if cached and now - cached['time'] < PROFILE_CACHE_DURATION:
+            PROFILE_CACHE.move_to_end(key)
+            PROFILE_CACHE_STATS['hits'] += 1
+            record_cache_event('profile', 'hit')
+            return cached['name']
+        PROFILE_CACHE_STATS['misses'] += 1
+    record_cache_event('profile', 'miss')
+    
+    started_at = time.time()
+    try:
+        line_bot_api = get_line_bot_api()
+        with trace_span('line.profile', provider='line', user_id=user_id):
+            if group_id != user_id:
+                profile = line_bot_api.get_group_member_profile(group_id, user_id)
+            else:
+                profile = line_bot_api.get_profile(user_id)
+        user_name = profile.display_name
+    except Exception as e:
+        print(f"無法取得使用者名稱: {e}")
+        # 查詢失敗時沿用過期的名稱
+        return cached['name'] if cached else "未知使用者"
+    
+    with PROFILE_CACHE_LOCK:
+        PROFILE_CACHE_STATS['fetches'] += 1
+        PROFILE_CACHE_STATS['fetch_time_total'] += time.time() - started_at
+        PROFILE_CACHE[key] = {'name': user_name, 'time': now}
+        PROFILE_CACHE.move_to_end(key)
+        while len(PROFILE_CACHE) > PROFILE_CACHE_MAX_SIZE:
+            PROFILE_CACHE.popitem(last=False)
+            record_cache_event('profile', 'eviction')
+    
+    return user_name
+
+def get_profile_cache_stats():
+    """名稱快取命中率與省下的 LINE API 時間（以平均查詢耗時估算）"""
+    with PROFILE_CACHE_LOCK:
+        stats = dict(PROFILE_CACHE_STATS)
+        size = len(PROFILE_CACHE)
+    
+    lookups = stats['hits'] + stats['misses']
+    avg_fetch = stats['fetch_time_total'] / stats['fetches'] if stats['fetches'] else 0
+    
+    return {
+        'size': size,
+        'hits': stats['hits'],
+        'misses': stats['misses'],
+        'hit_rate': round(stats['hits'] / lookups, 4) if lookups else 0,
+        'avg_fetch_ms': round(avg_fetch * 1000, 2),
+        'saved_ms': round(stats['hits'] * avg_fetch * 1000, 2)
+    }
+
 def handle_vote(user_id, user_name, group_id, vote_id, vote_type):
     """處理投票"""
     try:
@@ -1498,8 +4102,10 @@ def handle_vote(user_id, user_name, group_id, vote_id, vote_type):
         if vote['status'] != 'active':
             return f"❌ 此投票已結束（狀態：{vote['status']}）"
         
-        if datetime.now() > vote['deadline']:
+        if local_now() > vote['deadline']:
             vote['status'] = 'expired'
+            vote['closed_at'] = vote['deadline']
+            bump_reply_version('votes', vote['group_id'])
             return "❌ 此投票已過期"
         
         if group_id != vote['group_id']:
@@ -1541,6 +4147,7 @@ def handle_vote(user_id, user_name, group_id, vote_id, vote_type):
             response += f"\n\n✅ 投票通過！\n{result}"
         elif no_count >= required:
             vote['status'] = 'rejected'
+            vote['closed_at'] = local_now()
             response += "\n\n❌ 投票已否決，不執行賣出"
         else:
             need_yes = required - yes_count
@@ -1551,6 +4158,8 @@ def handle_vote(user_id, user_name, group_id, vote_id, vote_type):
             if need_no > 0:
                 response += f"\n• 還需 {need_no} 張反對票可否決"
         
+        # 票數或狀態都已更新完才讓快取失效
+        bump_reply_version('votes', group_id)
         return response
         
     except Exception as e:
@@ -1561,7 +4170,9 @@ def execute_sell(vote, vote_id):
     """執行賣出交易"""
     try:
         vote['status'] = 'executed'
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        vote['closed_at'] = local_now()
+        bump_reply_version('votes', vote['group_id'])
+        current_time = vote['closed_at'].strftime('%Y-%m-%d %H:%M:%S')
         
         total_amount = vote['shares'] * vote['price']
         total_profit = (vote['price'] - vote['avg_cost']) * vote['shares']
@@ -1570,6 +4181,7 @@ def execute_sell(vote, vote_id):
         # 記錄到交易紀錄
         if transaction_sheet:
             try:
+                sheet = get_group_sheet('transactions', vote['group_id'], create=True)
                 row_data = [
                     current_time, 
                     str(vote['initiator_id']), 
@@ -1587,7 +4199,7 @@ def execute_sell(vote, vote_id):
                     '已執行',
                     f"實現損益: {total_profit:+,.0f}元"
                 ]
-                transaction_sheet.append_row(row_data)
+                append_sheet_row(sheet, row_data)
                 print(f"✅ 賣出交易已記錄到交易紀錄表")
             except Exception as e:
                 print(f"⚠️ 記錄賣出交易失敗: {e}")
@@ -1633,7 +4245,7 @@ def get_vote_status(vote_id):
         
         vote = active_votes[vote_id]
         
-        time_left = vote['deadline'] - datetime.now()
+        time_left = vote['deadline'] - local_now()
         hours_left = int(time_left.total_seconds() / 3600)
         minutes_left = int((time_left.total_seconds() % 3600) / 60)
         
@@ -1669,8 +4281,8 @@ def list_active_votes(group_id):
         
         for vote_id, vote in active_votes.items():
             if vote['group_id'] == group_id and vote['status'] == 'active':
-                if vote['deadline'] > datetime.now():
-                    time_left = vote['deadline'] - datetime.now()
+                if vote['deadline'] > local_now():
+                    time_left = vote['deadline'] - local_now()
                     hours_left = int(time_left.total_seconds() / 3600)
                     
                     group_votes.append({
@@ -1702,41 +4314,98 @@ def list_active_votes(group_id):
         print(f"列出投票錯誤: {e}")
         return f"❌ 列出投票時發生錯誤: {str(e)}"
 
-def send_reply_message(reply_token, message_text):
-    """發送回覆訊息"""
+def send_reply_message(reply_token, message_text, deadline=None, push_to=None):
+    """發送回覆訊息：長回覆切成多則，前 5 則用回覆、其餘用推播；回覆 token 已過期或失效時全部改用推播（push_to）"""
     if not LINE_CHANNEL_ACCESS_TOKEN:
         print("❌ 沒有 Access Token")
         return False
     
+    messages = build_reply_messages(message_text)
+    if not push_to and len(messages) > LINE_MESSAGES_PER_CALL:
+        # 沒有推播對象時只能送出一次回覆的量
+        print(f"⚠️ 回覆共 {len(messages)} 則，無推播對象，只送出前 {LINE_MESSAGES_PER_CALL} 則")
+        messages = messages[:LINE_MESSAGES_PER_CALL]
+    
+    if deadline and deadline.expired() and push_to:
+        print("⏰ 回覆 token 已逾時，改用推播")
+        return send_push_messages(push_to, messages)
+    
     url = 'https://api.line.me/v2/bot/message/reply'
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
     }
     
-    if len(message_text) > 5000:
-        message_text = message_text[:4997] + "..."
-    
     data = {
         'replyToken': reply_token,
-        'messages': [{
-            'type': 'text',
-            'text': str(message_text)
-        }]
+        'messages': messages[:LINE_MESSAGES_PER_CALL]
     }
     
     try:
-        response = requests.post(url, headers=headers, json=data)
+        response = traced_request('line.reply', 'POST', url, headers=headers, json=data,
+                                  timeout=upstream_timeout(deadline, 10))
         if response.status_code == 200:
-            print("✅ 訊息發送成功")
+            print(f"✅ 訊息發送成功（{len(data['messages'])} 則）")
+            if len(messages) > LINE_MESSAGES_PER_CALL:
+                return send_push_messages(push_to, messages[LINE_MESSAGES_PER_CALL:])
             return True
         else:
             print(f"❌ API 錯誤: {response.status_code} - {response.text}")
+            # 回覆 token 無效（通常是已過期），改用推播
+            if response.status_code == 400 and 'reply token' in response.text.lower() and push_to:
+                return send_push_messages(push_to, messages)
             return False
     except Exception as e:
         print(f"❌ 發送失敗: {e}")
         return False
 
+def send_push_messages(to, messages):
+    """依序推播任意數量的訊息物件，每次呼叫最多 5 則"""
+    sent = True
+    for start in range(0, len(messages), LINE_MESSAGES_PER_CALL):
+        sent = send_push_message(to, messages[start:start + LINE_MESSAGES_PER_CALL]) and sent
+    return sent
+
+def send_push_message(to, message_text):
+    """發送推播訊息（會計入 LINE 訊息額度），message_text 可以是最多 5 則文字或訊息物件的列表"""
+    if not LINE_CHANNEL_ACCESS_TOKEN:
+        print("❌ 沒有 Access Token")
+        return False
+    
+    url = 'https://api.line.me/v2/bot/message/push'
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
+    }
+    
+    texts = message_text if isinstance(message_text, list) else [message_text]
+    messages = []
+    for text in texts[:LINE_MESSAGES_PER_CALL]:
+        if isinstance(text, dict):
+            messages.append(text)
+            continue
+        text = str(text)
+        if len(text) > LINE_TEXT_LIMIT:
+            text = text[:LINE_TEXT_LIMIT - 3] + "..."
+        messages.append({'type': 'text', 'text': text})
+    
+    data = {
+        'to': to,
+        'messages': messages
+    }
+    
+    try:
+        response = traced_request('line.push', 'POST', url, headers=headers, json=data, timeout=10)
+        if response.status_code == 200:
+            print("✅ 推播發送成功")
+            return True
+        else:
+            print(f"❌ 推播 API 錯誤: {response.status_code} - {response.text}")
+            return False
+    except Exception as e:
+        print(f"❌ 推播失敗: {e}")
+        return False
+
 @app.route("/", methods=['GET'])
 def health_check():
     return jsonify({
@@ -1755,57 +4424,87 @@ def health_check():
             "完全動態股票查詢（無預設清單）"
         ],
         "sheets_connected": bool(transaction_sheet and holdings_sheet),
+        "shard_mode": SHARD_MODE,
+        "shard_routes": len(SHARD_ROUTES),
         "environment_vars": {
             "LINE_CHANNEL_ACCESS_TOKEN": bool(LINE_CHANNEL_ACCESS_TOKEN),
             "LINE_CHANNEL_SECRET": bool(LINE_CHANNEL_SECRET),
             "SPREADSHEET_ID": bool(SPREADSHEET_ID),
             "GOOGLE_CREDENTIALS": bool(GOOGLE_CREDENTIALS_JSON)
         },
-        "cache_size": len(STOCK_CACHE)
+        "cache_size": len(STOCK_CACHE),
+        "profile_cache": get_profile_cache_stats(),
+        "seen_events": len(SEEN_EVENTS),
+        "event_queue": get_event_queue_stats()
     })
 
-@app.route("/api/webhook", methods=['POST'])
-def webhook():
-    try:
-        body = request.get_data(as_text=True)
-        events_data = json.loads(body)
-        events = events_data.get('events', [])
+def claim_event(event):
+    """登記事件ID，已處理過（重送）的事件回傳 False"""
+    event_id = event.get('webhookEventId')
+    if not event_id:
+        return True
+    
+    now = time.time()
+    with SEEN_EVENTS_LOCK:
+        # 清掉過期的事件ID（最舊的在前面）
+        while SEEN_EVENTS:
+            oldest_id, seen_at = next(iter(SEEN_EVENTS.items()))
+            if now - seen_at < SEEN_EVENTS_TTL and len(SEEN_EVENTS) < SEEN_EVENTS_MAX_SIZE:
+                break
+            SEEN_EVENTS.popitem(last=False)
         
-        for event in events:
-            event_type = event.get('type')
-            
-            if event_type == 'message' and event.get('message', {}).get('type') == 'text':
-                reply_token = event.get('replyToken')
-                message_text = event.get('message', {}).get('text', '').strip()
-                user_id = event.get('source', {}).get('userId', '')
-                group_id = event.get('source', {}).get('groupId', user_id)
-                
-                # 取得使用者名稱
-                user_name = "未知使用者"
-                try:
-                    from linebot import LineBotApi
-                    line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-                    if group_id != user_id:
-                        profile = line_bot_api.get_group_member_profile(group_id, user_id)
-                    else:
-                        profile = line_bot_api.get_profile(user_id)
-                    user_name = profile.display_name
-                except Exception as e:
-                    print(f"無法取得使用者名稱: {e}")
-                
-                print(f"💬 收到訊息: '{message_text}' 來自: {user_name}")
-                
-                response_text = None
-                
-                # === 處理各種指令 ===
-                
-                # 買入指令
-                if message_text.startswith('/買入'):
-                    buy_data = parse_buy_command(message_text)
-                    if buy_data:
-                        response_text = handle_buy_stock(user_id, user_name, group_id, buy_data)
-                    else:
-                        response_text = """❌ 買入指令格式錯誤
+        if event_id in SEEN_EVENTS:
+            return False
+        SEEN_EVENTS[event_id] = now
+    
+    # 記憶體沒有紀錄的重送事件（可能由其他實例處理過），再查持久層
+    is_redelivery = (event.get('deliveryContext') or {}).get('isRedelivery', False)
+    if is_redelivery and EVENT_DEDUP_SHEET and ensure_google_sheets() and event_sheet:
+        try:
+            if event_sheet.find(str(event_id), in_column=1):
+                return False
+        except Exception as e:
+            print(f"⚠️ 查詢事件紀錄失敗: {e}")
+    
+    return True
+
+def release_event(event):
+    """處理失敗時撤銷登記，讓 LINE 重送的同一事件可以再處理一次"""
+    event_id = event.get('webhookEventId')
+    if not event_id:
+        return
+    with SEEN_EVENTS_LOCK:
+        SEEN_EVENTS.pop(event_id, None)
+
+def record_event(event, message_text):
+    """寫入類指令的事件ID存到持久層"""
+    event_id = event.get('webhookEventId')
+    if not (event_id and EVENT_DEDUP_SHEET):
+        return
+    # 多行指令只要有一行是寫入類就要記錄
+    if not any(line.strip().startswith(WRITE_COMMAND_PREFIXES) for line in message_text.split('\n')):
+        return
+    if not (ensure_google_sheets() and event_sheet):
+        return
+    
+    try:
+        event_sheet.append_row([str(event_id), local_now().strftime('%Y-%m-%d %H:%M:%S'),
+                                message_text.split()[0]])
+    except Exception as e:
+        print(f"⚠️ 記錄事件ID失敗: {e}")
+
+def command_buy(ctx):
+    """/買入：記錄買入交易"""
+    ensure_google_sheets()
+    message_text = ctx['text']
+    user_id = ctx['user_id']
+    group_id = ctx['group_id']
+    buy_data = parse_buy_command(message_text, ctx['deadline'])
+    if buy_data:
+        user_name = get_user_name(user_id, group_id)
+        return handle_buy_stock(user_id, user_name, group_id, buy_data)
+    else:
+        return """❌ 買入指令格式錯誤
 
 ✅ 支援的格式：
 
@@ -1822,13 +4521,18 @@ def webhook():
 • 只寫數字時，小於1000視為張數
 • 支援所有上市櫃股票"""
 
-                # 賣出指令
-                elif message_text.startswith('/賣出'):
-                    sell_data = parse_sell_command(message_text)
-                    if sell_data:
-                        response_text = create_sell_voting(user_id, user_name, group_id, sell_data)
-                    else:
-                        response_text = """❌ 賣出指令格式錯誤
+def command_sell(ctx):
+    """/賣出：發起賣出投票"""
+    ensure_google_sheets()
+    message_text = ctx['text']
+    user_id = ctx['user_id']
+    group_id = ctx['group_id']
+    sell_data = parse_sell_command(message_text, ctx['deadline'])
+    if sell_data:
+        user_name = get_user_name(user_id, group_id)
+        return create_sell_voting(user_id, user_name, group_id, sell_data, ctx['deadline'])
+    else:
+        return """❌ 賣出指令格式錯誤
 
 ✅ 支援的格式：
 
@@ -1840,16 +4544,20 @@ def webhook():
 /賣出 台積電 1張 600元 2張 605元
 /賣出 2330 1 600元 2 605元 分批獲利"""
 
-                # 持股查詢（支援查看他人）
-                elif message_text.startswith('/持股'):
-                    parts = message_text.split()
-                    if len(parts) == 1:
-                        response_text = get_user_holdings(user_id, group_id)
-                    elif len(parts) >= 2:
-                        query = ' '.join(parts[1:])  # 支援多字名稱
-                        response_text = get_user_holdings(user_id, group_id, query)
-                    else:
-                        response_text = """❌ 持股查詢格式錯誤
+def command_holdings(ctx):
+    """/持股：查詢持股（支援查看他人、全部）"""
+    ensure_google_sheets()
+    message_text = ctx['text']
+    user_id = ctx['user_id']
+    group_id = ctx['group_id']
+    parts = message_text.split()
+    if len(parts) == 1:
+        return get_user_holdings(user_id, group_id, deadline=ctx['deadline'])
+    elif len(parts) >= 2:
+        query = ' '.join(parts[1:])  # 支援多字名稱
+        return get_user_holdings(user_id, group_id, query, ctx['deadline'])
+    else:
+        return """❌ 持股查詢格式錯誤
 
 ✅ 支援的格式：
 • /持股 - 查看自己的所有持股
@@ -1857,34 +4565,132 @@ def webhook():
 • /持股 張三 - 查看張三的持股
 • /持股 全部 - 查看群組所有人的持股"""
 
-                # 股價查詢
-                elif message_text.startswith('/股價'):
-                    parts = message_text.split()
-                    if len(parts) >= 2:
-                        stock_input = ' '.join(parts[1:])  # 支援多字股票名稱
-                        print(f"查詢股價: {stock_input}")
-                        
-                        # 取得股票資訊
-                        stock_info = get_stock_info(stock_input)
-                        
-                        if stock_info:
-                            stock_code = stock_info['code']
-                            stock_name = stock_info['name']
-                            market = stock_info['market']
-                            
-                            # 取得股價
-                            price = get_stock_price(stock_code, stock_name, market)
-                            
-                            if price > 0:
-                                market_text = "上市" if market == 'tse' else "上櫃"
-                                response_text = f"""📊 股價查詢結果
+def command_alert(ctx):
+    """/提醒：設定或列出價格提醒"""
+    ensure_google_sheets()
+    if ctx['text'].strip() == '/提醒':
+        return list_price_alerts(ctx['user_id'], ctx['group_id'], ctx['deadline'])
+    
+    alert = parse_alert_command(ctx['text'])
+    if not alert:
+        return """❌ 提醒指令格式錯誤
+
+✅ 支援的格式：
+• /提醒 2330 > 1200 - 漲破 1200 元時通知（>= 含 1200 元）
+• /提醒 台積電 < 900 - 跌破 900 元時通知（<= 含 900 元）
+• /提醒 - 列出自己的提醒
+• /取消提醒 提醒ID - 取消提醒"""
+    
+    stock_input, direction, threshold = alert
+    user_name = get_user_name(ctx['user_id'], ctx['group_id'])
+    return create_price_alert(ctx['user_id'], user_name, ctx['group_id'], stock_input, direction, threshold, ctx['deadline'])
+
+def command_cancel_alert(ctx):
+    """/取消提醒：取消價格提醒"""
+    ensure_google_sheets()
+    parts = ctx['text'].split()
+    if len(parts) != 2:
+        return "❌ 格式錯誤\n正確格式：/取消提醒 提醒ID"
+    return cancel_price_alert(ctx['user_id'], ctx['group_id'], parts[1], ctx['deadline'])
+
+def command_leaderboard(ctx):
+    """/排行：群組績效排行榜"""
+    ensure_google_sheets()
+    return get_leaderboard(ctx['group_id'], ctx['deadline'])
+
+def command_trend(ctx):
+    """/走勢：近 N 個交易日走勢（只讀本機日線）"""
+    parts = ctx['text'].split()
+    if len(parts) < 2 or len(parts) > 3 or (len(parts) == 3 and not parts[2].isdigit()):
+        return """❌ 走勢查詢格式錯誤
+
+✅ 支援的格式：
+• /走勢 2330 - 近 20 個交易日
+• /走勢 2330 60 - 近 60 個交易日"""
+    
+    days = int(parts[2]) if len(parts) == 3 else 20
+    days = max(2, min(days, OHLC_MAX_DAYS))
+    return get_price_trend(parts[1], days)
+
+PNL_USAGE = """✅ 支援的格式：
+• /損益 - 自己的已實現與未實現損益
+• /損益 2025年 - 指定年度（也可用 2025-03、2025-03-15）
+• /損益 2025-01-01 2025-03-31 - 指定期間
+• /損益 台積電 - 指定股票
+• /損益 全部 - 群組每位成員的已實現損益
+• 加上「平均」或「FIFO」切換成本計算方式"""
+
+def command_pnl(ctx):
+    """/損益：已實現／未實現損益（批次成本引擎）"""
+    ensure_google_sheets()
+    args = ctx['text'].split()[1:]
+    return get_pnl_report(ctx['user_id'], ctx['group_id'], args, ctx['deadline'])
+
+EXPORT_USAGE = """✅ 支援的格式：
+• /匯出 - 自己的所有交易
+• /匯出 2025年 - 指定年度（也可用 2025-03、2025-03-15）
+• /匯出 2025-01-01 2025-03-31 - 指定期間
+• /匯出 全部 - 群組所有成員的交易"""
+
+def command_export(ctx):
+    """/匯出：交易紀錄 CSV 下載連結"""
+    args = ctx['text'].split()[1:]
+    return get_export_link(ctx['user_id'], ctx['group_id'], args)
+
+IMPORT_USAGE = """✅ 支援的格式（每行一筆，可直接從試算表貼上）：
+/匯入
+2024-03-05 買入 台積電 2張 580元 長期持有
+2024-05-01 賣出 2330 500股 610
+0050 1000 135.5
+
+💡 提示：
+• 日期可省略（視為今天），也可加時間：2024-03-05 10:30
+• 交易類型可省略（視為買入）
+• 賣出直接記錄，不經投票
+• 任何一行有錯誤時整批不寫入"""
+
+def command_import(ctx):
+    """/匯入：批次匯入歷史交易"""
+    ensure_google_sheets()
+    lines = ctx['text'][3:].split('\n')
+    user_name = get_user_name(ctx['user_id'], ctx['group_id'])
+    return import_trades(ctx['user_id'], user_name, ctx['group_id'], lines, ctx['deadline'])
+
+def command_price(ctx):
+    """/股價：查詢即時股價"""
+    message_text = ctx['text']
+    parts = message_text.split()
+    if len(parts) >= 2:
+        stock_input = ' '.join(parts[1:])  # 支援多字股票名稱
+        print(f"查詢股價: {stock_input}")
+        
+        # 取得股票資訊
+        stock_info = get_stock_info(stock_input, ctx['deadline'])
+        
+        if stock_info:
+            stock_code = stock_info['code']
+            stock_name = stock_info['name']
+            market = stock_info['market']
+            
+            # 取得股價
+            price = get_stock_price(stock_code, stock_name, market, ctx['deadline'])
+            
+            if price > 0:
+                market_text = "上市" if market == 'tse' else "上櫃"
+                session = get_market_session()
+                price_note = ''
+                if is_previous_close_quote(stock_code):
+                    price_note = '（昨收，今日尚無成交）'
+                elif session != 'open':
+                    price_note = '（休市中，最後成交價）'
+                return f"""📊 股價查詢結果
 
 🏢 股票：{stock_name} ({stock_code})
 📍 市場：{market_text}
-💰 目前股價：{price:.2f}元
-⏰ 查詢時間：{datetime.now().strftime('%H:%M:%S')}"""
-                            else:
-                                response_text = f"""❌ 無法取得股價
+💰 目前股價：{price:.2f}元{price_note}
+⏰ 查詢時間：{taipei_now().strftime('%H:%M:%S')}"""
+            else:
+                return f"""❌ 無法取得股價
 
 股票：{stock_name} ({stock_code})
 
@@ -1894,8 +4700,8 @@ def webhook():
 3. 資料來源暫時無法使用
 
 請稍後再試"""
-                        else:
-                            response_text = f"""❌ 找不到股票：{stock_input}
+        else:
+            return f"""❌ 找不到股票：{stock_input}
 
 請確認：
 1. 輸入正確的股票代號（4位數字）
@@ -1904,8 +4710,8 @@ def webhook():
 範例：
 • /股價 2330（代號查詢）
 • /股價 台積電（名稱查詢）"""
-                    else:
-                        response_text = """❌ 請輸入要查詢的股票
+    else:
+        return """❌ 請輸入要查詢的股票
 
 格式：/股價 [股票代號或名稱]
 
@@ -1915,37 +4721,52 @@ def webhook():
 • /股價 3078
 • /股價 波若威"""
 
-                # 投票相關
-                elif message_text.startswith('/贊成'):
-                    parts = message_text.split()
-                    if len(parts) == 2:
-                        vote_id = parts[1]
-                        response_text = handle_vote(user_id, user_name, group_id, vote_id, 'yes')
-                    else:
-                        response_text = "❌ 格式錯誤\n正確格式：/贊成 投票ID"
-
-                elif message_text.startswith('/反對'):
-                    parts = message_text.split()
-                    if len(parts) == 2:
-                        vote_id = parts[1]
-                        response_text = handle_vote(user_id, user_name, group_id, vote_id, 'no')
-                    else:
-                        response_text = "❌ 格式錯誤\n正確格式：/反對 投票ID"
-
-                elif message_text.startswith('/投票狀態'):
-                    parts = message_text.split()
-                    if len(parts) == 2:
-                        vote_id = parts[1]
-                        response_text = get_vote_status(vote_id)
-                    else:
-                        response_text = "❌ 格式錯誤\n正確格式：/投票狀態 投票ID"
-
-                elif message_text == '/投票' or message_text == '/投票清單':
-                    response_text = list_active_votes(group_id)
-
-                # 股票清單
-                elif message_text == '/股票清單':
-                    response_text = """📋 股票查詢說明
+def command_vote_yes(ctx):
+    """/贊成：投贊成票"""
+    ensure_google_sheets()
+    message_text = ctx['text']
+    user_id = ctx['user_id']
+    group_id = ctx['group_id']
+    parts = message_text.split()
+    if len(parts) == 2:
+        vote_id = parts[1]
+        user_name = get_user_name(user_id, group_id)
+        return handle_vote(user_id, user_name, group_id, vote_id, 'yes')
+    else:
+        return "❌ 格式錯誤\n正確格式：/贊成 投票ID"
+
+def command_vote_no(ctx):
+    """/反對：投反對票"""
+    ensure_google_sheets()
+    message_text = ctx['text']
+    user_id = ctx['user_id']
+    group_id = ctx['group_id']
+    parts = message_text.split()
+    if len(parts) == 2:
+        vote_id = parts[1]
+        user_name = get_user_name(user_id, group_id)
+        return handle_vote(user_id, user_name, group_id, vote_id, 'no')
+    else:
+        return "❌ 格式錯誤\n正確格式：/反對 投票ID"
+
+def command_vote_status(ctx):
+    """/投票狀態：查詢投票狀態"""
+    message_text = ctx['text']
+    parts = message_text.split()
+    if len(parts) == 2:
+        vote_id = parts[1]
+        return get_vote_status(vote_id)
+    else:
+        return "❌ 格式錯誤\n正確格式：/投票狀態 投票ID"
+
+def command_list_votes(ctx):
+    """/投票：列出進行中的投票"""
+    group_id = ctx['group_id']
+    return list_active_votes(group_id)
+
+def command_stock_list(ctx):
+    """/股票清單：查詢說明"""
+    return """📋 股票查詢說明
 
 本系統支援所有台灣上市櫃股票！
 
@@ -1973,20 +4794,32 @@ def webhook():
 
 💡 任何台灣股票都可以查詢，不限於上述清單！"""
 
-                # 幫助
-                elif message_text == '/幫助' or message_text == '/help':
-                    response_text = """📚 股票管理機器人使用說明
+def command_help(ctx):
+    """/幫助：使用說明"""
+    return """📚 股票管理機器人使用說明
 
 💰 交易指令：
 • /買入 股票 數量 價格 理由
 • /賣出 股票 數量 價格 [備註]
+• /匯入（換行後每行一筆）- 批次匯入歷史交易
+• 一則訊息可放多行指令，會一起處理並合併回覆
 
 📊 查詢指令：
 • /持股 - 查看自己的所有持股
 • /持股 股票名稱 - 查看自己特定股票
 • /持股 用戶名稱 - 查看他人持股
 • /持股 全部 - 查看群組所有人持股
+• /排行 - 群組績效排行榜
 • /股價 股票名稱 - 查詢即時股價
+• /損益 [期間] [股票] - 已實現／未實現損益
+• /走勢 股票代號 [天數] - 近期日線走勢
+• /匯出 [期間] [全部] - 下載交易紀錄 CSV
+
+⏰ 提醒指令：
+• /提醒 股票 > 價格 - 漲到指定價格時通知
+• /提醒 股票 < 價格 - 跌到指定價格時通知
+• /提醒 - 列出自己的提醒
+• /取消提醒 提醒ID - 取消提醒
 
 🗳️ 投票指令：
 • /贊成 投票ID - 投贊成票
@@ -2005,34 +4838,738 @@ def webhook():
 • 支援批次交易
 • 群組投票決策機制"""
 
-                # 測試
-                elif message_text == '/測試':
-                    test_results = "🤖 系統測試報告：\n\n"
-                    test_results += f"✅ Webhook 連接成功\n"
-                    test_results += f"✅ Google Sheets: {'已連接' if holdings_sheet else '未連接'}\n"
-                    test_results += f"✅ LINE Token: {'已設置' if LINE_CHANNEL_ACCESS_TOKEN else '未設置'}\n"
-                    test_results += f"✅ 快取股票數: {len(STOCK_CACHE)} 支\n"
-                    test_results += f"\n📊 股價測試（台積電 2330）：\n"
-                    
-                    stock_info = get_stock_info('2330')
-                    if stock_info:
-                        test_price = get_stock_price(stock_info['code'], stock_info['name'], stock_info['market'])
-                        if test_price > 0:
-                            test_results += f"✅ 股價抓取成功：{test_price}元\n"
-                        else:
-                            test_results += f"❌ 股價抓取失敗\n"
-                    else:
-                        test_results += f"❌ 無法取得股票資訊\n"
-                    
-                    test_results += f"\n🌐 運行環境：Vercel\n"
-                    test_results += f"⏰ 系統時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                    test_results += f"📦 版本：4.0 (完全動態查詢)"
-                    
-                    response_text = test_results
+def command_test(ctx):
+    """/測試：系統診斷"""
+    ensure_google_sheets()
+    test_results = "🤖 系統測試報告：\n\n"
+    test_results += f"✅ Webhook 連接成功\n"
+    test_results += f"✅ Google Sheets: {'已連接' if holdings_sheet else '未連接'}\n"
+    test_results += f"✅ LINE Token: {'已設置' if LINE_CHANNEL_ACCESS_TOKEN else '未設置'}\n"
+    test_results += f"✅ 快取股票數: {len(STOCK_CACHE)} 支\n"
+    profile_stats = get_profile_cache_stats()
+    test_results += f"✅ 名稱快取: 命中率 {profile_stats['hit_rate']:.0%}，省下 {profile_stats['saved_ms']:.0f}ms\n"
+    test_results += f"\n📊 股價測試（台積電 2330）：\n"
+    
+    stock_info = get_stock_info('2330', ctx['deadline'])
+    if stock_info:
+        test_price = get_stock_price(stock_info['code'], stock_info['name'], stock_info['market'], ctx['deadline'])
+        if test_price > 0:
+            test_results += f"✅ 股價抓取成功：{test_price}元\n"
+        else:
+            test_results += f"❌ 股價抓取失敗\n"
+    else:
+        test_results += f"❌ 無法取得股票資訊\n"
+    
+    test_results += f"\n🌐 運行環境：Vercel\n"
+    test_results += f"⏰ 系統時間：{local_now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+    test_results += f"📦 版本：4.0 (完全動態查詢)"
+    
+    return test_results
+
+def is_command_batch(message_text):
+    """兩行以上且每行都是指令時視為多指令訊息（/匯入 本身就是多行格式）"""
+    lines = [line.strip() for line in message_text.split('\n') if line.strip()]
+    return len(lines) >= 2 and all(line.startswith('/') for line in lines) and not lines[0].startswith('/匯入')
+
+def run_buy_lines(ctx, lines):
+    """連續的 /買入 一起處理：各自解析後合併成一次 commit_trades"""
+    if not (holdings_sheet and transaction_sheet):
+        return "❌ 無法連接持股資料庫"
+    
+    user_name = get_user_name(ctx['user_id'], ctx['group_id'])
+    now = local_now()
+    trades = []
+    errors = []
+    for line_no, line in enumerate(lines, 1):
+        buy_data = parse_buy_command(line, ctx['deadline'])
+        if not buy_data:
+            errors.append(f"「{line}」格式錯誤")
+            continue
+        items = buy_data['transactions'] if buy_data.get('is_batch') else [buy_data]
+        if any(item['shares'] <= 0 or item['price'] <= 0 for item in items):
+            errors.append(f"「{line}」股數與價格必須大於0")
+            continue
+        for i, item in enumerate(items, 1):
+            trade = {
+                'line_no': line_no, 'time': now, 'action': 'buy',
+                'user_id': ctx['user_id'], 'user_name': user_name, 'group_id': ctx['group_id'],
+                'stock_code': buy_data['stock_code'], 'stock_name': buy_data['stock_name'],
+                'shares': item['shares'], 'price': item['price'], 'reason': buy_data['reason']
+            }
+            # 和單則 /買入 的批次買入寫一樣的理由與備註
+            if buy_data.get('is_batch'):
+                trade['reason'] = f"{buy_data.get('reason', '批次買入')} (批次{i}/{len(items)})"
+                trade['note'] = f"批次交易第{i}筆"
+            trades.append(trade)
+    
+    response = ''
+    if trades:
+        changed, trade_errors, writes = commit_trades(ctx['group_id'], trades, ctx['deadline'])
+        if trade_errors:
+            # commit_trades 有錯誤時整批都沒寫入，錯誤訊息的行號換成原本的指令
+            for error in trade_errors:
+                match = re.match(r'第 (\d+) 行：(.*)', error)
+                errors.append(f"「{lines[int(match.group(1)) - 1]}」{match.group(2)}" if match else error)
+            errors.append(f"有錯誤時整批不寫入，這 {len(trades)} 筆買入都沒有記錄，請修正後重新傳送")
+            trades = []
+    if trades:
+        response += f"📈 買入交易已記錄：{len(trades)} 筆\n"
+        for trade in trades:
+            response += (f"• {trade['stock_name']} ({trade['stock_code'] or 'N/A'}) "
+                         f"{format_shares(trade['shares'])} @ {trade['price']:.2f}元\n")
+        response += "\n📊 目前持股：\n" + render_position_changes(changed)
+        response += f"💾 Google Sheets 寫入 {writes} 次"
+    if errors:
+        response += ("\n\n" if response else "") + "❌ 以下買入未記錄：\n" + '\n'.join(f"• {error}" for error in errors)
+    return response
+
+def command_multi(ctx):
+    """多行指令：連續的 /買入 合併寫入，其餘依序執行；共用持股快照，合併成一則回覆"""
+    lines = [line.strip() for line in ctx['text'].split('\n') if line.strip()]
+    if len(lines) > BATCH_MAX_COMMANDS:
+        return f"❌ 一次最多 {BATCH_MAX_COMMANDS} 行指令，請分開傳送"
+    
+    ensure_google_sheets()
+    sections = []
+    with batch_scope():
+        buy_lines = []
+        for index, line in enumerate(lines + [None]):
+            handler = route_command(line) if line else None
+            if handler is command_buy:
+                buy_lines.append(line)
+                continue
+            if buy_lines:
+                try:
+                    sections.append((buy_lines, run_buy_lines(ctx, buy_lines)))
+                except Exception as e:
+                    print(f"❌ 批次買入錯誤: {e}")
+                    sections.append((buy_lines, f"❌ 處理買入時發生錯誤: {str(e)}"))
+                buy_lines = []
+            if line is None:
+                break
+            if handler is None:
+                sections.append(([line], "❓ 無法辨識的指令"))
+                continue
+            try:
+                sections.append(([line], handler(dict(ctx, text=line))))
+            except Exception as e:
+                print(f"❌ 多行指令第 {index + 1} 行錯誤: {e}")
+                sections.append(([line], f"❌ 執行指令時發生錯誤: {str(e)}"))
+    
+    response = f"📦 多指令處理結果（{len(lines)} 行）"
+    for section_lines, section_text in sections:
+        response += f"\n{'='*25}\n"
+        response += '\n'.join(f"▶️ {line}" for line in section_lines)
+        response += f"\n{section_text}"
+    return response
+
+# 可快取回覆的唯讀指令與其依賴的資料範圍
+REPLY_CACHE_SCOPES = {
+    command_holdings: 'holdings',
+    command_list_votes: 'votes',
+    command_vote_status: 'votes'
+}
 
-                # 發送回覆
-                if response_text and reply_token:
-                    send_reply_message(reply_token, response_text)
+# 指令表：完全相符的指令
+EXACT_COMMANDS = {
+    '/投票': command_list_votes,
+    '/投票清單': command_list_votes,
+    '/股票清單': command_stock_list,
+    '/幫助': command_help,
+    '/help': command_help,
+    '/測試': command_test,
+    '/排行': command_leaderboard
+}
+
+# 指令表：前綴指令（長的前綴優先比對，例如 /投票狀態）
+PREFIX_COMMANDS = {
+    '/買入': command_buy,
+    '/賣出': command_sell,
+    '/持股': command_holdings,
+    '/股價': command_price,
+    '/損益': command_pnl,
+    '/走勢': command_trend,
+    '/匯出': command_export,
+    '/匯入': command_import,
+    '/提醒': command_alert,
+    '/取消提醒': command_cancel_alert,
+    '/贊成': command_vote_yes,
+    '/反對': command_vote_no,
+    '/投票狀態': command_vote_status
+}
+PREFIX_LENGTHS = sorted({len(prefix) for prefix in PREFIX_COMMANDS}, reverse=True)
+
+def route_command(message_text):
+    """依指令表找出處理函式，不是指令時回傳 None"""
+    if '\n' in message_text and is_command_batch(message_text):
+        return command_multi
+    
+    handler = EXACT_COMMANDS.get(message_text)
+    if handler:
+        return handler
+    
+    for length in PREFIX_LENGTHS:
+        handler = PREFIX_COMMANDS.get(message_text[:length])
+        if handler:
+            return handler
+    
+    return None
+
+def process_event(event):
+    """處理單一 LINE 事件並回覆"""
+    # 重送的事件直接略過，避免重複交易
+    if not claim_event(event):
+        print(f"♻️ 略過重送事件: {event.get('webhookEventId')}")
+        return
+    
+    # 先登記再處理，同時送達的重複事件不會並行執行；失敗時撤銷登記
+    try:
+        dispatch_event(event)
+    except Exception:
+        release_event(event)
+        raise
+
+def dispatch_event(event):
+    """依事件類型執行對應指令"""
+    event_type = event.get('type')
+    
+    if event_type == 'message' and event.get('message', {}).get('type') == 'text':
+        reply_token = event.get('replyToken')
+        message_text = event.get('message', {}).get('text', '').strip()
+        user_id = event.get('source', {}).get('userId', '')
+        group_id = event.get('source', {}).get('groupId', user_id)
+        
+        handler = route_command(message_text)
+        if not handler:
+            return
+        
+        # 使用者名稱只在交易、投票指令需要時才查詢（有快取）
+        print(f"💬 收到訊息: '{message_text}' 來自: {user_id}")
+        
+        ctx = {
+            'event': event,
+            'text': message_text,
+            'user_id': user_id,
+            'group_id': group_id,
+            'reply_token': reply_token,
+            'deadline': Deadline.for_event(event)
+        }
+        
+        if PROFILING_ENABLED and should_profile_event(ctx):
+            profile_call(handle_command, handler, ctx)
+        else:
+            handle_command(handler, ctx)
+
+def bump_reply_version(scope, group_id):
+    """群組的持股或投票有變動，讓相關的快取回覆失效"""
+    key = (scope, str(group_id))
+    with REPLY_CACHE_LOCK:
+        REPLY_VERSIONS[key] = REPLY_VERSIONS.get(key, 0) + 1
+
+def get_reply_cache_key(handler, ctx):
+    """可快取的唯讀指令回傳快取 key，其他指令回傳 None"""
+    scope = REPLY_CACHE_SCOPES.get(handler)
+    if scope is None or REPLY_CACHE_TTL <= 0:
+        return None
+    
+    text = ' '.join(ctx['text'].split())
+    group_id = ctx['group_id']
+    if scope == 'holdings':
+        # /持股 全部 每個人看到的都一樣，其他查詢依使用者區分
+        user_key = '' if text == '/持股 全部' else ctx['user_id']
+        tick = int(time.time() // QUOTE_CACHE_DURATION)
+    else:
+        # 投票回覆含剩餘分鐘數
+        user_key = ''
+        tick = int(time.time() // 60)
+    
+    with REPLY_CACHE_LOCK:
+        version = REPLY_VERSIONS.get((scope, group_id), 0)
+    return (text, group_id, user_key, version, tick)
+
+def get_cached_reply(key):
+    """取出快取的回覆，沒有或過期時回傳 None"""
+    with REPLY_CACHE_LOCK:
+        entry = REPLY_CACHE.get(key)
+        if entry and time.time() - entry['time'] < REPLY_CACHE_TTL:
+            REPLY_CACHE.move_to_end(key)
+            record_cache_event('reply', 'hit')
+            return entry['text']
+        if entry:
+            del REPLY_CACHE[key]
+            record_cache_event('reply', 'eviction')
+    record_cache_event('reply', 'miss')
+    return None
+
+def store_cached_reply(key, text):
+    """錯誤訊息不快取"""
+    if not text or text.startswith('❌'):
+        return
+    with REPLY_CACHE_LOCK:
+        REPLY_CACHE[key] = {'text': text, 'time': time.time()}
+        REPLY_CACHE.move_to_end(key)
+        while len(REPLY_CACHE) > REPLY_CACHE_MAX_SIZE:
+            REPLY_CACHE.popitem(last=False)
+            record_cache_event('reply', 'eviction')
+
+def handle_command(handler, ctx):
+    """執行指令並回覆（含追蹤）"""
+    message_text = ctx['text']
+    group_id = ctx['group_id']
+    
+    with start_trace('event', command=handler.__name__, group_id=group_id, user_id=ctx['user_id']):
+        record_event(ctx['event'], message_text)
+        
+        with trace_span(f'command.{handler.__name__}', command=handler.__name__.removeprefix('command_'),
+                        text=message_text[:50]) as span:
+            # key 要在執行指令前算好，執行期間有寫入時結果會存到舊版本而不會被讀到
+            cache_key = get_reply_cache_key(handler, ctx)
+            response_text = get_cached_reply(cache_key) if cache_key else None
+            if response_text is None:
+                response_text = handler(ctx)
+                if cache_key:
+                    store_cached_reply(cache_key, response_text)
+            else:
+                span['attrs']['cached'] = True
+        
+        # 發送回覆（回覆 token 失效時改用推播）
+        if response_text and ctx['reply_token']:
+            send_reply_message(ctx['reply_token'], response_text, ctx['deadline'], push_to=group_id)
+
+def should_profile_event(ctx):
+    """PROFILE_EVENTS=1 時全部分析，否則只分析管理員的事件"""
+    return PROFILE_EVENTS or ctx['user_id'] in PROFILE_ADMIN_USER_IDS
+
+def profile_call(func, handler, ctx):
+    """以分析器執行單一事件，結果存到 PROFILE_DIR（同一時間只分析一個事件）"""
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return func(handler, ctx)
+    
+    try:
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+        except OSError as e:
+            print(f"⚠️ 無法建立分析目錄: {e}")
+            return func(handler, ctx)
+        
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{handler.__name__}-{os.urandom(3).hex()}"
+        base_path = os.path.join(PROFILE_DIR, name)
+        
+        if PROFILE_MODE == 'sample':
+            return sample_call(func, (handler, ctx), base_path)
+        
+        import cProfile
+        import pstats
+        import io
+        
+        profiler = cProfile.Profile()
+        started_at = time.perf_counter()
+        try:
+            return profiler.runcall(func, handler, ctx)
+        finally:
+            wall_ms = (time.perf_counter() - started_at) * 1000
+            try:
+                profiler.dump_stats(f"{base_path}.pstats")
+                
+                summary = io.StringIO()
+                summary.write(f"指令: {ctx['text'][:50]}\n牆鐘時間: {wall_ms:.1f} ms\n\n")
+                stats = pstats.Stats(profiler, stream=summary)
+                stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+                stats.sort_stats('tottime').print_stats(PROFILE_TOP_FUNCTIONS)
+                with open(f"{base_path}.txt", 'w', encoding='utf-8') as f:
+                    f.write(summary.getvalue())
+                print(f"🔬 分析結果已存檔: {base_path}.pstats（{wall_ms:.1f} ms）")
+            except OSError as e:
+                print(f"⚠️ 無法寫入分析結果: {e}")
+    finally:
+        PROFILE_LOCK.release()
+
+def sample_call(func, args, base_path):
+    """取樣分析：背景執行緒定期記錄呼叫堆疊，輸出 collapsed stack（可直接畫火焰圖）"""
+    import sys
+    
+    target_id = threading.get_ident()
+    samples = {}
+    done = threading.Event()
+    
+    def sampler():
+        while not done.wait(PROFILE_SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(target_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                samples[key] = samples.get(key, 0) + 1
+    
+    thread = threading.Thread(target=sampler, daemon=True)
+    started_at = time.perf_counter()
+    thread.start()
+    try:
+        return func(*args)
+    finally:
+        done.set()
+        thread.join()
+        wall_ms = (time.perf_counter() - started_at) * 1000
+        
+        try:
+            write_sample_profile(samples, wall_ms, base_path)
+            print(f"🔬 取樣結果已存檔: {base_path}.collapsed（{wall_ms:.1f} ms）")
+        except OSError as e:
+            print(f"⚠️ 無法寫入分析結果: {e}")
+
+def write_sample_profile(samples, wall_ms, base_path):
+    """輸出 collapsed stack 與前幾名函式的摘要"""
+    with open(f"{base_path}.collapsed", 'w', encoding='utf-8') as f:
+        for stack, count in sorted(samples.items()):
+            f.write(f"{stack} {count}\n")
+    
+    # 摘要：每個函式出現在堆疊頂端（self）與堆疊中（total）的取樣數
+    self_counts = {}
+    total_counts = {}
+    for stack, count in samples.items():
+        frames = stack.split(';')
+        self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + count
+        for frame_name in set(frames):
+            total_counts[frame_name] = total_counts.get(frame_name, 0) + count
+    
+    total = sum(samples.values()) or 1
+    with open(f"{base_path}.txt", 'w', encoding='utf-8') as f:
+        f.write(f"牆鐘時間: {wall_ms:.1f} ms，取樣數: {sum(samples.values())}\n\n")
+        f.write("自身時間最多的函式：\n")
+        for frame_name, count in sorted(self_counts.items(), key=lambda x: x[1], reverse=True)[:PROFILE_TOP_FUNCTIONS]:
+            f.write(f"{count / total:7.1%}  {frame_name}\n")
+        f.write("\n累計時間最多的函式：\n")
+        for frame_name, count in sorted(total_counts.items(), key=lambda x: x[1], reverse=True)[:PROFILE_TOP_FUNCTIONS]:
+            f.write(f"{count / total:7.1%}  {frame_name}\n")
+
+def parse_webhook_events(body):
+    """驗證 webhook 內容並取出事件列表，格式錯誤時回傳 None"""
+    try:
+        events_data = json.loads(body)
+    except (TypeError, ValueError):
+        return None
+    
+    if not isinstance(events_data, dict):
+        return None
+    
+    events = events_data.get('events', [])
+    if not isinstance(events, list):
+        return None
+    
+    return [event for event in events if isinstance(event, dict)]
+
+def get_event_executor():
+    """取得事件處理的執行緒池（第一次使用時建立）"""
+    global EVENT_EXECUTOR
+    with EVENT_STATS_LOCK:
+        if EVENT_EXECUTOR is None:
+            from concurrent.futures import ThreadPoolExecutor
+            EVENT_EXECUTOR = ThreadPoolExecutor(max_workers=EVENT_WORKERS,
+                                                thread_name_prefix='event-worker')
+        return EVENT_EXECUTOR
+
+def get_event_source_key(event):
+    """事件來源（群組 / 聊天室 / 使用者），同一來源的事件必須依序處理"""
+    source = event.get('source', {}) or {}
+    return source.get('groupId') or source.get('roomId') or source.get('userId', '')
+
+def group_events_by_source(events):
+    """依來源分組，保留各來源內的原始順序"""
+    batches = {}
+    for event in events:
+        batches.setdefault(get_event_source_key(event), []).append(event)
+    return batches
+
+def submit_source_events(source_key, events, wait=False):
+    """把事件放進來源的佇列；來源閒置時才排一個工作，同一來源同時只有一個工作依序處理
+    
+    工作執行緒不會因為等同一來源而卡住，某個群組大量送事件時其他來源照常處理。
+    wait=True 時回傳每個事件的 Future（同步模式等全部處理完）。
+    """
+    futures = []
+    if wait:
+        from concurrent.futures import Future
+        futures = [Future() for _ in events]
+    enqueued_at = time.time()
+    
+    with EVENT_STATS_LOCK:
+        EVENT_QUEUE_STATS['enqueued'] += len(events)
+        queue = SOURCE_QUEUES.get(source_key)
+        idle = queue is None
+        if idle:
+            queue = SOURCE_QUEUES[source_key] = deque()
+        queue.extend(zip(events, [enqueued_at] * len(events), futures or [None] * len(events)))
+    
+    if idle:
+        get_event_executor().submit(drain_source_queue, source_key)
+    return futures
+
+def drain_source_queue(source_key):
+    """工作執行緒：依序處理來源佇列直到清空，清空時移除該來源（SOURCE_QUEUES 不會無限累積）"""
+    while True:
+        with EVENT_STATS_LOCK:
+            queue = SOURCE_QUEUES[source_key]
+            if not queue:
+                del SOURCE_QUEUES[source_key]
+                return
+            event, enqueued_at, future = queue.popleft()
+            started_at = time.time()
+            queue_latency = started_at - enqueued_at
+            EVENT_QUEUE_STATS['dequeued'] += 1
+            EVENT_QUEUE_STATS['queue_latency_total'] += queue_latency
+            EVENT_QUEUE_STATS['queue_latency_max'] = max(EVENT_QUEUE_STATS['queue_latency_max'], queue_latency)
+            EVENT_QUEUE_STATS['in_flight'] += 1
+        
+        failed = False
+        try:
+            process_event(event)
+        except Exception as e:
+            failed = True
+            if future:
+                future.set_exception(e)
+            else:
+                print(f"❌ 背景事件處理錯誤: {e}")
+                import traceback
+                print(traceback.format_exc())
+        else:
+            if future:
+                future.set_result(None)
+        finally:
+            busy_time = time.time() - started_at
+            with EVENT_STATS_LOCK:
+                EVENT_QUEUE_STATS['in_flight'] -= 1
+                EVENT_QUEUE_STATS['busy_time_total'] += busy_time
+                if failed:
+                    EVENT_QUEUE_STATS['failed'] += 1
+                else:
+                    EVENT_QUEUE_STATS['processed'] += 1
+
+def process_events(events):
+    """同步模式：不同來源並行處理，全部完成後才返回（任一事件失敗時拋出，讓 LINE 重送）"""
+    futures = []
+    for source_key, source_events in group_events_by_source(events).items():
+        futures += submit_source_events(source_key, source_events, wait=True)
+    # 全部處理完才拋出第一個錯誤
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error:
+            raise error
+
+def enqueue_events(events):
+    """依來源分組後放入背景佇列，立即返回"""
+    for source_key, source_events in group_events_by_source(events).items():
+        submit_source_events(source_key, source_events)
+
+def get_event_queue_stats():
+    """事件佇列統計：排隊延遲從取出處理時計算，pending 是各來源佇列中還沒取出的事件"""
+    with EVENT_STATS_LOCK:
+        stats = dict(EVENT_QUEUE_STATS)
+        pending = sum(len(queue) for queue in SOURCE_QUEUES.values())
+        active_sources = len(SOURCE_QUEUES)
+    
+    uptime = max(time.time() - EVENT_STATS_STARTED_AT, 1e-9)
+    dequeued = stats['dequeued']
+    
+    return {
+        'async_mode': ASYNC_WEBHOOK,
+        'workers': EVENT_WORKERS,
+        'enqueued': stats['enqueued'],
+        'processed': stats['processed'],
+        'failed': stats['failed'],
+        'in_flight': stats['in_flight'],
+        'pending': pending,
+        'active_sources': active_sources,
+        'queue_latency_avg_ms': round(stats['queue_latency_total'] / dequeued * 1000, 2) if dequeued else 0,
+        'queue_latency_max_ms': round(stats['queue_latency_max'] * 1000, 2),
+        'worker_utilization': round(stats['busy_time_total'] / (EVENT_WORKERS * uptime), 4)
+    }
+
+def check_debug_auth():
+    """除錯與指標端點需要 DEBUG_TOKEN；未設定時端點不開放"""
+    if not DEBUG_TOKEN:
+        return jsonify({"error": "not found"}), 404
+    
+    token = request.args.get('token') or request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+    if not hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode()):
+        return jsonify({"error": "unauthorized"}), 401
+    return None
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Prometheus 指標（需設定 DEBUG_TOKEN，抓取時帶 Bearer token）"""
+    denied = check_debug_auth()
+    if denied:
+        return denied
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route("/debug/traces", methods=['GET'])
+def debug_traces():
+    """最近最慢的追蹤（需設定 DEBUG_TOKEN）"""
+    denied = check_debug_auth()
+    if denied:
+        return denied
+    
+    limit = request.args.get('limit', 10, type=int)
+    return jsonify({
+        "buffered": len(TRACE_BUFFER),
+        "traces": get_slowest_traces(limit)
+    })
+
+def check_cron_auth():
+    """排程端點需要 CRON_SECRET；未設定時端點不開放"""
+    if not CRON_SECRET:
+        return jsonify({"error": "not found"}), 404
+    
+    token = request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+    if not hmac.compare_digest(token.encode(), CRON_SECRET.encode()):
+        return jsonify({"error": "unauthorized"}), 401
+    return None
+
+@app.route("/cron/ohlc", methods=['GET', 'POST'])
+def cron_ohlc():
+    """收盤後增量更新日線：持股中的股票加上已追蹤的股票"""
+    denied = check_cron_auth()
+    if denied:
+        return denied
+    
+    # 休市日沒有新的日線
+    if not is_trading_day(taipei_now().date()):
+        print("💤 今天休市，略過日線更新")
+        return jsonify({"updated": {}, "failed": [], "skipped": 0, "market": "closed"})
+    
+    deadline = Deadline(time.time() + OHLC_CRON_BUDGET)
+    symbols = set(list_tracked_symbols())
+    names = {}
+    if ensure_google_sheets():
+        try:
+            for record in read_all_shard_records('holdings', deadline):
+                if record.get('股票代號'):
+                    stock_code = str(record['股票代號'])
+                    symbols.add(stock_code)
+                    names[stock_code] = record['股票名稱']
+        except Exception as e:
+            print(f"⚠️ 讀取持股清單失敗: {e}")
+    if names:
+        save_ohlc_names(names)
+    
+    updated = {}
+    failed = []
+    for stock_code in sorted(symbols):
+        if deadline.expired():
+            break
+        cached = STOCK_CACHE.get(stock_code)
+        added = update_daily_bars(stock_code, cached['market'] if cached else None, deadline)
+        if added is None:
+            failed.append(stock_code)
+        else:
+            updated[stock_code] = added
+            # 收盤價順便更新排行榜快照
+            bars = get_daily_bars(stock_code)
+            if bars is not None and len(bars):
+                update_leaderboard_price(stock_code, bars.close[-1])
+    
+    skipped = len(symbols) - len(updated) - len(failed)
+    print(f"📈 日線更新完成：{len(updated)} 支成功，{len(failed)} 支失敗，{skipped} 支未處理")
+    return jsonify({"updated": updated, "failed": failed, "skipped": skipped})
+
+@app.route("/cron/alerts", methods=['GET', 'POST'])
+def cron_alerts():
+    """盤中定期檢查價格提醒（Vercel Cron 或本機排程呼叫）"""
+    denied = check_cron_auth()
+    if denied:
+        return denied
+    
+    if not ensure_google_sheets() or not alert_sheet:
+        return jsonify({"error": "sheets unavailable"}), 503
+    
+    try:
+        return jsonify(run_price_alerts(Deadline(time.time() + ALERT_CRON_BUDGET)))
+    except Exception as e:
+        print(f"❌ 價格提醒檢查失敗: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/cron/digest", methods=['GET', 'POST'])
+def cron_digest():
+    """收盤後推播每日群組摘要（?dry_run=1 只回傳內容不推播）"""
+    denied = check_cron_auth()
+    if denied:
+        return denied
+    
+    if not ensure_google_sheets():
+        return jsonify({"error": "sheets unavailable"}), 503
+    
+    try:
+        dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+        return jsonify(run_daily_digest(dry_run, Deadline(time.time() + DIGEST_CRON_BUDGET)))
+    except Exception as e:
+        print(f"❌ 每日摘要失敗: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/export/transactions.csv", methods=['GET'])
+def export_transactions():
+    """串流下載交易紀錄 CSV（簽章連結），支援 Range 續傳"""
+    params = verify_export_params(request.args)
+    if params is None:
+        return jsonify({"error": "invalid or expired link"}), 403
+    if not ensure_google_sheets():
+        return jsonify({"error": "sheets unavailable"}), 503
+    
+    sheet = get_group_sheet('transactions', params['g'])
+    etag = f'"{request.args["sig"][:32]}"'
+    headers = {
+        'Content-Disposition': 'attachment; filename="transactions.csv"',
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Cache-Control': 'private, no-store'
+    }
+    
+    deadline = Deadline(time.time() + EXPORT_BUDGET)
+    
+    # If-Range 對不上時照一般下載處理；只支援單一範圍
+    match = re.match(r'^bytes=(\d+)-(\d*)$', request.headers.get('Range', ''))
+    if match and request.headers.get('If-Range', etag) == etag:
+        # Content-Range 要有結尾位置，續傳（bytes=N-）得先知道總長度：
+        # 工作表只讀一次、邊讀邊寫進暫存檔，再從起點分段輸出
+        try:
+            spool, total = spool_chunks(iter_ledger_csv(sheet, params, deadline))
+        except TimeoutError:
+            return jsonify({"error": "export timed out"}), 504
+        first = int(match.group(1))
+        last = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+        if first >= total or last < first:
+            spool.close()
+            return Response(status=416, headers={'Content-Range': f'bytes */{total}'})
+        
+        length = last - first + 1
+        headers['Content-Range'] = f'bytes {first}-{last}/{total}'
+        headers['Content-Length'] = str(length)
+        return Response(iter_spooled_range(spool, first, length), status=206, mimetype='text/csv', headers=headers)
+    
+    try:
+        chunks = prefetch_chunks(iter_ledger_csv(sheet, params, deadline))
+    except TimeoutError:
+        return jsonify({"error": "export timed out"}), 504
+    return Response(chunks, mimetype='text/csv', headers=headers)
+
+@app.route("/api/webhook", methods=['POST'])
+def webhook():
+    try:
+        body = request.get_data(as_text=True)
+        events = parse_webhook_events(body)
+        
+        if events is None:
+            print("❌ Webhook 內容格式錯誤")
+            return jsonify({"error": "invalid payload"}), 400
+        
+        # 非同步模式：事件丟到背景執行緒，立即回 200 給 LINE
+        if ASYNC_WEBHOOK:
+            enqueue_events(events)
+            return jsonify({"status": "OK", "queued": len(events)}), 200
+        
+        process_events(events)
         
         return jsonify({"status": "OK"}), 200
         
@@ -0,0 +1,165 @@
+"""群組持股查詢的規模測試
+
+以合成的持股工作表（10 ~ 10,000 筆持股、1 ~ 500 個群組）測量
+/持股、/持股 <名稱>、/持股 全部 的端到端耗時、記憶體高峰、上游呼叫次數
+與回覆長度，輸出 JSON 報告（含 git commit）方便跨版本比較。
+
+用法：
+    python benchmarks/bench_holdings_scaling.py --out scaling.json
+    python benchmarks/bench_holdings_scaling.py --holdings 10 1000 --groups 1 50 --latency-scale 0.01
+    python benchmarks/bench_holdings_scaling.py --compare old.json new.json
+    python benchmarks/bench_holdings_scaling.py --shard-mode group   # 先搬到分片再測
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import webhook  # noqa: E402
+import fakes  # noqa: E402
+
+DEFAULT_HOLDINGS = (10, 100, 1000, 10000)
+DEFAULT_GROUPS = (1, 10, 100, 500)
+HOLDINGS_PER_USER = 3
+
+
+def build_sheet(upstream, holdings, groups):
+    """平均分配到各群組，每位使用者持有 HOLDINGS_PER_USER 支股票；回傳要查詢的群組"""
+    codes = list(fakes.STOCKS)
+    sheet = fakes.FakeWorksheet(upstream, '持股統計', fakes.HOLDINGS_HEADER, webhook)
+    for i in range(holdings):
+        group_id = f'G{i % groups:04d}'
+        user_index = i // (groups * HOLDINGS_PER_USER)
+        code = codes[(i // groups) % len(codes)]
+        name, _, price = fakes.STOCKS[code]
+        sheet.rows.append([
+            f'U{user_index:05d}', f'成員{user_index:05d}', code, name,
+            1000, price, price * 1000, group_id, '2026-01-01 09:00:00', ''
+        ])
+    webhook.holdings_sheet = sheet
+    if webhook.SHARD_MODE != 'off':
+        # 每組規模都換一個新的試算表，再用遷移工具拆成分片
+        webhook.main_spreadsheet = spreadsheet = fakes.FakeSpreadsheet(upstream, webhook)
+        spreadsheet.add(sheet)
+        webhook.route_sheet = spreadsheet.add(
+            fakes.FakeWorksheet(upstream, '分片路由', webhook.ROUTE_SHEET_HEADER, webhook))
+        webhook.SHARD_SHEETS.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            webhook.migrate_to_shards()
+    return 'G0000'
+
+
+def run_command(client, upstream, text, group_id):
+    fakes.clear_caches(webhook)
+    body = json.dumps({'events': [fakes.text_event(text, 'U00000', group_id)]})
+    before = upstream.snapshot()
+    sent_before = len(upstream.session.sent_messages)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = client.post('/api/webhook', data=body)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert response.status_code == 200, response.data
+    calls = upstream.snapshot() - before
+    replies = upstream.session.sent_messages[sent_before:]
+    reply_chars = sum(len(m['text']) for _, body in replies for m in body.get('messages', []))
+    return {
+        'seconds': elapsed,
+        'peak_memory_kb': peak / 1024,
+        'upstream_calls': dict(calls),
+        'line_calls': calls.get('line', 0),
+        'reply_chars': reply_chars,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+
+def compare(old_path, new_path):
+    """比較兩份報告的耗時"""
+    with open(old_path, encoding='utf-8') as f:
+        old = {(r['holdings'], r['groups'], r['command']): r for r in json.load(f)['results']}
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)['results']
+
+    print(f"{'持股數':>8}{'群組數':>6}  {'指令':<10}{'舊(ms)':>10}{'新(ms)':>10}{'變化':>9}")
+    for row in new:
+        key = (row['holdings'], row['groups'], row['command'])
+        if key not in old:
+            continue
+        before, after = old[key]['seconds'] * 1000, row['seconds'] * 1000
+        change = (after - before) / before * 100 if before else 0
+        print(f"{row['holdings']:>8}{row['groups']:>6}  {row['command']:<10}{before:>10.1f}{after:>10.1f}{change:>+8.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--holdings', type=int, nargs='+', default=DEFAULT_HOLDINGS)
+    parser.add_argument('--groups', type=int, nargs='+', default=DEFAULT_GROUPS)
+    parser.add_argument('--latency-scale', type=float, default=0.0, help='上游延遲倍數（0 = 只測 CPU）')
+    parser.add_argument('--shard-mode', choices=('off', 'group', 'bucket'), default='off',
+                        help='分片模式（合成資料會先搬到分片）')
+    parser.add_argument('--out', help='JSON 報告輸出路徑')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='比較兩份報告')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    webhook.ASYNC_WEBHOOK = False
+    webhook.SHARD_MODE = args.shard_mode
+    upstream = fakes.install(webhook, fakes.UpstreamConfig(latency_scale=args.latency_scale))
+    client = webhook.app.test_client()
+
+    results = []
+    print(f"{'持股數':>8}{'群組數':>6}  {'指令':<10}{'耗時(ms)':>10}{'記憶體(KB)':>12}{'上游呼叫':>9}{'回覆字數':>9}")
+    for holdings in args.holdings:
+        for groups in args.groups:
+            if groups > holdings:
+                continue
+            group_id = build_sheet(upstream, holdings, groups)
+            commands = {
+                '/持股': '/持股',
+                '/持股 名稱': '/持股 成員00000',
+                '/持股 全部': '/持股 全部',
+            }
+            for label, text in commands.items():
+                result = run_command(client, upstream, text, group_id)
+                result.update({'holdings': holdings, 'groups': groups, 'command': label})
+                results.append(result)
+                print(f"{holdings:>8}{groups:>6}  {label:<10}{result['seconds'] * 1000:>10.1f}"
+                      f"{result['peak_memory_kb']:>12.0f}{sum(result['upstream_calls'].values()):>9}"
+                      f"{result['reply_chars']:>9}")
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump({
+                'commit': git_commit(),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'latency_scale': args.latency_scale,
+                'shard_mode': args.shard_mode,
+                'results': results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n報告已寫入 {args.out}")
+
+
+if __name__ == '__main__':
+    main()
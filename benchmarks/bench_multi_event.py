@@ -0,0 +1,92 @@
+"""多事件 webhook 基準測試
+
+產生同一次 webhook 內含多個來源、多個事件的合成資料，比較
+逐一處理（EVENT_WORKERS=1）與依來源並行處理的耗時。
+
+用法：
+    python benchmarks/bench_multi_event.py --sources 5 --events 3 --latency 0.2
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import webhook  # noqa: E402
+
+
+def build_payload(sources, events_per_source, round_id=0):
+    """每個群組各送一個慢指令（/持股 全部）加上數個快指令（/幫助）
+
+    每輪的 webhookEventId 都不同，否則第二輪起會被事件去重當成重送而略過。
+    """
+    events = []
+    for i in range(events_per_source):
+        for s in range(sources):
+            text = '/持股 全部' if i == 0 else '/幫助'
+            events.append({
+                'type': 'message',
+                'replyToken': f'token-{s}-{i}',
+                'webhookEventId': f'bench-{round_id}-{s}-{i}',
+                'message': {'type': 'text', 'text': text},
+                'source': {'type': 'group', 'groupId': f'G{s}', 'userId': f'U{s}'}
+            })
+    return {'destination': 'bench', 'events': events}
+
+
+def install_fakes(latency):
+    """以固定延遲取代外部 I/O（LINE 回覆、持股查詢）"""
+    replies = []
+
+    def fake_reply(reply_token, message_text, *args, **kwargs):
+        replies.append((reply_token, time.perf_counter()))
+        return True
+
+    def fake_holdings(user_id, group_id, *args, **kwargs):
+        time.sleep(latency)
+        return f'📊 群組持股總覽 {group_id}'
+
+    webhook.send_reply_message = fake_reply
+    webhook.get_user_holdings = fake_holdings
+    return replies
+
+
+def run(workers, sources, events_per_source, rounds):
+    webhook.EVENT_WORKERS = workers
+    webhook.EVENT_EXECUTOR = None
+    webhook.SEEN_EVENTS.clear()
+    client = webhook.app.test_client()
+
+    timings = []
+    for round_id in range(rounds):
+        body = json.dumps(build_payload(sources, events_per_source, round_id))
+        started = time.perf_counter()
+        response = client.post('/api/webhook', data=body)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.data
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sources', type=int, default=5)
+    parser.add_argument('--events', type=int, default=3, help='每個來源的事件數')
+    parser.add_argument('--latency', type=float, default=0.2, help='慢指令的模擬延遲（秒）')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    webhook.ASYNC_WEBHOOK = False
+    webhook.REPLY_CACHE_TTL = 0  # 關掉回覆快取，每輪都實際執行慢指令
+    install_fakes(args.latency)
+    print(f"事件數：{args.sources * args.events}（{args.sources} 個來源 × {args.events}）")
+    for label, workers in (('逐一處理', 1), ('依來源並行', args.workers)):
+        timings = run(workers, args.sources, args.events, args.rounds)
+        print(f"{label:<8} workers={workers:<3} 平均 {sum(timings) / len(timings) * 1000:8.1f} ms"
+              f"  最慢 {max(timings) * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""指令解析吞吐量基準測試
+
+以實際使用的指令字串（含格式錯誤的指令）測量 route_command 與
+parse_buy_command / parse_sell_command 每秒可處理的數量，並確認格式
+錯誤的指令不會觸發股票查詢。
+
+用法：
+    python benchmarks/bench_parser.py --iterations 20000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import webhook  # noqa: E402
+
+VALID_COMMANDS = [
+    '/買入 台積電 5張 580元 看好AI趨勢',
+    '/買入 2330 500股 580元 技術突破',
+    '/買入 台積電 2張 580元 3張 575元 看好AI趨勢',
+    '/買入 2330 1 580元 2 575元 逢低布局',
+    '/買入 聯發科 3張 1200元',
+    '/買入 波若威 2000股 150.5元 光通訊',
+    '/賣出 台積電 2張 600元',
+    '/賣出 2330 500股 1150元 停損',
+    '/賣出 台積電 1張 600元 2張 605元',
+    '/賣出 2330 1 600元 2 605元 分批獲利',
+]
+
+MALFORMED_COMMANDS = [
+    '/買入 台積電',
+    '/買入 台積電 五張 580元',
+    '/買入 2330 580',
+    '/賣出 2330 全部',
+    '/賣出 台積電 2張',
+]
+
+OTHER_COMMANDS = [
+    '/持股', '/持股 全部', '/持股 台積電', '/股價 2330', '/贊成 a1b2c3d4',
+    '/反對 a1b2c3d4', '/投票狀態 a1b2c3d4', '/投票', '/幫助', '/測試', '大家早安',
+]
+
+STOCKS = {
+    '台積電': {'code': '2330', 'name': '台積電', 'market': 'tse'},
+    '2330': {'code': '2330', 'name': '台積電', 'market': 'tse'},
+    '聯發科': {'code': '2454', 'name': '聯發科', 'market': 'tse'},
+    '波若威': {'code': '3078', 'name': '波若威', 'market': 'otc'},
+}
+
+
+def install_stock_lookup():
+    """以記憶體對照表取代股票查詢，並計算查詢次數"""
+    lookups = []
+
+    def fake_get_stock_info(keyword, *args, **kwargs):
+        lookups.append(keyword)
+        return STOCKS.get(keyword)
+
+    webhook.get_stock_info = fake_get_stock_info
+    return lookups
+
+
+def parse(text):
+    if text.startswith('/買入'):
+        return webhook.parse_buy_command(text)
+    return webhook.parse_sell_command(text)
+
+
+def measure(label, func, corpus, iterations):
+    started = time.perf_counter()
+    for i in range(iterations):
+        func(corpus[i % len(corpus)])
+    elapsed = time.perf_counter() - started
+    print(f"{label:<10} {iterations / elapsed:12,.0f} 次/秒  （每次 {elapsed / iterations * 1e6:6.2f} µs）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    lookups = install_stock_lookup()
+
+    for text in MALFORMED_COMMANDS:
+        assert parse(text) is None, text
+    assert not lookups, f"格式錯誤的指令觸發了股票查詢：{lookups}"
+    print(f"✅ {len(MALFORMED_COMMANDS)} 個格式錯誤的指令都未觸發股票查詢")
+
+    routed = VALID_COMMANDS + MALFORMED_COMMANDS + OTHER_COMMANDS
+    measure('指令路由', webhook.route_command, routed, args.iterations)
+    measure('交易解析', parse, VALID_COMMANDS, args.iterations)
+    measure('錯誤指令', parse, MALFORMED_COMMANDS, args.iterations)
+
+
+if __name__ == '__main__':
+    main()
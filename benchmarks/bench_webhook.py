@@ -0,0 +1,170 @@
+"""離線 webhook 基準測試
+
+以 Flask test client 呼叫 webhook()，所有上游（LINE、Yahoo、mis.twse、
+Google Sheets）都換成 benchmarks/fakes.py 的假服務，可設定延遲與失敗率。
+重播幾種實際的 webhook 內容，輸出每個指令的 p50/p95/p99 延遲與上游呼叫次數。
+
+用法：
+    python benchmarks/bench_webhook.py --iterations 20 --latency-scale 0.1
+    python benchmarks/bench_webhook.py --fail sheets=0.1 --fail yahoo=0.3
+    python benchmarks/bench_webhook.py --warm --json report.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import webhook  # noqa: E402
+import fakes  # noqa: E402
+
+PROVIDERS = ('line', 'yahoo', 'twse', 'sheets')
+BIG_GROUP = 'G-big'
+SMALL_GROUP = 'G-small'
+BIG_GROUP_SIZE = 50
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def seed_big_group(upstream):
+    """50 人的群組，每人持有 2 支股票"""
+    codes = list(fakes.STOCKS)
+    for i in range(BIG_GROUP_SIZE):
+        user_id = f'U{i:03d}'
+        for j in range(2):
+            code = codes[(i + j) % len(codes)]
+            name, _, price = fakes.STOCKS[code]
+            webhook.holdings_sheet.rows.append([
+                user_id, f'成員{i:03d}', code, name, 1000, price, price * 1000,
+                BIG_GROUP, '2026-01-01 09:00:00', ''
+            ])
+
+
+class Runner:
+    """送出 webhook 並記錄延遲、上游呼叫次數"""
+
+    def __init__(self, upstream, warm):
+        self.client = webhook.app.test_client()
+        self.upstream = upstream
+        self.warm = warm
+        self.latencies = defaultdict(list)
+        self.calls = defaultdict(Counter)
+
+    def send(self, label, text, user_id, group_id):
+        if not self.warm:
+            fakes.clear_caches(webhook)
+        body = json.dumps({'destination': 'bench', 'events': [fakes.text_event(text, user_id, group_id)]})
+        before = self.upstream.snapshot()
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = self.client.post('/api/webhook', data=body)
+        elapsed = time.perf_counter() - started
+
+        assert response.status_code == 200, response.data
+        self.latencies[label].append(elapsed)
+        self.calls[label].update(self.upstream.snapshot() - before)
+
+    def last_reply(self):
+        _, body = self.upstream.session.sent_messages[-1]
+        return body['messages'][0]['text']
+
+
+def scenario_buy(runner, i):
+    runner.send('買入', f'/買入 台積電 1張 {1000 + i}元 基準測試', 'U-buyer', SMALL_GROUP)
+
+
+def scenario_batch_buy(runner, i):
+    runner.send('批次買入', '/買入 2454 1張 1200元 2張 1190元 3張 1180元 分批布局', 'U-buyer', SMALL_GROUP)
+
+
+def scenario_sell_vote(runner, i):
+    """先買入確保有持股，再發起賣出並由兩位成員投票通過"""
+    runner.send('買入', '/買入 2317 2張 180元 準備賣出', 'U-seller', SMALL_GROUP)
+    runner.send('賣出投票', '/賣出 2317 1張 190元 獲利了結', 'U-seller', SMALL_GROUP)
+    match = re.search(r'投票ID：(\w+)', runner.last_reply())
+    vote_id = match.group(1) if match else 'missing'
+    runner.send('投票', f'/贊成 {vote_id}', 'U-seller', SMALL_GROUP)
+    runner.send('投票(通過)', f'/贊成 {vote_id}', 'U-voter', SMALL_GROUP)
+
+
+def scenario_group_holdings(runner, i):
+    runner.send('持股 全部', '/持股 全部', 'U000', BIG_GROUP)
+
+
+SCENARIOS = {
+    'buy': scenario_buy,
+    'batch_buy': scenario_batch_buy,
+    'sell_vote': scenario_sell_vote,
+    'group_holdings': scenario_group_holdings,
+}
+
+
+def parse_failures(values):
+    failure_rate = {}
+    for item in values or []:
+        provider, _, rate = item.partition('=')
+        failure_rate[provider] = float(rate)
+    return failure_rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--latency-scale', type=float, default=0.1, help='延遲倍數（1.0 = 接近正式環境）')
+    parser.add_argument('--fail', action='append', metavar='PROVIDER=RATE', help='失敗率，例如 sheets=0.1')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='只跑指定情境')
+    parser.add_argument('--warm', action='store_true', help='保留快取（預設每個請求前清空）')
+    parser.add_argument('--json', help='另存機器可讀的結果')
+    args = parser.parse_args()
+
+    webhook.ASYNC_WEBHOOK = False
+    config = fakes.UpstreamConfig(latency_scale=args.latency_scale, failure_rate=parse_failures(args.fail))
+    upstream = fakes.install(webhook, config, group_sizes={SMALL_GROUP: 3, BIG_GROUP: BIG_GROUP_SIZE})
+    seed_big_group(upstream)
+
+    runner = Runner(upstream, args.warm)
+    for name in args.scenario or SCENARIOS:
+        for i in range(args.iterations):
+            SCENARIOS[name](runner, i)
+
+    report = {}
+    print(f"{'指令':<12}{'次數':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}  每次上游呼叫")
+    for label, values in runner.latencies.items():
+        count = len(values)
+        calls = {p: runner.calls[label][p] / count for p in PROVIDERS}
+        report[label] = {
+            'count': count,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'upstream_calls': calls,
+        }
+        calls_text = ' '.join(f'{p}={c:.1f}' for p, c in calls.items() if c)
+        print(f"{label:<12}{count:>6}{report[label]['p50_ms']:>10.1f}{report[label]['p95_ms']:>10.1f}"
+              f"{report[label]['p99_ms']:>10.1f}  {calls_text}")
+
+    if upstream.failures:
+        print(f"\n注入失敗次數：{dict(upstream.failures)}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'latency_scale': args.latency_scale, 'warm': args.warm, 'commands': report},
+                      f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""冷啟動載入時間檢查
+
+以 `python -X importtime` 載入 api/webhook.py，列出最耗時的模組，並在
+以下情況回傳非 0（CI 的 .github/workflows/import-budget.yml 每次 push 都會執行）：
+  * 載入總時間超過預算
+  * 冷啟動時載入了應該延遲載入的重量級模組
+
+用法：
+    python benchmarks/check_import_budget.py --budget-ms 400 --top 15
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+
+# 這些模組只應該在需要的指令中才載入
+DEFERRED_MODULES = ('requests', 'gspread', 'google.auth', 'linebot', 'numpy')
+
+
+def profile_import(runs):
+    """多次冷啟動取最快的一次，降低雜訊"""
+    best = None
+    env = dict(os.environ)
+    # 不帶任何憑證，確保冷啟動不對外連線
+    for key in ('LINE_CHANNEL_ACCESS_TOKEN', 'LINE_CHANNEL_SECRET', 'SPREADSHEET_ID', 'GOOGLE_CREDENTIALS'):
+        env.pop(key, None)
+
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import webhook'],
+            cwd=API_DIR, env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            sys.stderr.write(result.stderr)
+            raise SystemExit(f"載入 webhook.py 失敗（exit {result.returncode}）")
+
+        modules = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            modules.append((name.strip(), int(self_us), int(cumulative_us)))
+
+        total_us = next((cumulative for name, _, cumulative in modules if name == 'webhook'), 0)
+        if best is None or total_us < best[0]:
+            best = (total_us, modules)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=float(os.environ.get('IMPORT_BUDGET_MS', '400')))
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    total_us, modules = profile_import(args.runs)
+
+    print(f"{'模組':<40} {'自身(ms)':>10} {'累計(ms)':>10}")
+    for name, self_us, cumulative_us in sorted(modules, key=lambda m: m[1], reverse=True)[:args.top]:
+        print(f"{name:<40} {self_us / 1000:>10.1f} {cumulative_us / 1000:>10.1f}")
+
+    total_ms = total_us / 1000
+    print(f"\n冷啟動載入 webhook.py：{total_ms:.1f} ms（預算 {args.budget_ms:.0f} ms）")
+
+    failed = False
+    loaded = {name for name, _, _ in modules}
+    eager = [m for m in DEFERRED_MODULES if m in loaded]
+    if eager:
+        print(f"❌ 冷啟動載入了應延遲載入的模組：{', '.join(eager)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print("❌ 超過載入時間預算")
+        failed = True
+
+    if failed:
+        sys.exit(1)
+    print("✅ 符合冷啟動預算")
+
+
+if __name__ == '__main__':
+    main()
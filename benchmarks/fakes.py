@@ -0,0 +1,409 @@
+"""本機假上游：LINE、Yahoo、mis.twse、Google Sheets
+
+讓 webhook() 可以在沒有網路與憑證的情況下完整執行，用於基準測試。
+每個上游都可設定延遲與失敗率，並記錄呼叫次數。
+
+用法：
+    upstream = fakes.install(webhook, fakes.UpstreamConfig(latency={'yahoo': 0.1}))
+    ...
+    upstream.calls  # {'yahoo': 3, 'sheets': 5, ...}
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+
+# 預設延遲（秒），大約是正式環境觀察到的量級
+DEFAULT_LATENCY = {
+    'yahoo': 0.15,
+    'twse': 0.10,
+    'sheets': 0.30,
+    'line': 0.05,
+}
+
+# Yahoo 日線歷史的天數
+HISTORY_DAYS = 260
+
+STOCKS = {
+    '2330': ('台積電', 'tse', 1000.0),
+    '2454': ('聯發科', 'tse', 1200.0),
+    '2317': ('鴻海', 'tse', 180.0),
+    '2308': ('台達電', 'tse', 350.0),
+    '2303': ('聯電', 'tse', 50.0),
+    '2412': ('中華電', 'tse', 125.0),
+    '2882': ('國泰金', 'tse', 60.0),
+    '2881': ('富邦金', 'tse', 85.0),
+    '2603': ('長榮', 'tse', 200.0),
+    '3008': ('大立光', 'tse', 2500.0),
+    '3078': ('波若威', 'otc', 150.0),
+    '5274': ('信驊', 'otc', 3000.0),
+    '8299': ('群聯', 'otc', 500.0),
+    '6488': ('環球晶', 'otc', 450.0),
+}
+
+
+class UpstreamFailure(Exception):
+    """注入的上游失敗"""
+
+
+class UpstreamConfig:
+    """各上游的延遲（秒）與失敗率（0~1）"""
+
+    def __init__(self, latency=None, failure_rate=None, latency_scale=1.0, seed=42):
+        self.latency = dict(DEFAULT_LATENCY)
+        self.latency.update(latency or {})
+        self.failure_rate = failure_rate or {}
+        self.latency_scale = latency_scale
+        self.random = random.Random(seed)
+
+
+class Upstream:
+    """所有假上游共用的延遲、失敗注入與呼叫計數"""
+
+    def __init__(self, config):
+        self.config = config
+        self.calls = Counter()
+        self.failures = Counter()
+        self.lock = threading.Lock()
+
+    def hit(self, provider):
+        """模擬一次上游呼叫；注入失敗時回傳 False"""
+        with self.lock:
+            self.calls[provider] += 1
+            failed = self.config.random.random() < self.config.failure_rate.get(provider, 0)
+            if failed:
+                self.failures[provider] += 1
+        delay = self.config.latency.get(provider, 0) * self.config.latency_scale
+        if delay:
+            time.sleep(delay)
+        return not failed
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls)
+
+
+class FakeResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self._data = data
+        self.text = json.dumps(data, ensure_ascii=False)
+
+    def json(self):
+        return self._data
+
+
+class FakeHTTPSession:
+    """取代 requests.Session：依網址分派到 Yahoo / TWSE / LINE 假服務"""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.sent_messages = []
+        self.prices = {code: price for code, (_, _, price) in STOCKS.items()}
+
+    def request(self, method, url, params=None, json=None, **kwargs):
+        if 'finance.yahoo.com' in url:
+            return self._yahoo(url, params or {})
+        if 'mis.twse.com.tw' in url:
+            return self._twse(params or {})
+        if 'api.line.me' in url:
+            return self._line(url, json or {})
+        return FakeResponse(404, {})
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _yahoo(self, url, params):
+        if not self.upstream.hit('yahoo'):
+            return FakeResponse(500, {'chart': {'result': None}})
+
+        match = re.search(r'/chart/(\d+)\.(TWO|TW)', url)
+        code = match.group(1) if match else ''
+        if code not in STOCKS:
+            return FakeResponse(404, {'chart': {'result': None}})
+
+        price = self.prices[code]
+        if params.get('interval') == '1d':
+            return FakeResponse(200, {'chart': {'result': [self._yahoo_history(code, price, params)]}})
+        return FakeResponse(200, {'chart': {'result': [{'meta': {'regularMarketPrice': price}}]}})
+
+    def _yahoo_history(self, code, price, params):
+        """產生固定的日線（以目前股價為終點的隨機漫步），period1 有值時只回傳之後的部分"""
+        rnd = random.Random(code)
+        days = HISTORY_DAYS
+        closes = [price]
+        for _ in range(days - 1):
+            closes.append(round(closes[-1] / (1 + rnd.uniform(-0.03, 0.03)), 2))
+        closes.reverse()
+
+        # 以今天（台北時間）往回推的交易日，時間戳記為當天 09:00
+        today = (int(time.time()) + 8 * 3600) // 86400
+        trading_days = []
+        day = today
+        while len(trading_days) < days:
+            if (day + 3) % 7 < 5:
+                trading_days.append(day)
+            day -= 1
+        trading_days.reverse()
+        timestamps = [day * 86400 + 3600 for day in trading_days]
+
+        start = 0
+        if params.get('period1'):
+            start = next((i for i, ts in enumerate(timestamps) if ts >= int(params['period1'])), len(timestamps))
+        quote = {
+            'open': [round(c * 0.995, 2) for c in closes[start:]],
+            'high': [round(c * 1.01, 2) for c in closes[start:]],
+            'low': [round(c * 0.985, 2) for c in closes[start:]],
+            'close': closes[start:],
+            'volume': [rnd.randint(1000, 50000) * 1000 for _ in closes[start:]],
+        }
+        return {'meta': {'regularMarketPrice': price, 'gmtoffset': 8 * 3600},
+                'timestamp': timestamps[start:], 'indicators': {'quote': [quote]}}
+
+    def _twse(self, params):
+        if not self.upstream.hit('twse'):
+            return FakeResponse(500, {})
+
+        rows = []
+        for channel in params.get('ex_ch', '').split('|'):
+            match = re.match(r'(tse|otc)_(\w+)\.tw', channel)
+            if not match:
+                continue
+            market, code = match.groups()
+            if code in STOCKS and STOCKS[code][1] == market:
+                name, _, price = STOCKS[code]
+                rows.append({'c': code, 'n': name, 'ex': market, 'z': f'{price:.2f}',
+                             'y': f'{price * 0.99:.2f}'})
+        return FakeResponse(200, {'msgArray': rows})
+
+    def _line(self, url, body):
+        if not self.upstream.hit('line'):
+            return FakeResponse(500, {'message': 'injected failure'})
+        self.sent_messages.append((url.rsplit('/', 1)[-1], body))
+        return FakeResponse(200, {})
+
+
+class FakeProfile:
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class FakeMemberCount:
+    def __init__(self, count):
+        self.count = count
+
+
+class FakeLineBotApi:
+    """取代 linebot.LineBotApi 的查詢方法"""
+
+    def __init__(self, upstream, group_sizes=None):
+        self.upstream = upstream
+        self.group_sizes = group_sizes or {}
+
+    def _hit(self):
+        if not self.upstream.hit('line'):
+            raise UpstreamFailure('LINE API 注入失敗')
+
+    def get_group_member_profile(self, group_id, user_id):
+        self._hit()
+        return FakeProfile(f'成員{user_id[-3:]}')
+
+    def get_profile(self, user_id):
+        self._hit()
+        return FakeProfile(f'成員{user_id[-3:]}')
+
+    def get_group_members_count(self, group_id):
+        self._hit()
+        # 含機器人自己
+        return FakeMemberCount(self.group_sizes.get(group_id, 4) + 1)
+
+
+def column_index(letters):
+    index = 0
+    for char in letters:
+        index = index * 26 + (ord(char) - ord('A') + 1)
+    return index
+
+
+class FakeWorksheet:
+    """記憶體中的工作表，支援 webhook.py 用到的 gspread 方法"""
+
+    def __init__(self, upstream, title, header, webhook=None):
+        self.upstream = upstream
+        self.title = title
+        self.rows = [list(header)]
+        self.webhook = webhook
+
+    def _call(self, op):
+        """每個 Sheets API 呼叫記一次並加上追蹤 span"""
+        span = (self.webhook.trace_span(f'sheets.{op}', provider='sheets', sheet=self.title)
+                if self.webhook is not None else nullcontext())
+        with span:
+            if not self.upstream.hit('sheets'):
+                raise UpstreamFailure(f'Sheets 注入失敗：{self.title}')
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    def _records(self, rows):
+        header = self.rows[0]
+        return [{key: (row[i] if i < len(row) else '') for i, key in enumerate(header)} for row in rows]
+
+    def get_all_records(self):
+        self._call('get_all_records')
+        return self._records(self.rows[1:])
+
+    def get(self, range_name, **kwargs):
+        """讀取範圍（例如 A5:O 或 A2:O10），和 Sheets API 一樣回傳字串並省略列尾空白"""
+        self._call('get')
+        match = re.match(r'([A-Z]+)(\d+):([A-Z]+)(\d*)$', range_name)
+        first_col, last_col = column_index(match.group(1)) - 1, column_index(match.group(3))
+        first_row = int(match.group(2)) - 1
+        last_row = int(match.group(4)) if match.group(4) else len(self.rows)
+        values = []
+        for row in self.rows[first_row:last_row]:
+            cells = ['' if value is None else str(value) for value in row[first_col:last_col]]
+            while cells and cells[-1] == '':
+                cells.pop()
+            values.append(cells)
+        return values
+
+    def append_row(self, values, **kwargs):
+        self._call('append_row')
+        self.rows.append(list(values))
+
+    def append_rows(self, values, **kwargs):
+        self._call('append_rows')
+        self.rows.extend(list(row) for row in values)
+
+    def _write(self, range_name, values):
+        match = re.match(r'([A-Z]+)(\d+)', range_name)
+        col, row = column_index(match.group(1)) - 1, int(match.group(2)) - 1
+        for r, row_values in enumerate(values):
+            while len(self.rows) <= row + r:
+                self.rows.append([])
+            target = self.rows[row + r]
+            for c, value in enumerate(row_values):
+                while len(target) <= col + c:
+                    target.append('')
+                target[col + c] = value
+
+    def update(self, range_name, values, **kwargs):
+        self._call('update')
+        self._write(range_name, values)
+
+    def batch_update(self, data, **kwargs):
+        self._call('batch_update')
+        for item in data:
+            self._write(item['range'], item['values'])
+
+    def delete_rows(self, start_index, end_index=None):
+        self._call('delete_rows')
+        end_index = end_index or start_index
+        del self.rows[start_index - 1:end_index]
+
+    def find(self, query, in_column=None):
+        self._call('find')
+        for row in self.rows:
+            column = in_column - 1 if in_column else None
+            values = [row[column]] if column is not None and column < len(row) else row
+            if str(query) in [str(value) for value in values]:
+                return True
+        return None
+
+
+class FakeSpreadsheet:
+    """記憶體中的試算表，分片模式會用 worksheet/add_worksheet 開新工作表"""
+
+    def __init__(self, upstream, webhook=None):
+        self.upstream = upstream
+        self.webhook = webhook
+        self.sheets = {}
+
+    def add(self, sheet):
+        self.sheets[sheet.title] = sheet
+        return sheet
+
+    def worksheet(self, title):
+        if title not in self.sheets:
+            raise KeyError(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows=1000, cols=26):
+        sheet = FakeWorksheet(self.upstream, title, [], self.webhook)
+        return self.add(sheet)
+
+
+class FakeSheetsClient:
+    """只支援 open_by_key，每個試算表ID對應一個 FakeSpreadsheet"""
+
+    def __init__(self, upstream, webhook=None):
+        self.upstream = upstream
+        self.webhook = webhook
+        self.spreadsheets = {}
+
+    def open_by_key(self, key):
+        if key not in self.spreadsheets:
+            self.spreadsheets[key] = FakeSpreadsheet(self.upstream, self.webhook)
+        return self.spreadsheets[key]
+
+
+TRANSACTION_HEADER = ['日期時間', '使用者ID', '使用者名稱', '股票代號', '股票名稱', '交易類型', '股數', '單價',
+                      '總金額', '理由', '群組ID', '紀錄ID', '投票ID', '狀態', '備註']
+HOLDINGS_HEADER = ['使用者ID', '使用者名稱', '股票代號', '股票名稱', '總股數', '平均成本', '總成本',
+                   '群組ID', '更新時間', '備註']
+ALERT_HEADER = ['提醒ID', '使用者ID', '使用者名稱', '群組ID', '股票代號', '股票名稱', '市場', '條件', '價格', '狀態',
+                '建立時間', '觸發時間', '觸發價格']
+VOTING_HEADER = ['投票ID', '發起人ID', '發起人名稱', '股票代號', '股票名稱', '賣出股數', '賣出價格', '群組ID',
+                 '投票狀態', '贊成票數', '反對票數', '創建時間', '截止時間', '結果', '備註']
+
+
+def install(webhook, config=None, group_sizes=None):
+    """把假上游接到 webhook 模組上，回傳 Upstream（含呼叫計數）"""
+    upstream = Upstream(config or UpstreamConfig())
+    session = FakeHTTPSession(upstream)
+    upstream.session = session
+
+    webhook.LINE_CHANNEL_ACCESS_TOKEN = 'fake-token'
+    webhook.HTTP_SESSION = session
+    webhook.LINE_BOT_API = FakeLineBotApi(upstream, group_sizes)
+    webhook.transaction_sheet = FakeWorksheet(upstream, '交易紀錄', TRANSACTION_HEADER, webhook)
+    webhook.holdings_sheet = FakeWorksheet(upstream, '持股統計', HOLDINGS_HEADER, webhook)
+    webhook.voting_sheet = FakeWorksheet(upstream, '投票紀錄', VOTING_HEADER, webhook)
+    webhook.alert_sheet = FakeWorksheet(upstream, '價格提醒', ALERT_HEADER, webhook)
+    webhook.sheets_client = FakeSheetsClient(upstream, webhook)
+    webhook.main_spreadsheet = spreadsheet = FakeSpreadsheet(upstream, webhook)
+    for sheet in (webhook.transaction_sheet, webhook.holdings_sheet, webhook.voting_sheet, webhook.alert_sheet):
+        spreadsheet.add(sheet)
+    if webhook.SHARD_MODE != 'off':
+        webhook.route_sheet = spreadsheet.add(FakeWorksheet(upstream, '分片路由', webhook.ROUTE_SHEET_HEADER, webhook))
+    return upstream
+
+
+def clear_caches(webhook):
+    """清空各種記憶體快取，模擬冷快取"""
+    for name in ('STOCK_CACHE', 'CACHE_TIME', 'QUOTE_CACHE', 'PROFILE_CACHE', 'REPLY_CACHE'):
+        cache = getattr(webhook, name, None)
+        if cache is not None:
+            cache.clear()
+
+
+def text_event(text, user_id, group_id, event_id=None):
+    """產生一個 LINE 文字訊息事件"""
+    return {
+        'type': 'message',
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'webhookEventId': event_id or f'ev-{time.time_ns()}-{random.random()}',
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': f'reply-{time.time_ns()}',
+        'message': {'type': 'text', 'id': str(time.time_ns()), 'text': text},
+        'source': {'type': 'group', 'groupId': group_id, 'userId': user_id}
+    }
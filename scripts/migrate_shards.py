@@ -0,0 +1,40 @@
+"""把共用工作表的資料依群組搬到分片
+
+讀取交易紀錄、持股統計、投票紀錄三張共用表，為還沒有路由的群組建立路由，並把分片裡
+還沒有的列寫進所屬分片（每個分片每張表一次寫入）。交易與投票依紀錄ID／投票ID比對，可重複執行：
+啟用 SHARD_MODE 前後都可以跑，部署新版後再跑一次，補上遷移後舊實例寫進共用表的列。
+遷移前，共用表裡有資料的群組繼續讀寫共用表；共用表保留不刪，確認無誤後可自行封存。
+
+用法（環境變數與正式環境相同）：
+    SHARD_MODE=group python scripts/migrate_shards.py --dry-run
+    SHARD_MODE=bucket SHARD_BUCKETS=16 python scripts/migrate_shards.py
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import webhook  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dry-run', action='store_true', help='只列出各群組要搬移的列數，不寫入')
+    args = parser.parse_args()
+
+    if webhook.SHARD_MODE == 'off':
+        sys.exit('❌ 請先設定 SHARD_MODE=group 或 bucket')
+    if not webhook.init_google_sheets():
+        sys.exit('❌ 無法連接 Google Sheets')
+
+    summary = webhook.migrate_to_shards(dry_run=args.dry_run)
+    for group_id, counts in sorted(summary.items()):
+        shard = webhook.get_group_shard(group_id)
+        detail = '、'.join(f"{webhook.SHEET_LAYOUTS[kind][0]} {count} 列" for kind, count in counts.items())
+        print(f"{group_id} -> {shard}：{detail}")
+    print(f"\n{'預計搬移' if args.dry_run else '已搬移'} {len(summary)} 個群組")
+
+
+if __name__ == '__main__':
+    main()
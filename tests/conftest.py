@@ -0,0 +1,34 @@
+"""測試共用設定：直接載入 api/webhook.py，外部服務一律換成 benchmarks/fakes.py 的假上游"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import fakes  # noqa: E402
+import webhook  # noqa: E402
+
+
+@pytest.fixture
+def w(monkeypatch, tmp_path):
+    """接上假上游的 webhook 模組，每個測試都從空的工作表與快取開始"""
+    monkeypatch.setattr(webhook, 'LOT_STATE_PATH', str(tmp_path / 'lots.json'))
+    monkeypatch.setattr(webhook, 'ensure_google_sheets', lambda: True)
+    for name in ('SHARD_ROUTES', 'SHARD_SHEETS', 'SHARD_SPREADSHEETS', 'SHARD_UNMIGRATED',
+                 'LOT_STATES', 'SEEN_EVENTS'):
+        getattr(webhook, name).clear()
+    webhook.SHARD_STATE['loaded_at'] = 0
+    fakes.clear_caches(webhook)
+    fakes.install(webhook, fakes.UpstreamConfig(latency_scale=0))
+    return webhook
+
+
+@pytest.fixture
+def sharded(w, monkeypatch):
+    """分片模式（每個群組一個分片）"""
+    monkeypatch.setattr(w, 'SHARD_MODE', 'group')
+    fakes.install(w, fakes.UpstreamConfig(latency_scale=0))
+    return w
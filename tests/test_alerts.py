@@ -0,0 +1,28 @@
+import pytest
+
+
+def alert_record(condition, price, stock_code='2330'):
+    return {'狀態': '啟用', '條件': condition, '價格': str(price), '股票代號': stock_code, '市場': 'tse'}
+
+
+@pytest.mark.parametrize('text, price, fires', [
+    ('/提醒 2330 > 100', 100, False),
+    ('/提醒 2330 > 100', 100.5, True),
+    ('/提醒 2330 >= 100', 100, True),
+    ('/提醒 2330 < 100', 100, False),
+    ('/提醒 2330 < 100', 99.5, True),
+    ('/提醒 2330 <= 100', 100, True),
+])
+def test_threshold_boundary(w, text, price, fires):
+    _, condition, threshold = w.parse_alert_command(text)
+    index = w.build_alert_index([alert_record(condition, threshold)])
+    assert bool(w.evaluate_alerts(index, {'2330': price})) is fires
+
+
+def test_evaluate_alerts_picks_only_crossed_thresholds(w):
+    records = [alert_record('above', 90), alert_record('above', 100), alert_record('above', 110),
+               alert_record('at_or_below', 100), alert_record('below', 100), alert_record('below', 120)]
+    index = w.build_alert_index(records)
+    rows = sorted(row for row, _, _ in w.evaluate_alerts(index, {'2330': 100}))
+    # 第 2 列是第一筆紀錄
+    assert rows == [2, 5, 7]
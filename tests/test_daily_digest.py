@@ -0,0 +1,18 @@
+from datetime import datetime
+
+
+def test_early_morning_trade_lands_in_todays_digest(w, monkeypatch):
+    # 台北 01:30 是 UTC 前一天 17:30，紀錄與摘要都要用台北日期
+    now = datetime(2026, 10, 20, 1, 30, tzinfo=w.TAIPEI_TZ)
+    monkeypatch.setattr(w, 'taipei_now', lambda: now)
+    monkeypatch.setattr(w, 'local_now', lambda: now.replace(tzinfo=None))
+    ctx = {'text': '/買入 台積電 1張 580元 測試', 'user_id': 'U1', 'group_id': 'G1',
+           'deadline': None, 'event': {}, 'reply_token': None}
+
+    w.route_command(ctx['text'])(ctx)
+
+    assert w.transaction_sheet.rows[-1][0].startswith('2026-10-20 01:30')
+    report = w.run_daily_digest(dry_run=True)
+    assert report['date'] == '2026-10-20'
+    assert '台積電' in report['digests']['G1']
+    assert '今日交易' in report['digests']['G1']
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pytest
+
+
+def event(source, n):
+    return {'source': {'groupId': source}, 'n': n}
+
+
+@pytest.fixture
+def pool(w, monkeypatch):
+    """兩個工作執行緒，事件處理換成可控制的假處理"""
+    monkeypatch.setattr(w, 'EVENT_WORKERS', 2)
+    monkeypatch.setattr(w, 'EVENT_EXECUTOR', None)
+    w.SOURCE_QUEUES.clear()
+    yield w
+    w.get_event_executor().shutdown(wait=True)
+
+
+def test_busy_source_does_not_block_other_sources(pool, monkeypatch):
+    w = pool
+    release = threading.Event()
+    handled = []
+
+    def fake_process(ev):
+        if ev['source']['groupId'] == 'A':
+            release.wait(5)
+        handled.append((ev['source']['groupId'], ev['n']))
+
+    monkeypatch.setattr(w, 'process_event', fake_process)
+    # 同一群組連續送很多次 webhook，不能佔滿所有工作執行緒
+    for n in range(10):
+        w.enqueue_events([event('A', n)])
+    done = w.submit_source_events('B', [event('B', 0)], wait=True)
+
+    done[0].result(timeout=2)
+    assert handled == [('B', 0)]
+
+    release.set()
+    deadline = time.time() + 5
+    while w.SOURCE_QUEUES and time.time() < deadline:
+        time.sleep(0.01)
+    assert [n for source, n in handled if source == 'A'] == list(range(10))
+    assert w.SOURCE_QUEUES == {}
+
+
+def test_sync_mode_waits_and_raises_handler_errors(pool, monkeypatch):
+    w = pool
+    handled = []
+
+    def fake_process(ev):
+        if ev['n'] == 1:
+            raise RuntimeError('boom')
+        handled.append(ev['n'])
+
+    monkeypatch.setattr(w, 'process_event', fake_process)
+    with pytest.raises(RuntimeError):
+        w.process_events([event('A', 0), event('A', 1), event('B', 2)])
+    assert sorted(handled) == [0, 2]
+    assert w.get_event_queue_stats()['failed'] >= 1
+
+
+def test_queue_stats_measure_wait_from_dequeue(pool, monkeypatch):
+    w = pool
+    release = threading.Event()
+    monkeypatch.setattr(w, 'process_event', lambda ev: release.wait(5) if ev['n'] == 0 else time.sleep(0.02))
+    for name in w.EVENT_QUEUE_STATS:
+        monkeypatch.setitem(w.EVENT_QUEUE_STATS, name, 0)
+
+    for n in range(3):
+        w.enqueue_events([event('A', n)])
+    time.sleep(0.05)
+    stats = w.get_event_queue_stats()
+    assert (stats['in_flight'], stats['pending'], stats['active_sources']) == (1, 2, 1)
+
+    release.set()
+    deadline = time.time() + 5
+    while w.SOURCE_QUEUES and time.time() < deadline:
+        time.sleep(0.01)
+    stats = w.get_event_queue_stats()
+    assert (stats['processed'], stats['pending'], stats['active_sources']) == (3, 0, 0)
+    # 後面兩個事件排在第一個後面，排隊時間至少是第一個事件的處理時間
+    assert stats['queue_latency_max_ms'] >= 50
+    busy = w.EVENT_QUEUE_STATS['busy_time_total']
+    assert busy < 0.16  # 若把排隊時間算進忙碌時間會超過 0.2 秒
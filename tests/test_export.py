@@ -0,0 +1,58 @@
+import tracemalloc
+
+import pytest
+
+
+@pytest.fixture
+def export(w, monkeypatch):
+    """回傳 (client, fill)：fill(n) 寫入 n 筆交易並回傳匯出連結"""
+    monkeypatch.setattr(w, 'EXPORT_SECRET', 'test-secret')
+    monkeypatch.setattr(w, 'EXPORT_SPOOL_BYTES', 64 * 1024)
+    monkeypatch.setenv('PUBLIC_BASE_URL', 'https://bot.example.com')
+
+    def fill(n):
+        del w.transaction_sheet.rows[1:]
+        for i in range(n):
+            w.transaction_sheet.rows.append([f'2025-01-{i % 28 + 1:02d} 10:00:00', 'U1', '甲', '2330', '台積電',
+                                             '買入', 1000, 900.5, 900500, '測試,含逗號', 'G1', f'r{i}', '',
+                                             '已執行', ''])
+        url = w.build_export_url('G1', '', None, '2026-01-01 00:00:00')
+        return url.replace('https://bot.example.com', '')
+
+    return w.app.test_client(), fill
+
+
+def test_range_resume_matches_full_download(export):
+    client, fill = export
+    url = fill(3000)
+    full = client.get(url).data
+
+    response = client.get(url, headers={'Range': 'bytes=1000-'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-{len(full) - 1}/{len(full)}'
+    assert response.data == full[1000:]
+
+    assert client.get(url, headers={'Range': 'bytes=10-19'}).data == full[10:20]
+    assert client.get(url, headers={'Range': f'bytes={len(full)}-'}).status_code == 416
+
+
+def test_range_resume_does_not_hold_the_csv_in_memory(export):
+    client, fill = export
+    url = fill(20000)
+
+    tracemalloc.start()
+    response = client.get(url, headers={'Range': 'bytes=100-'}, buffered=False)
+    size = sum(len(block) for block in response.response)
+    response.close()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # 整份放進記憶體的話尖峰至少是 CSV 本身的大小
+    assert size > 1024 * 1024
+    assert peak < size
+
+
+def test_non_ascii_signature_is_rejected(export):
+    client, fill = export
+    url = fill(1)
+    assert client.get(url.replace('sig=', 'sig=%E4%B8%AD')).status_code == 403
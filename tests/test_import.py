@@ -0,0 +1,34 @@
+from datetime import datetime
+
+
+def run(w, text, user_id='U1', group_id='G1'):
+    ctx = {'text': text, 'user_id': user_id, 'group_id': group_id,
+           'deadline': None, 'event': {}, 'reply_token': None}
+    return w.route_command(text)(ctx)
+
+
+def test_backdated_import_resets_lot_state(w, monkeypatch):
+    monkeypatch.setattr(w, 'local_now', lambda: datetime(2025, 3, 3, 10, 0))
+    run(w, '/買入 台積電 1張 200元')
+    assert w.sync_lot_state()['last_time'] == '2025-03-03 10:00:00'
+
+    reply = run(w, '/匯入\n2025-01-02 買入 台積電 1張 100元\n2025-03-02 賣出 台積電 1張 250元')
+
+    assert not reply.startswith('❌'), reply
+    assert w.LOT_STATES[None]['last_time'] == ''
+    state = w.sync_lot_state()
+    realized = w.query_realized_pnl(state, 'G1', 'U1', method='fifo')['2330']
+    assert realized['pnl'] == 1000 * (250 - 100)
+
+
+def test_multi_line_batch_buy_writes_same_ledger_notes(w):
+    run(w, '/買入 2454 2張 1100元 1張 1090元')
+    single = [(row[9], row[14]) for row in w.transaction_sheet.rows[1:]]
+    del w.transaction_sheet.rows[1:]
+
+    run(w, '/買入 2454 2張 1100元 1張 1090元\n/買入 台積電 1張 580元')
+    multi = [(row[9], row[14]) for row in w.transaction_sheet.rows[1:]]
+
+    assert single == [(reason, note) for reason, note in multi[:2]]
+    assert [note for _, note in single] == ['批次交易第1筆', '批次交易第2筆']
+    assert multi[2][1] == ''
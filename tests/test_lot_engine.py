@@ -0,0 +1,71 @@
+def row(when, action, shares, price, user_id='U1', group_id='G1', stock_code='2330'):
+    return [when, user_id, '甲', stock_code, '台積電', action, shares, price, shares * price,
+            '', group_id, f'r-{when}', '', '已執行', '']
+
+
+def add(w, *rows):
+    w.transaction_sheet.rows.extend(rows)
+
+
+def pnl(w, state, method):
+    return w.query_realized_pnl(state, 'G1', 'U1', method=method)['2330']['pnl']
+
+
+def test_fifo_and_average_cost(w):
+    add(w, row('2025-01-02 09:00:00', '買入', 1000, 100),
+        row('2025-01-03 09:00:00', '買入', 1000, 200),
+        row('2025-01-04 09:00:00', '賣出', 1000, 250))
+
+    state = w.sync_lot_state()
+
+    assert pnl(w, state, 'fifo') == 1000 * (250 - 100)
+    assert pnl(w, state, 'average') == 1000 * (250 - 150)
+
+
+def test_partial_consume_keeps_remaining_lot(w):
+    add(w, row('2025-01-02 09:00:00', '買入', 1000, 100),
+        row('2025-01-03 09:00:00', '買入', 1000, 200),
+        row('2025-01-04 09:00:00', '賣出', 1500, 300))
+
+    state = w.sync_lot_state()
+
+    assert pnl(w, state, 'fifo') == 1000 * 200 + 500 * 100
+    position = state['positions']['G1']['U1']['2330']
+    assert position['shares'] == 500
+    assert [lot[:2] for lot in position['lots']] == [[500, 200]]
+
+
+def test_incremental_sync_only_reads_new_rows(w):
+    add(w, row('2025-01-02 09:00:00', '買入', 1000, 100))
+    w.sync_lot_state()
+    add(w, row('2025-01-03 09:00:00', '賣出', 400, 150))
+
+    state = w.sync_lot_state()
+
+    assert state['cursor'] == 2
+    assert pnl(w, state, 'fifo') == 400 * 50
+
+
+def test_fingerprint_mismatch_replays_from_start(w):
+    add(w, row('2025-01-02 09:00:00', '買入', 1000, 100),
+        row('2025-01-03 09:00:00', '賣出', 1000, 150))
+    w.sync_lot_state()
+
+    # 有人直接改了工作表裡已處理過的列
+    w.transaction_sheet.rows[2][7] = 120
+    state = w.sync_lot_state()
+
+    assert pnl(w, state, 'fifo') == 1000 * 20
+
+
+def test_backdated_rows_replay_in_trade_time_order(w):
+    add(w, row('2025-03-01 09:00:00', '買入', 1000, 200))
+    w.sync_lot_state()
+
+    # 之後才匯入更早的買入與一筆賣出：FIFO 要先扣 1 月的批次
+    add(w, row('2025-01-02 09:00:00', '買入', 1000, 100),
+        row('2025-04-01 09:00:00', '賣出', 1000, 250))
+    state = w.sync_lot_state()
+
+    assert pnl(w, state, 'fifo') == 1000 * (250 - 100)
+    assert [lot[:2] for lot in state['positions']['G1']['U1']['2330']['lots']] == [[1000, 200]]
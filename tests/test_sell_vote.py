@@ -0,0 +1,19 @@
+import time
+from datetime import datetime, timedelta
+
+
+def test_vote_deadline_is_separate_from_request_deadline(w, monkeypatch):
+    now = datetime(2025, 3, 3, 10, 0)
+    monkeypatch.setattr(w, 'local_now', lambda: now)
+    ctx = {'text': '/買入 台積電 1張 100元', 'user_id': 'U1', 'group_id': 'G1',
+           'deadline': None, 'event': {}, 'reply_token': None}
+    w.route_command(ctx['text'])(ctx)
+
+    request_deadline = w.Deadline(time.time() + 5)
+    reply = w.create_sell_voting('U1', '甲', 'G1', {'stock_code': '2330', 'stock_name': '台積電',
+                                                     'shares': 1000, 'price': 120}, request_deadline)
+
+    assert not reply.startswith('❌'), reply
+    vote = w.active_votes[w.voting_sheet.rows[-1][0]]
+    assert vote['deadline'] == now + timedelta(hours=24)
+    assert w.voting_sheet.rows[-1][12] == '2025-03-04 10:00:00'
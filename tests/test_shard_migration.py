@@ -0,0 +1,100 @@
+from datetime import datetime
+
+
+def ledger_row(record_id, action, shares, price, group_id='G1', user_id='U1', when='2025-01-02 09:00:00'):
+    return [when, user_id, '甲', '2330', '台積電', action, shares, price, shares * price,
+            '', group_id, record_id, '', '已執行', '']
+
+
+def holding(sheet, user_id='U1', stock_code='2330'):
+    return [row for row in sheet.rows[1:] if row[0] == user_id and str(row[2]) == stock_code]
+
+
+def buy(w, group_id, shares, price, when):
+    trade = {'line_no': 1, 'time': when, 'action': 'buy', 'user_id': 'U1', 'user_name': '甲',
+             'group_id': group_id, 'stock_code': '2330', 'stock_name': '台積電',
+             'shares': shares, 'price': price}
+    changed, errors, _ = w.commit_trades(group_id, [trade])
+    assert not errors
+
+
+def shard_sheets(w, group_id):
+    return w.open_shard_sheets(w.SHARD_ROUTES[group_id])
+
+
+def test_unmigrated_group_keeps_using_shared_sheets(sharded):
+    w = sharded
+    w.holdings_sheet.rows.append(['U1', '甲', '2330', '台積電', 1000, 900, 900000, 'G1', '', ''])
+    w.transaction_sheet.rows.append(ledger_row('r1', '買入', 1000, 900))
+
+    assert w.get_group_sheet('holdings', 'G1') is w.holdings_sheet
+    buy(w, 'G1', 1000, 1000, datetime(2025, 2, 3, 10, 0))
+
+    assert 'G1' not in w.SHARD_ROUTES
+    assert int(holding(w.holdings_sheet)[0][4]) == 2000
+
+
+def test_new_group_gets_a_route_on_first_write(sharded):
+    w = sharded
+    buy(w, 'G2', 1000, 500, datetime(2025, 2, 3, 10, 0))
+
+    assert 'G2' in w.SHARD_ROUTES
+    assert int(holding(shard_sheets(w, 'G2')['holdings'])[0][4]) == 1000
+    assert len(w.transaction_sheet.rows) == 1
+
+
+def test_history_moves_when_route_was_created_before_migration(sharded):
+    w = sharded
+    w.holdings_sheet.rows.append(['U1', '甲', '2330', '台積電', 1000, 900, 900000, 'G1', '', ''])
+    w.transaction_sheet.rows.append(ledger_row('r1', '買入', 1000, 900))
+    w.voting_sheet.rows.append(['v1', 'U1', '甲', '2330', '台積電', 500, 950, 'G1', '已結束',
+                                0, 0, '', '', '', ''])
+
+    # 舊版在遷移前就為群組開了分片，之後的交易寫在分片
+    w.create_shard_route('G1')
+    buy(w, 'G1', 500, 1000, datetime(2025, 2, 3, 10, 0))
+    sheets = shard_sheets(w, 'G1')
+
+    summary = w.migrate_to_shards()
+
+    assert summary['G1'] == {'transactions': 1, 'votes': 1}
+    assert {row[11] for row in sheets['transactions'].rows[1:]} >= {'r1'}
+    assert len(sheets['transactions'].rows) == 3
+    assert len(sheets['votes'].rows) == 2
+    position = holding(sheets['holdings'])
+    assert len(position) == 1
+    assert int(position[0][4]) == 1500
+    assert float(position[0][6]) == 1400000
+
+    # 重跑不會重複搬
+    assert w.migrate_to_shards() == {}
+    assert len(sheets['transactions'].rows) == 3
+    assert int(holding(sheets['holdings'])[0][4]) == 1500
+
+
+def test_rerun_picks_up_rows_written_after_migration(sharded):
+    w = sharded
+    w.holdings_sheet.rows.append(['U1', '甲', '2330', '台積電', 1000, 900, 900000, 'G1', '', ''])
+    w.transaction_sheet.rows.append(ledger_row('r1', '買入', 1000, 900))
+
+    assert w.migrate_to_shards(dry_run=True) == {'G1': {'transactions': 1, 'holdings': 1}}
+    w.migrate_to_shards()
+    sheets = shard_sheets(w, 'G1')
+    assert int(holding(sheets['holdings'])[0][4]) == 1000
+
+    # 還沒部署新版的實例在遷移後又寫進共用表
+    w.transaction_sheet.rows.append(ledger_row('r2', '賣出', 400, 1000, when='2025-01-05 10:00:00'))
+    w.holdings_sheet.rows[1][4] = 600
+
+    assert w.migrate_to_shards() == {'G1': {'transactions': 1}}
+    assert len(sheets['transactions'].rows) == 3
+    assert int(holding(sheets['holdings'])[0][4]) == 600
+
+
+def test_cron_reads_include_unmigrated_groups(sharded):
+    w = sharded
+    w.holdings_sheet.rows.append(['U1', '甲', '2330', '台積電', 1000, 900, 900000, 'G1', '', ''])
+    buy(w, 'G2', 1000, 500, datetime(2025, 2, 3, 10, 0))
+
+    groups = sorted(str(record['群組ID']) for record in w.read_all_shard_records('holdings'))
+    assert groups == ['G1', 'G2']
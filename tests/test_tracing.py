@@ -0,0 +1,39 @@
+import threading
+
+
+class BlockingCollector:
+    """收到第一筆後卡住，模擬變慢的 OTLP collector"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.received = []
+
+    def post(self, url, json=None, **kwargs):
+        self.received.append(json)
+        self.release.wait(5)
+
+
+def test_otlp_export_uses_one_thread_and_drops_when_full(w, monkeypatch):
+    collector = BlockingCollector()
+    monkeypatch.setattr(w, 'HTTP_SESSION', collector)
+    monkeypatch.setattr(w, 'OTLP_ENDPOINT', 'http://collector:4318')
+    monkeypatch.setattr(w, 'OTLP_QUEUE', None)
+    monkeypatch.setattr(w, 'OTLP_QUEUE_SIZE', 3)
+    monkeypatch.setattr(w, 'OTLP_STATS', {'exported': 0, 'failed': 0, 'dropped': 0})
+    before = set(threading.enumerate())
+
+    for i in range(10):
+        with w.start_trace('webhook.event', command=f'/cmd{i}'):
+            pass
+
+    exporters = [thread for thread in set(threading.enumerate()) - before if thread.name == 'otlp-exporter']
+    assert len(exporters) == 1
+    # 最多 1 筆送出中、3 筆排隊，其餘丟棄
+    assert w.OTLP_STATS['dropped'] >= 6
+    assert w.OTLP_QUEUE.qsize() <= 3
+
+    collector.release.set()
+    w.OTLP_QUEUE.join()
+    assert exporters[0].is_alive()
+    assert w.OTLP_STATS['exported'] + w.OTLP_STATS['dropped'] == 10
+    assert 'linebot_otlp_traces_total{result="dropped"}' in w.render_metrics()